@@ -0,0 +1,69 @@
+import argparse
+import time
+
+from blockchain.blocks import Block, Tx, Input, Output
+from blockchain.verifiers import check_signature
+from blockchain import wallet
+from blockchain.wallet import Wallet, Address
+
+"""
+Measures the effect of the interned `Address` cache on block decoding and signature verification.
+
+Builds a block where every transaction spends outputs of a few wallets, as it happens with real traffic where the
+same addresses show up again and again. Then times `Block.from_dict` and signature checks of all inputs twice:
+without cache, so every address is parsed as before, and warm, with the cache kept between rounds.
+
+Usage:
+    python -m benchmarks.address_cache --txs=200 --wallets=10 --rounds=5
+"""
+
+
+def build_block(txs, wallets):
+    wallets = [Wallet.create() for _ in range(wallets)]
+    res = []
+    jobs = []
+    for i in range(txs):
+        sender = wallets[i % len(wallets)]
+        receiver = wallets[(i + 1) % len(wallets)]
+        inp = Input('%064x' % i, 0, sender.address, 0)
+        inp.sign(sender)
+        res.append(Tx([inp], [Output(receiver.address, 1, 0), Output(sender.address, 1, 1)]))
+        jobs.append((('{}{}{}{}'.format(inp.prev_tx_hash, inp.output_index, inp.address, inp.index)).encode(), inp.signature, sender.address))
+    return Block(res, 1, '0' * 64).as_dict, jobs
+
+
+def measure(func, rounds, cache_size):
+    wallet.ADDRESS_CACHE_SIZE = cache_size
+    Address.clear_cache()
+    func()
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        spent = time.perf_counter() - started
+        best = spent if best is None else min(best, spent)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txs', type=int, default=200)
+    parser.add_argument('--wallets', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    cache_size = wallet.ADDRESS_CACHE_SIZE
+    data, jobs = build_block(args.txs, args.wallets)
+    cases = [
+        ('Block.from_dict', lambda: Block.from_dict(data)),
+        ('signature checks', lambda: all(check_signature(job) for job in jobs)),
+    ]
+    print('%s txs, %s distinct addresses, best of %s rounds' % (args.txs, args.wallets, args.rounds))
+    for name, func in cases:
+        cold = measure(func, args.rounds, 0)
+        warm = measure(func, args.rounds, cache_size)
+        print('%-18s no cache %8.2f ms   warm %8.2f ms   x%.1f' % (name, cold * 1000, warm * 1000, cold / warm))
+
+
+if __name__ == '__main__':
+    main()
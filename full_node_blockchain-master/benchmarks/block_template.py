@@ -0,0 +1,85 @@
+import argparse
+import random
+import time
+
+from blockchain.blocks import Tx, Input, Output, Block, TX_WEIGHT_OVERHEAD
+from blockchain.blockchain import Blockchain
+from blockchain.db import DB
+from blockchain.wallet import Wallet
+
+"""
+Measures block template build time and fees captured by the block packer with a big mempool.
+
+Mempool is filled with txs of 1 to 8 outputs and random fees, part of them spend outputs of earlier mempool txs, so
+there are packages of chained txs. Txs are put to the mempool directly, without verification, signatures are not
+real. For every block weight limit `Mempool.select` runs greedy only and with refinement, then the full
+`Blockchain.create_block_template` is timed, which adds coinbase, tx bodies and the Merkle tree, and its refresh on
+top of the previous template, as `TemplateManager` does it while mining.
+
+Usage:
+    python -m benchmarks.block_template --txs=20000 --weights=50000,250000,1000000 --chained=0.3
+"""
+
+
+def fill(bc, count, chained, seed):
+    rnd = random.Random(seed)
+    wallet = Wallet.create()
+    signature = 'ab' * 64
+    prev = []
+    for i in range(count):
+        if prev and rnd.random() < chained:
+            parent = prev.pop(rnd.randrange(len(prev)))
+        else:
+            parent = ('%064x' % i, 0)
+        outputs = rnd.randint(1, 8)
+        tx = Tx([Input(parent[0], parent[1], wallet.address, 0, signature=signature)], [Output(wallet.address, 1, j) for j in range(outputs)])
+        fee = rnd.randint(0, 20) * len(tx.encode()) // 10
+        bc.db.transaction_by_hash[tx.hash] = tx.as_dict
+        try:
+            bc.mempool.add(tx, fee)
+        except Exception:
+            # chain over the ancestor limit
+            continue
+        prev.extend((tx.hash, j) for j in range(outputs))
+
+
+def timed(func, repeat):
+    started = time.time()
+    for _ in range(repeat):
+        res = func()
+    return res, (time.time() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txs', type=int, default=20000)
+    parser.add_argument('--weights', type=str, default='50000,250000,1000000')
+    parser.add_argument('--chained', type=float, default=0.3)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, Wallet.create())
+    bc.create_first_block()
+    fill(bc, args.txs, args.chained, args.seed)
+    print('%s mempool entries, %.2f MB, all fees %s' % (len(bc.mempool), bc.mempool.size / 2**20, sum(el[0] for el in bc.mempool.items())))
+
+    reserved = Block([bc.create_coinbase_tx()], 1, bc.head.hash()).weight
+    for weight in [int(el) for el in args.weights.split(',')]:
+        db.config['max_block_weight'] = weight
+        print('max block weight %s' % weight)
+        for name, refine in [('greedy', 0), ('refined', 50)]:
+            selected, spent = timed(lambda: bc.mempool.select(weight - reserved, TX_WEIGHT_OVERHEAD, max_refine=refine), args.repeat)
+            used = reserved + sum(bc.mempool.entries[el[1]].size + TX_WEIGHT_OVERHEAD for el in selected)
+            print('  %-8s select %8.2f ms  %6s txs  %8s bytes  fees %8s' % (name, spent * 1000, len(selected), used, sum(el[0] for el in selected)))
+        template, spent = timed(lambda: bc.create_block_template(), args.repeat)
+        print('  template %8.2f ms  %6s txs  %8s bytes  fees %8s' % (spent * 1000, len(template.txs) - 1, template.weight, template.txs[0].outputs[0].amount - db.config['mining_reward']))
+        # refresh on top of the previous template reuses its txs and Merkle tree
+        _, spent = timed(lambda: bc.create_block_template(template), args.repeat)
+        print('  refresh  %8.2f ms' % (spent * 1000))
+
+
+if __name__ == '__main__':
+    main()
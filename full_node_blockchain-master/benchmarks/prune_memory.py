@@ -0,0 +1,78 @@
+import argparse
+import tracemalloc
+
+from blockchain.blocks import Tx, Input, Output, Block
+from blockchain.db import DB
+from blockchain.wallet import Wallet
+
+"""
+Compares memory of the in-memory DB with and without pruning under steady traffic.
+
+Every block has a coinbase and spends all outputs of the previous block into the same number of new outputs, so
+the UTXO set keeps its size and only spent transaction bodies pile up. Block index of every confirmed transaction
+is kept in both modes for inclusion proofs, it is the part which still grows with pruning.
+Blocks are applied to DB the way `Blockchain.rollover_block` does it, without mining and verification. Allocated
+memory of the DB is measured with `tracemalloc` at checkpoints. Blocks themselves are not counted, a node keeps
+only recent ones in memory with the block log of `--data-dir`, which `--prune-depth` requires.
+
+Usage:
+    python -m benchmarks.prune_memory --blocks=2000 --txs=20 --depth=6
+"""
+
+
+def make_blocks(count, txs):
+    wallet = Wallet.create()
+    coinbase_inp = Input('COINBASE', 0, wallet.address, 0)
+    coinbase_inp.sign(wallet)
+    prev = []
+    blocks = []
+    for index in range(count):
+        # first coinbase makes outputs for all txs of the next block
+        size = 1 if index else txs + 1
+        coinbase = Tx([Input('COINBASE', index, wallet.address, 0, signature=coinbase_inp.signature)], [Output(wallet.address, 1, i) for i in range(size)])
+        block_txs = [coinbase]
+        outputs = [(coinbase.hash, i) for i in range(size)]
+        # first tx joins two outputs, so the block spends all outputs of the previous one
+        groups = [[prev[0], prev[-1]]] + [[el] for el in prev[1:-1]] if prev else []
+        for group in groups:
+            inputs = [Input(tx_hash, output_index, wallet.address, 0, signature=coinbase_inp.signature) for tx_hash, output_index in group]
+            tx = Tx(inputs, [Output(wallet.address, 1, 0)])
+            block_txs.append(tx)
+            outputs.append((tx.hash, 0))
+        prev = outputs
+        blocks.append(Block(block_txs, index, blocks[-1].hash() if blocks else 0x0))
+    return blocks
+
+
+def run(blocks, prune_depth, every):
+    tracemalloc.start()
+    db = DB(prune_depth)
+    res = []
+    for block in blocks:
+        view = db.view()
+        view.apply_block(block)
+        view.commit()
+        if (block.index + 1) % every == 0:
+            res.append((block.index + 1, len(db.transaction_by_hash), tracemalloc.get_traced_memory()[0]))
+    tracemalloc.stop()
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--txs', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=6)
+    args = parser.parse_args()
+
+    blocks = make_blocks(args.blocks, args.txs)
+    every = max(1, args.blocks // 5)
+    print('%s blocks, %s txs per block, prune depth %s' % (args.blocks, args.txs + 1, args.depth))
+    for name, depth in [('full', None), ('pruned', args.depth)]:
+        print(name)
+        for height, txs, size in run(blocks, depth, every):
+            print('  block %6s  %8s txs kept  %8.2f MB' % (height, txs, size / 2**20))
+
+
+if __name__ == '__main__':
+    main()
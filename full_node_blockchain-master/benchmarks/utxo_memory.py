@@ -0,0 +1,79 @@
+import argparse
+import random
+import tracemalloc
+from collections import defaultdict
+from hashlib import sha256
+
+from blockchain.utxo import UTXOSet
+
+"""
+Compares memory used by the compact `UTXOSet` and by the UTXO structures DB had before: sets of
+(tx hash, output hash) hex tuples and dicts of output hash to amount, both keyed by address.
+
+Builds a synthetic set of outputs spread over a pool of addresses, two outputs per transaction, and measures
+allocated memory of every structure with `tracemalloc`. Hashes are made while building, so every structure pays
+for the hash strings or bytes it keeps. Addresses are the same strings for both and are not counted.
+Old structures also needed full transaction dicts to resolve output indexes, they are not counted either.
+
+Usage:
+    python -m benchmarks.utxo_memory --outputs=1000000 --addresses=10000
+"""
+
+
+def outputs(count, addresses):
+    rnd = random.Random(1)
+    pool = ['MEgCQQ%058x' % rnd.getrandbits(232) + 'AgMBAAE=' for _ in range(addresses)]
+    return [(i, pool[i % addresses], rnd.randint(1, 1000)) for i in range(count)]
+
+
+def hashes(outputs):
+    tx_hash = None
+    for i, address, amount in outputs:
+        if i % 2 == 0:
+            tx_hash = sha256(b'tx%d' % (i // 2)).hexdigest()
+        yield tx_hash, i % 2, sha256(b'out%d' % i).hexdigest(), address, amount
+
+
+def measure(build, count, addresses):
+    data = outputs(count, addresses)
+    tracemalloc.start()
+    structure = build(hashes(data))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return structure, size
+
+
+def build_old(data):
+    unspent_txs_by_user_hash = defaultdict(set)
+    unspent_outputs_amount = defaultdict(dict)
+    for tx_hash, _, out_hash, address, amount in data:
+        unspent_txs_by_user_hash[address].add((tx_hash, out_hash))
+        unspent_outputs_amount[address][out_hash] = amount
+    return unspent_txs_by_user_hash, unspent_outputs_amount
+
+
+def build_compact(data):
+    utxo = UTXOSet()
+    for tx_hash, index, _, address, amount in data:
+        utxo.add(tx_hash, index, address, amount)
+    return utxo
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outputs', type=int, default=1000000)
+    parser.add_argument('--addresses', type=int, default=10000)
+    args = parser.parse_args()
+
+    print('%s outputs, %s addresses' % (args.outputs, args.addresses))
+    res = {}
+    for name, build in [('address keyed dicts', build_old), ('UTXOSet', build_compact)]:
+        structure, size = measure(build, args.outputs, args.addresses)
+        del structure
+        res[name] = size
+        print('%-20s %8.1f MB   %6.1f bytes per output' % (name, size / 2**20, size / args.outputs))
+    print('x%.1f less memory' % (res['address keyed dicts'] / res['UTXOSet']))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 from .blocks import Tx, Block
+from . import wire
 
 """
 The API class serves as a high-level interface to the blockchain functionality. It allows interaction with the 
@@ -17,16 +18,46 @@ Methods:
 
     get_chain(self, from_block: int, limit: int = 20):
         Returns a portion of the blockchain starting from a specified block index, limited to a certain number of blocks. 
-        It also includes blocks from any potential forks (splitbrain situations).
+        When the range reaches the head, blocks of side branches from the block tree are added, so peers can
+        switch to a branch with more work.
+
+    get_chain_blocks(self, from_block: int, limit: int = 20):
+        Same as `get_chain` but returns `Block` objects.
+
+    get_chain_encoded(self, from_block: int, limit: int = 20):
+        Same as `get_chain` in the binary wire format. With block storage chain blocks are copied from the mapped
+        log as they are, without building `Block` objects.
 
     add_block(self, block):
         Adds a new block to the blockchain. If the block is valid and accepted, it triggers any necessary rollover logic.
+        Accepts either a `Block` or its dictionary representation.
 
     mine_block(self, check_stop=None):
         Initiates the block mining process. An optional callback can be provided to stop mining as needed.
+        Returns the mined block, or None if mining was stopped.
 
     add_tx(self, tx):
-        Adds a new transaction to the blockchain's pool of unconfirmed transactions.
+        Adds a new transaction to the blockchain's pool of unconfirmed transactions. Accepts a `Tx` or a dictionary.
+
+    add_txs(self, txs):
+        Adds a batch of transactions, which may depend on each other. Returns result for every transaction
+        in the given order.
+
+    has_block(self, block_hash):
+        True if the block is in the block tree, on the main chain or on a side branch.
+
+    can_reorg_from(self, height):
+        True if a fork at the height is within the reorg depth of the block tree.
+
+    get_tx_proof(self, tx_hash):
+        Returns Merkle inclusion proof of a confirmed transaction together with the header of its block, so a light
+        client can check the transaction without downloading the whole block.
+
+    get_mining_stats(self):
+        Returns mining telemetry: hashrate, time-to-block histogram, stale blocks, template age and difficulty.
+
+    get_verify_stats(self):
+        Returns size, hits and misses of the signature cache shared by mempool and block verification.
 
     get_head(self):
         Retrieves and returns the latest block in the blockchain as a dictionary.
@@ -52,44 +83,105 @@ class API:
         self.bc = blockcain
 
     def get_user_balance(self, address):
-        total = 0
-        for v in self.bc.db.unspent_outputs_amount[str(address)].values():
-            total += v
-        return total
+        return self.bc.db.utxo.balance(address)
 
     def get_user_unspent_txs(self, address):
         res = []
-        for tx_hash,out_hash in self.bc.db.unspent_txs_by_user_hash[str(address)]:
-            amount = self.bc.db.unspent_outputs_amount[str(address)][out_hash]
-            for index,out in enumerate(self.bc.db.transaction_by_hash[tx_hash]['outputs']):
-                if out['hash'] == out_hash:
-                    res.append({
-                        "tx": tx_hash,
-                        "output_index": index,
-                        "out_hash": out_hash,
-                        "amount": amount
-                    })
+        for tx_hash, index, amount in self.bc.db.utxo.by_address(address):
+            res.append({
+                "tx": tx_hash,
+                "output_index": index,
+                "out_hash": self.bc.db.transaction_by_hash[tx_hash]['outputs'][index]['hash'],
+                "amount": amount
+            })
         return res
 
     def get_chain(self, from_block:int, limit:int=20):
-        res = [b.as_dict for b in self.bc.chain[from_block:from_block+limit]]
-        # adding blocks from splitbrain
-        if len(res) < limit:
-            res += self.bc.fork_blocks.values()
+        return [b.as_dict for b in self.get_chain_blocks(from_block, limit)]
+
+    def get_chain_blocks(self, from_block:int, limit:int=20):
+        res = self.bc.chain[from_block:from_block+limit]
+        # adding blocks of side branches, so peers can switch to them
+        if len(res) < limit and from_block <= len(self.bc.chain):
+            res += [el for el in self.bc.tree.side_blocks() if el.index >= from_block]
         return res
 
+    def get_chain_encoded(self, from_block:int, limit:int=20):
+        storage = self.bc.storage
+        if storage is None or from_block < 0:
+            return wire.encode_list(self.get_chain_blocks(from_block, limit))
+        records = storage.read_records(from_block, from_block + limit)
+        count = len(range(from_block, min(from_block + limit, len(storage))))
+        if count < limit and from_block <= len(storage):
+            side_blocks = [el for el in self.bc.tree.side_blocks() if el.index >= from_block]
+            records += b''.join([wire.frame(el.encode()) for el in side_blocks])
+            count += len(side_blocks)
+        return wire.join_records(count, records)
+
     def add_block(self, block):
-        block = Block.from_dict(block)
+        if isinstance(block, dict):
+            block = Block.from_dict(block)
         res = self.bc.add_block(block)
         if res:
             self.bc.rollover_block(block)
         return res
 
     def mine_block(self, check_stop=None):
-        self.bc.force_block(check_stop)
+        return self.bc.force_block(check_stop)
 
     def add_tx(self, tx):
-        return self.bc.add_tx(Tx.from_dict(tx))
+        if isinstance(tx, dict):
+            tx = Tx.from_dict(tx)
+        return self.bc.add_tx(tx)
+
+    def add_txs(self, txs):
+        txs = [Tx.from_dict(el) if isinstance(el, dict) else el for el in txs]
+        errors = self.bc.add_txs(txs)
+        res = []
+        for tx in txs:
+            error = errors.get(tx.hash)
+            res.append({"hash": tx.hash, "success": error is None, "msg": error or ''})
+        return res
+
+    def has_block(self, block_hash):
+        return block_hash in self.bc.tree
+
+    def can_reorg_from(self, height):
+        '''
+        True if blocks of the main chain down to the height are still in the tree, so a fork there can be followed.
+        '''
+        head = self.bc.head
+        return head is not None and head.index - height <= self.bc.tree.depth
+
+    def get_tx_proof(self, tx_hash):
+        index = self.bc.db.block_index_by_tx_hash.get(tx_hash)
+        if index is None:
+            return {}
+        block = self.bc.chain[index]
+        return {
+            "tx_hash": tx_hash,
+            "block_index": block.index,
+            "block_hash": block.hash(),
+            "header": {
+                "merkel_root": block.build_merkel_tree(),
+                "prev_hash": block.prev_hash,
+                "index": block.index,
+                "nonce": block.nonce,
+                "timestamp": block.timestamp,
+            },
+            "proof": block.tx_proof(tx_hash),
+        }
+
+    def get_mining_stats(self):
+        res = self.bc.stats.as_dict()
+        res['template_age'] = self.bc.templates.age
+        res['template_refreshes'] = self.bc.templates.refreshes
+        res['difficulty'] = self.bc.db.config['difficulty']
+        res['workers'] = self.bc.miner.workers if self.bc.miner else 1
+        return res
+
+    def get_verify_stats(self):
+        return {'signature_cache': self.bc.sig_cache.as_dict()}
 
     def get_head(self):
         if not self.bc.head:
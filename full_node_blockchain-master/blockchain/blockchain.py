@@ -1,6 +1,16 @@
-from .blocks import Block, Tx, Input, Output
-from .verifiers import TxVerifier, BlockOutOfChain, BlockVerifier, BlockVerificationFailed
+from .blocks import Block, Tx, Input, Output, BlockHeader, target_digest, TX_WEIGHT_OVERHEAD
+from .miner import search_nonce
+from .template import TemplateManager
+from .stats import MiningStats
+from .verifiers import TxVerifier, BlockOutOfChain, BlockVerifier, BlockVerificationFailed, SignatureCache
+from .storage import ChainWindow
+from .tree import BlockTree, block_work
+from .mempool import Mempool, MempoolView, save_mempool, load_mempool
+from .db import UTXOView
+from collections import defaultdict, deque
 import logging
+import threading
+import time
 
 """
 A Blockchain class that encapsulates the logic for managing a blockchain instance, including block creation,
@@ -8,42 +18,96 @@ transaction processing, mining, and chain synchronization.
 
 Attributes:
     max_nonce (int): The maximum value for nonce in the Proof of Work algorithm.
-    chain (list): A list of mined blocks that forms the current blockchain.
-    unconfirmed_transactions (set): A set of transactions that have been verified but not yet included in a block.
+    chain (list): A list of mined blocks that forms the current blockchain. With storage it is a `ChainWindow`,
+                  which keeps only recent blocks in memory and reads older ones from the block log.
+    mempool (Mempool): Transactions that have been verified but not yet included in a block, by fee rate. Bounded
+        by count and size, the lowest fee rate is evicted first. Bodies of the transactions are in the DB.
     db (DB): An instance of the DB class that represents the current blockchain's state.
     wallet (Wallet): The wallet associated with the node running this blockchain instance.
     on_new_block (callable): An optional callback function to be executed when a new block is added.
     on_prev_block (callable): An optional callback function to be executed when a block is rolled back.
-    current_block_transactions (set): A set of transactions that are being processed in the current block.
-    fork_blocks (dict): A dictionary of blocks that represent alternative chains due to forks.
+    miner (Miner): An optional multi-process miner. Without it nonce search runs in the calling thread.
+    verify_pool (Executor): An optional process pool used by block verification to check signatures in parallel.
+    storage (BlockLog): An optional append-only block log. Accepted blocks are written to it.
+    sig_cache (SignatureCache): Signatures verified on mempool admission, so block verification skips them.
+    mempool_version (int): Counter bumped on every change of the mempool. Used to refresh templates.
+    templates (TemplateManager): Keeps the candidate block for mining up to date with head and mempool.
+    stats (MiningStats): Hashes, hashrate, time-to-block and stale block counters of this node mining.
+    tree (BlockTree): Recent blocks of the main chain and of side branches by hash and height with cumulative work.
+    staged (dict): Verified UTXO views by block hash, waiting for `rollover_block` to commit them.
+    lock (RLock): Held while chain, DB or mempool change and while a template is built, so API handlers, sync and
+        mining threads see consistent state. Nonce search runs without it.
 
 Methods:
     create_first_block(self):
         Creates the genesis block for the blockchain with a COINBASE transaction.
 
-    create_coinbase_tx(self, fee=0):
-        Creates a COINBASE transaction that rewards the miner.
+    replay_storage(self):
+        Rebuilds DB state from blocks already in the block log, used on node restart. Only blocks after the
+        state loaded from a snapshot are applied.
 
-    is_valid_block(self, block):
+    create_coinbase_tx(self, fee=0, signature=None):
+        Creates a COINBASE transaction that rewards the miner. Signature of another coinbase of the same wallet
+        can be passed to skip signing.
+
+    is_valid_block(self, block, view=None):
         Validates a block by checking its consistency with the previous block and the current blockchain state.
+        Changes of the block are written into the view.
 
     add_block(self, block):
         Attempts to add a block to the blockchain, handling duplicate, out-of-chain, and forked blocks.
+        A block on top of the head is verified and staged. A block of a side branch is stored in the tree, if its
+        branch has more cumulative work than the main chain the node switches to it.
+
+    switch_chain(self, tip):
+        Rolls back the main chain to the common ancestor with the tip and applies blocks of the tip branch.
+        If a block of the branch fails verification, the branch is dropped and the main chain is restored.
 
     add_tx(self, tx):
         Adds a new transaction to the pool of unconfirmed transactions if it hasn't been processed yet.
+        A transaction spending an output already spent in the pool is rejected, unless it is a valid fee bump.
+        Outputs of unconfirmed transactions can be spent, up to the ancestor limit of the mempool.
+
+    add_txs(self, txs):
+        Adds a batch of transactions at once. Transactions of the batch may spend outputs of each other, they are
+        verified parents first with all signatures checked together. Returns error or None for every transaction.
+
+    dump_mempool(self, path):
+        Saves unconfirmed transactions with their admission time to a file, see `mempool.save_mempool`.
+
+    load_mempool(self, path):
+        Adds transactions of the file back to the mempool, verified again as one batch. Invalid and confirmed
+        ones are skipped.
+
+    select_txs(self, reserved=0):
+        Picks unconfirmed transactions for the next block by packages with their unconfirmed ancestors, bigger
+        package fee rate first, parents before children, up to the block weight limit.
+
+    create_block_template(self, base=None):
+        Builds a candidate block on top of the head, prioritizing transactions with higher fees, filled up to
+        `max_block_weight`. Unconfirmed parents always go before their children.
 
     force_block(self, check_stop=None):
-        Forces the creation of a block, prioritizing transactions with higher fees.
+        Mines the current block template, switching to a fresh one whenever head or mempool changes.
 
     rollover_block(self, block):
-        Updates the blockchain state to include the transactions from the newly mined block.
+        Updates the blockchain state to include the transactions from the newly mined block. Commits the view
+        staged by `add_block`, so block transactions are walked only once.
 
     rollback_block(self):
-        Reverts the last block from the chain, restoring the blockchain state to its previous condition.
+        Reverts the last block from the chain, restoring the blockchain state to its previous condition with the
+        undo record of the block. Its transactions except coinbase go back to unconfirmed with their fees,
+        unconfirmed spends of its coinbase are evicted.
+
+    drop_invalid_txs(self, block):
+        Evicts transactions of a rejected own block which fail verification against confirmed state, or all of
+        them if none fails, so the next template differs.
 
-    mine_block(self, block, check_stop=None):
-        Mines a block using a Proof of Work algorithm with an optional stopping condition.
+    mine_block(self, block, check_stop=None, refresh=None):
+        Mines a block using a Proof of Work algorithm with an optional stopping condition and template refresh.
+
+    search_nonce(self, block, target, check_stop=None, refresh=None):
+        Single thread nonce search, used when no miner is attached.
 
 Properties:
     head (Block): Returns the latest block in the blockchain.
@@ -60,22 +124,56 @@ Usage:
 logger = logging.getLogger('Blockchain')
 
 
+def _parents_first(txs):
+    '''
+    Orders txs so every tx goes after txs of the list it spends. Otherwise keeps the given order, drops duplicates.
+    '''
+    by_hash = {}
+    for tx in txs:
+        by_hash.setdefault(tx.hash, tx)
+    parents = {h: {inp.prev_tx_hash for inp in tx.inputs if inp.prev_tx_hash in by_hash} for h, tx in by_hash.items()}
+    children = defaultdict(list)
+    for h, tx_parents in parents.items():
+        for parent in tx_parents:
+            children[parent].append(h)
+    ready = deque(h for h, tx_parents in parents.items() if not tx_parents)
+    res = []
+    while ready:
+        h = ready.popleft()
+        res.append(by_hash[h])
+        for child in children[h]:
+            parents[child].discard(h)
+            if not parents[child]:
+                ready.append(child)
+    return res
+
+
 class Blockchain: 
 
-    __slots__ =  'max_nonce', 'chain', 'unconfirmed_transactions', 'db', 'wallet', 'on_new_block', 'on_prev_block', 'current_block_transactions', 'fork_blocks'
+    __slots__ =  'max_nonce', 'chain', 'mempool', 'db', 'wallet', 'on_new_block', 'on_prev_block', 'templates', 'stats', 'tree', 'miner', 'verify_pool', 'sig_cache', 'staged', 'storage', 'lock'
 
-    def __init__(self, db, wallet, on_new_block=None, on_prev_block=None):
+    def __init__(self, db, wallet, on_new_block=None, on_prev_block=None, miner=None, verify_pool=None, sig_cache=None, storage=None, reorg_depth=100, mempool=None):
         self.max_nonce = 2**32
     
         self.db = db
         self.wallet = wallet
         self.on_new_block = on_new_block
         self.on_prev_block = on_prev_block
-
-        self.unconfirmed_transactions = set()
-        self.current_block_transactions = set()
-        self.chain = []
-        self.fork_blocks = {}    
+        self.miner = miner
+        self.verify_pool = verify_pool
+        self.sig_cache = sig_cache if sig_cache is not None else SignatureCache()
+
+        self.mempool = mempool if mempool is not None else Mempool()
+        self.templates = TemplateManager(self)
+        self.stats = MiningStats()
+        self.storage = storage
+        self.chain = ChainWindow(storage) if storage is not None else []
+        # undo records older than prune depth are dropped, so reorgs can not go deeper
+        self.tree = BlockTree(min(reorg_depth, db.prune_depth) if db.prune_depth is not None else reorg_depth)
+        for block in self.chain[max(0, len(self.chain) - self.tree.depth - 1):]:
+            self.tree.add(block, self.block_work)
+        self.staged = {}
+        self.lock = threading.RLock()
  
     def create_first_block(self):
         """
@@ -85,73 +183,273 @@ class Blockchain:
         block = Block([tx], 0, 0x0)
         self.mine_block(block)
 
-    def create_coinbase_tx(self, fee=0):
-        inp = Input('COINBASE',0,self.wallet.address,0)
-        inp.sign(self.wallet)
+    def replay_storage(self):
+        '''
+        Blocks in the log were verified when they were added, so they are only applied to DB.
+        DB restored from a snapshot or persistent DB already has the state up to its block index, only blocks
+        after it are applied. Returns number of applied blocks.
+        '''
+        start = self.db.block_index + 1 if self.db.block_index_by_tx_hash else 0
+        for height in range(start, len(self.chain)):
+            view = self.db.view()
+            view.apply_block(self.chain[height])
+            with self.db.transaction():
+                view.commit()
+        if len(self.chain) > start:
+            logger.info('Replayed %s blocks from storage' % (len(self.chain) - start))
+        return max(0, len(self.chain) - start)
+
+    def create_coinbase_tx(self, fee=0, signature=None):
+        # coinbase signature does not cover the amount, so it can be reused for another fee
+        inp = Input('COINBASE',0,self.wallet.address,0,signature=signature)
+        if signature is None:
+            inp.sign(self.wallet)
         out = Output(self.wallet.address, self.db.config['mining_reward']+fee, 0)
         return Tx([inp],[out])
 
-    def is_valid_block(self, block):
-        bv = BlockVerifier(self.db)
-        return bv.verify(self.head, block)
+    def is_valid_block(self, block, view=None):
+        bv = BlockVerifier(self.db, self.verify_pool, cache=self.sig_cache)
+        return bv.verify(self.head, block, view)
+
+    @property
+    def block_work(self):
+        return block_work(self.db.config['difficulty'])
 
     def add_block(self, block):
-        if self.head and block.hash() == self.head.hash():
-            logger.error('Duplicate block')
-            return False
-        try:
-            self.is_valid_block(block)
-        except BlockOutOfChain:
-            # Here we covering split brain case only for next 2 leves of blocks
-            # with high difficulty its a rare case, and more then 2 level much more rare.
-            if block.prev_hash == self.head.prev_hash:
-                logger.error('Split Brain detected')
-                self.fork_blocks[block.hash()] = block
+        with self.lock:
+            block_hash = block.hash()
+            if block_hash in self.tree:
+                logger.error('Duplicate block')
+                return False
+            if self.head and block.prev_hash != self.head.hash():
+                return self.add_fork_block(block)
+            view = self.db.view()
+            try:
+                self.is_valid_block(block, view)
+            except BlockOutOfChain as e:
+                logger.error('Hard chain out of sync: %s' % e)
+                return False
+            except BlockVerificationFailed as e:
+                logger.error('Block verification failed: %s' % e)
                 return False
-            else:
-                for b_hash, b in self.fork_blocks.items():
-                    if block.prev_hash == b_hash:
-                        logger.error('Split Brain fixed. Longer chain choosen')
-                        self.rollback_block()
-                        self.chain.append(b)
-                        self.chain.append(block)
-                        self.fork_blocks = {}
-                        return True
-                    logger.error('Second Split Brain detected. Not programmed to fix this')
-                    return False
-        except BlockVerificationFailed as e:
-            logger.error('Block verification failed: %s' % e)
-            return False
-        else:        
             self.chain.append(block)
-            self.fork_blocks = {}
+            self.tree.add(block, self.block_work)
+            self.tree.prune(block.index)
+            self.staged[block_hash] = view
             logger.info('   Block added')
             return True
-        logger.error('Hard chain out of sync')
 
-    def add_tx(self, tx):
-        if self.db.transaction_by_hash.get(tx.hash):
+    def add_fork_block(self, block):
+        parent = self.tree.get(block.prev_hash)
+        if parent is None:
+            logger.error('Parent of block #%s is unknown, chain out of sync' % block.index)
+            return False
+        # only proof of work is checked before the block is kept, txs are verified if its branch is chosen
+        if block.index != parent.height + 1 or bytes.fromhex(block.hash()) > target_digest(self.db.config['difficulty']):
+            logger.error('Fork block #%s is not valid' % block.index)
+            return False
+        node = self.tree.add(block, self.block_work, keep=True)
+        if node.work <= self.tree.get(self.head.hash()).work:
+            logger.error('Split Brain detected, fork block #%s stored' % block.index)
             return False
-        tv = TxVerifier(self.db)
-        fee = tv.verify(tx.inputs, tx.outputs)
-        self.db.transaction_by_hash[tx.hash] = tx.as_dict
-        self.unconfirmed_transactions.add((fee, tx.hash))
+        logger.error('Split Brain fixed. Chain with more work choosen')
+        return self.switch_chain(node)
+
+    def switch_chain(self, tip):
+        ancestor, path = self.tree.fork_path(self.head.hash(), tip.hash)
+        if ancestor is None:
+            logger.error('Fork is deeper than %s blocks, can not switch' % self.tree.depth)
+            return False
+        old = []
+        while self.head.hash() != ancestor.hash:
+            old.append(self.head)
+            self.rollback_block()
+        for node in path:
+            block = node.block
+            view = self.db.view()
+            try:
+                self.is_valid_block(block, view)
+            except (BlockOutOfChain, BlockVerificationFailed) as e:
+                logger.error('Fork block #%s verification failed: %s, main chain restored' % (block.index, e))
+                self.tree.remove(node.hash)
+                while self.head.hash() != ancestor.hash:
+                    self.rollback_block()
+                for el in reversed(old):
+                    self.chain.append(el)
+                    self.tree.get(el.hash()).block = None
+                    self.rollover_block(el)
+                return False
+            self.chain.append(block)
+            node.block = None
+            self.staged[node.hash] = view
+            # the tip is committed by the caller, as any block returned by add_block
+            if node is not tip:
+                self.rollover_block(block)
+        self.tree.prune(tip.height)
         return True
-       
+
+    def add_tx(self, tx):
+        with self.lock:
+            # body of a confirmed tx can be pruned, its block index is kept
+            if self.db.transaction_by_hash.get(tx.hash) or tx.hash in self.db.block_index_by_tx_hash:
+                return False
+            # outputs of mempool txs can be spent as well
+            tv = TxVerifier(MempoolView(self.db, self.mempool), self.sig_cache)
+            fee = tv.verify(tx.inputs, tx.outputs)
+            # raises on a conflicting spend, which is not a valid fee bump
+            evicted = self.mempool.add(tx, fee)
+            self.db.transaction_by_hash[tx.hash] = tx.as_dict
+            self.forget_txs(evicted)
+            if tx.hash in evicted:
+                raise Exception('Mempool is full, fee rate too low.')
+            return True
+
+    def forget_txs(self, tx_hashes):
+        '''
+        Drops bodies of txs evicted from the mempool, confirmed ones are kept.
+        '''
+        for tx_hash in tx_hashes:
+            if tx_hash not in self.db.block_index_by_tx_hash:
+                self.db.transaction_by_hash.pop(tx_hash, None)
+
+    @property
+    def mempool_version(self):
+        return self.mempool.version
+
+    def add_txs(self, txs, added=None):
+        '''
+        Batch version of add_tx. Txs are checked against a scratch UTXO view over confirmed and mempool outputs,
+        where every accepted tx is applied, so children see outputs of their parents from the batch and double
+        spends inside the batch are caught.
+        Optional added maps tx hash to its admission time, for txs loaded back to the mempool.
+        Returns dict of tx hash to error message, None for accepted txs.
+        '''
+        with self.lock:
+            ordered = _parents_first(txs)
+            view = UTXOView(MempoolView(self.db, self.mempool))
+            view.add_txs(ordered)
+            signatures = BlockVerifier(self.db, self.verify_pool, cache=self.sig_cache).verify_signatures(ordered, view)
+            tv = TxVerifier(view, self.sig_cache)
+            res = {}
+            evicted = []
+            for tx, tx_signatures in zip(ordered, signatures):
+                if tx.hash in self.db.transaction_by_hash or tx.hash in self.db.block_index_by_tx_hash:
+                    res[tx.hash] = 'Duplicate'
+                    continue
+                # known parent, in the mempool or confirmed, is not a rejected one
+                if any(res.get(inp.prev_tx_hash) not in (None, 'Duplicate') for inp in tx.inputs):
+                    res[tx.hash] = 'Parent transaction rejected.'
+                    continue
+                try:
+                    fee = tv.verify(tx.inputs, tx.outputs, tx_signatures)
+                    evicted.extend(self.mempool.add(tx, fee, added.get(tx.hash) if added else None))
+                except Exception as e:
+                    res[tx.hash] = str(e)
+                    continue
+                view.apply_tx(tx, None)
+                self.db.transaction_by_hash[tx.hash] = tx.as_dict
+                res[tx.hash] = None
+            self.forget_txs(evicted)
+            for tx_hash in evicted:
+                if tx_hash in res:
+                    res[tx_hash] = 'Mempool is full, fee rate too low.'
+            return res
+
+    def dump_mempool(self, path):
+        '''
+        Saves mempool txs with their admission time. Returns number of saved txs.
+        '''
+        records = []
+        # file is written after the lock is released, other threads keep adding txs
+        with self.lock:
+            for tx_hash, entry in self.mempool.entries.items():
+                body = self.db.transaction_by_hash.get(tx_hash)
+                if body is not None:
+                    records.append((entry.time, Tx.from_dict(body)))
+        save_mempool(path, records)
+        return len(records)
+
+    def load_mempool(self, path):
+        '''
+        Adds txs saved by dump_mempool as one batch, so signatures are checked together, on the verify pool if set.
+        Confirmed, expired and invalid txs are skipped. Returns number of accepted txs.
+        '''
+        records = load_mempool(path)
+        errors = self.add_txs([tx for _, tx in records], {tx.hash: added for added, tx in records})
+        with self.lock:
+            self.forget_txs(self.mempool.expire())
+        return sum(1 for tx_hash, error in errors.items() if error is None and tx_hash in self.mempool)
+
+    def select_txs(self, reserved=0):
+        '''
+        Unconfirmed txs for the next block, bigger package fee rate first, within the block weight left after
+        reserved bytes. Tx is taken only together with and after all its unconfirmed ancestors.
+        '''
+        return self.mempool.select(self.db.config['max_block_weight'] - reserved, TX_WEIGHT_OVERHEAD)
+
+    def create_block_template(self, base=None):
+        '''
+        Gathering all txs with some limit. First take Txs with bigger fee.
+        If previous template on the same head already starts with the selected txs, its merkle tree is reused:
+        new txs are appended and only coinbase leaf is replaced, so template refresh does not rehash all txs.
+        '''
+        with self.lock:
+            prev_hash = self.head.hash()
+            # coinbase weight does not depend on the fee, header and coinbase are reserved first
+            coinbase = self.create_coinbase_tx()
+            selected = self.select_txs(Block([coinbase], self.head.index+1, prev_hash).weight)
+            fee = sum([v[0] for v in selected])
+            coinbase = self.create_coinbase_tx(fee, coinbase.inputs[0].signature)
+
+            base_txs = base.txs[1:] if base is not None and base.prev_hash == prev_hash else None
+            if base_txs is not None and [el.hash for el in base_txs] == [v[1] for v in selected[:len(base_txs)]]:
+                txs = list(base_txs) + [Tx.from_dict(self.db.transaction_by_hash[v[1]]) for v in selected[len(base_txs):]]
+                tree = base.merkle_tree.copy()
+                tree.update(0, coinbase.hash)
+                for tx in txs[len(base_txs):]:
+                    tree.append(tx.hash)
+            else:
+                txs = [Tx.from_dict(self.db.transaction_by_hash[v[1]]) for v in selected]
+                tree = None
+            return Block(
+                txs=[coinbase] + txs,
+                index=self.head.index+1,
+                prev_hash=prev_hash,
+                merkle_tree=tree,
+            )
+
     def force_block(self, check_stop=None):
         '''
-        Forcing to mine block. Gthering all txs with some limit. First take Txs with bigger fee.
+        Forcing to mine block. Template refreshed in place while mining when new block or Tx arrives.
         '''
-        txs = sorted(self.unconfirmed_transactions, key=lambda x:-x[0])[:self.db.config['txs_per_block']]
-        self.current_block_transactions = set(txs)
-        fee = sum([v[0] for v in txs])
-        txs = [Tx.from_dict(self.db.transaction_by_hash[v[1]]) for v in txs ]
-        block = Block(
-            txs=[self.create_coinbase_tx(fee)] + txs,
-            index=self.head.index+1,
-            prev_hash=self.head.hash(),
-        )
-        self.mine_block(block, check_stop)
+        return self.mine_block(self.templates.current(), check_stop, self.templates.current)
+
+    def drop_invalid_txs(self, block):
+        '''
+        Evicts mempool txs of the own block which was rejected, so the next template is not the same.
+        Txs are checked in block order against confirmed outputs, if every one of them passes, the block
+        failed as a whole and all of them are evicted.
+        '''
+        with self.lock:
+            view = self.db.view()
+            tv = TxVerifier(view, self.sig_cache)
+            invalid = []
+            for tx in block.txs[1:]:
+                try:
+                    tv.verify(tx.inputs, tx.outputs)
+                except Exception as e:
+                    logger.error('Tx %s of rejected block evicted: %s' % (tx.hash, e))
+                    invalid.append(tx.hash)
+                    continue
+                view.apply_tx(tx, None)
+            if not invalid:
+                invalid = [tx.hash for tx in block.txs[1:]]
+            evicted = []
+            for tx_hash in invalid:
+                if tx_hash in self.mempool:
+                    evicted += self.mempool.evict(tx_hash)
+            self.forget_txs(evicted)
+            return evicted
 
     def rollover_block(self, block):
         '''
@@ -160,67 +458,104 @@ class Blockchain:
         Also i added some sort of callback in case some additional functionality should be added on top.
         For example some Blockchain analytic DB.
         '''
-        self.unconfirmed_transactions -= self.current_block_transactions
-        self.db.block_index = block.index
-        for tx in block.txs:
-            self.db.transaction_by_hash[tx.hash] = tx.as_dict
-            for out in tx.outputs:
-                self.db.unspent_txs_by_user_hash[str(out.address)].add((tx.hash,out.hash))
-                self.db.unspent_outputs_amount[str(out.address)][out.hash] = int(out.amount)
-            for inp in tx.inputs:
-                if inp.prev_tx_hash == 'COINBASE':
-                    continue
-                prev_out = self.db.transaction_by_hash[inp.prev_tx_hash]['outputs'][inp.output_index]
-                self.db.unspent_txs_by_user_hash[prev_out['address']].remove((inp.prev_tx_hash,prev_out['hash']))
-                del self.db.unspent_outputs_amount[prev_out['address']][prev_out['hash']]
-        if self.on_new_block:
-            self.on_new_block(block, self.db)
-        self.current_block_transactions = set()
+        with self.lock:
+            # txs spending the same outputs as the block are double spends now
+            evicted = []
+            for tx in block.txs:
+                evicted += self.mempool.confirm(tx)
+            self.forget_txs(evicted + self.mempool.expire())
+            view = self.staged.pop(block.hash(), None)
+            if view is None:
+                # block was not verified by add_block, for example the fork block choosen on split brain
+                view = self.db.view()
+                view.apply_block(block)
+            with self.db.transaction():
+                view.commit()
+            if self.on_new_block:
+                self.on_new_block(block, self.db)
 
     def rollback_block(self):
-        block = self.chain.pop()
-        self.db.block_index -= 1
-        total_amount_in = 0
-        total_amount_out = 0
-
-        for tx in block.txs:
-            # removing new unspent outputs
-            for out in tx.outputs:
-                self.db.unspent_txs_by_user_hash[str(out.address)].remove((tx.hash,out.hash))
-                del self.db.unspent_outputs_amount[str(out.address)][out.hash]
-                total_amount_out += out.amount
-            # adding back previous unspent outputs
-            for inp in tx.inputs:
-                if inp.prev_tx_hash == 'COINBASE':
-                    continue
-                prev_out = self.db.transaction_by_hash[inp.prev_tx_hash]['outputs'][inp.output_index]
-                self.db.unspent_txs_by_user_hash[prev_out['address']].add((inp.prev_tx_hash,prev_out['hash']))
-                self.db.unspent_outputs_amount[prev_out['address']][prev_out['hash']] = prev_out['amount']      
-                total_amount_in += int(prev_out['amount'])
-
-            # adding Tx back un unprocessed stack
-            fee = total_amount_in - total_amount_out
-            self.unconfirmed_transactions.add((fee,tx.hash))
-
-        
-        if self.on_prev_block:
-            self.on_prev_block(block, self.db)
-
-    def mine_block(self, block, check_stop=None):
+        with self.lock:
+            with self.db.transaction():
+                block = self.chain.pop()
+                # rolled back block stays in the tree as a side branch
+                node = self.tree.get(block.hash())
+                if node is not None:
+                    node.block = block
+                if self.staged.pop(block.hash(), None) is not None:
+                    # added, but not committed yet, DB has no changes of the block
+                    return
+                fees = self.db.undo_block(block)
+                # coinbase is not a mempool tx, others go back with their own fees
+                evicted = []
+                for tx in block.txs:
+                    if tx.hash in fees:
+                        evicted += self.mempool.add(tx, fees[tx.hash], force=True)
+                # coinbase of the block is gone, mempool txs spending it can not be valid anymore
+                for tx_hash in self.mempool.descendants(block.txs[0].hash):
+                    if tx_hash in self.mempool:
+                        evicted += self.mempool.evict(tx_hash)
+                self.forget_txs(evicted)
+
+            if self.on_prev_block:
+                self.on_prev_block(block, self.db)
+
+    def mine_block(self, block, check_stop=None, refresh=None):
         '''
-        Mine a block with ability to stop in case if check callback return True
+        Mine a block with ability to stop in case if check callback return True.
+        If miner is attached nonce search runs on its worker processes.
+        With refresh callback, search switches to the block it returns as soon as it differs from the current one.
+        '''
+        target = target_digest(self.db.config['difficulty'])
+        started = time.time()
+        while True:
+            if self.miner:
+                block = self.miner.mine(block, target, self.max_nonce, check_stop, refresh, self.stats.add_hashes)
+            else:
+                block = self.search_nonce(block, target, check_stop, refresh)
+            if not block:
+                return None
+            # nonce search runs without the lock, head can not change between the checks and the commit
+            with self.lock:
+                if self.head and block.prev_hash != self.head.hash():
+                    # new head arrived right when nonce was found
+                    logger.error('Mined block is stale.')
+                    self.stats.stale_blocks += 1
+                elif not self.add_block(block):
+                    # nothing of the block is applied, the next template is built from scratch without its bad txs
+                    logger.error('Mined block rejected.')
+                    self.drop_invalid_txs(block)
+                    self.templates.reset()
+                else:
+                    self.stats.block_found(time.time() - (max(started, self.templates.head_since) if refresh else started))
+                    self.rollover_block(block)
+                    logger.info('  Block mined at nonce: %s' % block.nonce)
+                    return block
+            if not refresh:
+                return None
+            block = refresh()
+
+    def search_nonce(self, block, target, check_stop=None, refresh=None):
         '''
-        for n in range(self.max_nonce):
+        Returns block with found nonce, which could be newer template then given one, or None if stopped
+        '''
+        while True:
+            def interrupted():
+                return (check_stop and check_stop()) or (refresh and refresh() is not block)
+
+            nonce = search_nonce(
+                BlockHeader(*block.header), target, 0, self.max_nonce, check_stop=interrupted, progress=self.stats.add_hashes
+            )
+            if nonce is not None:
+                block.nonce = nonce
+                return block
             if check_stop and check_stop():
                 logger.error('Mining interrupted.')
-                return
-            if int(block.hash(nonce=n), 16) <= (2 ** (256-self.db.config['difficulty'])):
-                self.add_block(block)
-                self.rollover_block(block)
-                logger.info('  Block mined at nonce: %s' % n)
-                break
-
-
+                return None
+            if not refresh or refresh() is block:
+                logger.error('Nonce range exhausted.')
+                return None
+            block = refresh()
 
     @property
     def head(self):
@@ -1,13 +1,30 @@
 import pytest
+from concurrent.futures import ProcessPoolExecutor
 from unittest import TestCase as tc
 import copy
+import threading
+import time
+import os
 import pprint
 
-from .blocks import Tx, Input, Output
+from hashlib import sha256
+
+from .blocks import Tx, Input, Output, Block, BlockHeader, target_digest
 from .blockchain import Blockchain
-from .wallet import Wallet
-from .verifiers import TxVerifier
+from .wallet import Wallet, Address
+from . import wallet as wallet_module
+from .verifiers import TxVerifier, BlockVerifier, BlockVerificationFailed, SignatureCache
+from .miner import Miner
+from . import wire
+from .merkle import MerkleTree, verify_proof
+from .api import API
 from .db import DB
+from .storage import BlockLog, ChainWindow
+from .utxo import UTXOSet
+from .sqlite_db import SQLiteDB
+from .snapshot import Snapshots
+from .tree import BlockTree
+from .mempool import Mempool
 
 """
 This test suite validates the functionality of various blockchain components including transactions, blockchains,
@@ -19,10 +36,127 @@ Tests:
         passes verification and that transactions with insufficient funds or with inputs signed by the wrong wallet
         raise appropriate exceptions.
 
+    test_tx_encoding():
+        Tests that transaction encoding is deterministic, survives dict round trip with the same hashes and that
+        hashed objects can not be changed.
+
+    test_wire_format():
+        Tests that blocks survive binary wire encoding with the same hashes and that a list of blocks is
+        smaller than its JSON form.
+
+    test_merkle_tree():
+        Tests that incrementally built Merkle tree matches the one built at once, known root layout for odd
+        number of leaves, and that inclusion proofs served by the API verify against the block header.
+
+    test_parallel_signatures():
+        Tests that block verification with signatures checked on a process pool accepts a valid block and
+        reports exactly the same error as the serial check for an input signed by the wrong wallet.
+
+    test_signature_cache():
+        Tests that a signature checked when a transaction enters mempool is not checked again during block
+        verification, that failed checks are not cached and that the cache is bounded, also when threads share it.
+
+    test_address_cache(monkeypatch):
+        Tests that addresses parsed from the same string are the same cached instance and keep their string form,
+        and that the cache stays bounded and consistent when threads use it at once.
+
+    test_chained_spends():
+        Tests that a transaction can spend an output of an earlier transaction in the same block and that a double
+        spend inside a block is rejected without leaving partial changes in DB.
+
+    test_tx_batch():
+        Tests that a batch of transactions spending outputs of each other is accepted in any order, that invalid
+        transactions, double spends and children of rejected transactions get their own errors, and that block
+        templates take parents before children.
+
+    test_block_log():
+        Tests that accepted blocks go to the segmented block log, rollback truncates it, a torn append is cut off
+        on open and a node restarted from the log has the same chain and DB state, while only a window of recent
+        blocks stays in memory. Binary sync payload read from the log matches encoding of the blocks.
+
+    test_utxo_set():
+        Tests the compact UTXO table: lookups by outpoint and by address, balances, spending and reuse of
+        record slots.
+
+    test_mempool():
+        Tests that the mempool selects by package fee rate with parents first even when a child came before its parent,
+        that over the limit the lowest fee rate is evicted together with its descendants and that old entries
+        expire.
+
+    test_mempool_conflicts():
+        Tests that a transaction spending an output already spent in the mempool is rejected unless it is a fee
+        bump, that a fee bump replaces the conflicting transaction, and that the outpoint index follows block
+        apply and rollback.
+
+    test_mempool_packages():
+        Tests that transactions spending outputs of mempool transactions are accepted up to the ancestor limit,
+        that the block template takes a package with its ancestors first, and that packages follow block apply and
+        rollback of an ancestor.
+
+    test_mempool_file(tmp_path):
+        Tests that the mempool saved to a file is loaded back on restart with admission times, that confirmed
+        transactions and transactions made invalid by a block are skipped with their children, and that a broken
+        file is ignored.
+
+    test_block_weight():
+        Tests that a block over `max_block_weight` fails verification, that the template fits the limit and that
+        the packer replaces a small tx by a bigger one paying more in total when the bigger one did not fit.
+
+    test_sqlite_db():
+        Tests that the SQLite backend keeps the same state as the in-memory DB through blocks and a rollback,
+        that unconfirmed transactions are not persisted, that a reopened node replays no blocks, and that a block
+        stored without its committed state is applied on restart, that backup makes a full copy and that a
+        write of another thread during a block transaction is kept in memory as unconfirmed.
+
+    test_snapshot():
+        Tests that a node restarted from a state snapshot replays only blocks stored after it and gets the same
+        state, that unconfirmed transactions are not saved and a snapshot ahead of the block log is skipped.
+
+    test_prune():
+        Tests that in pruning mode bodies of fully spent transactions are dropped once the spending block is deep
+        enough, confirmed transactions are still rejected as duplicates and rollbacks within the depth give the same
+        state as without pruning.
+
+    test_undo():
+        Tests that a multi-block rollback is done with undo records only, without reading transaction bodies, that
+        transactions of rolled back blocks return to unconfirmed with their own fees and without coinbase, and
+        that they are mined again with the right reward.
+
     test_rollback(num_wallets=2, loops=5):
         Tests the blockchain's ability to rollback transactions and revert to a previous state.
         This test creates transactions, adds them to the blockchain, and then rolls back a number of blocks.
-        It then asserts that the database state matches the expected state after rollback.
+        It then asserts that the database state matches the expected state after rollback, and that only txs which
+        do not spend a rolled back coinbase go back to the mempool.
+
+    test_block_header():
+        Tests that the midstate based `BlockHeader` gives the same hashes as hashing the full header string
+        and that the nonce it finds satisfies the target.
+
+    test_template_refresh():
+        Tests that a transaction arriving during mining refreshes the block template and the running search
+        switches to it, so the mined block contains the transaction and its fee, and that a mined block the chain
+        rejects is not applied.
+
+    test_rejected_block_txs():
+        Tests that when the own mined block is rejected, the mempool tx which made it invalid is evicted and the
+        block mined from the next template keeps the valid txs.
+
+    test_chain_lock():
+        Tests that the chain lock is free while a nonce is searched, so txs are accepted in another thread during
+        mining, and that blocks mined in one thread while txs arrive in others leave mempool and DB consistent.
+
+    test_miner_workers():
+        Tests the multi-process miner. It mines blocks on a pool of workers, checks that the block passes
+        verification, that hashes are counted in mining stats and that the stop callback interrupts the search.
+
+    test_block_tree():
+        Tests that a node follows a fork three blocks deep once the other branch has more work, ends with the same
+        state as the node which mined it, keeps its own blocks as a side branch, and that a heavier branch with an
+        invalid block, a wrong reward or a tx spending a missing output, is dropped with the main chain restored.
+
+    test_reorg_coinbase_spend():
+        Tests that a mempool tx spending the coinbase of a block replaced by a heavier fork is evicted, so the
+        next mined block does not include it.
 
     test_split_brain():
         Tests the blockchain's behavior in a split brain scenario, where two different blocks are mined simultaneously
@@ -31,7 +165,8 @@ Tests:
         and the other chain rolls back to the correct state.
 
 Each test initializes its own instances of wallets and blockchains, and manipulates transactions and blocks to
-verify the integrity and expected behavior of the blockchain under different conditions.
+verify the integrity and expected behavior of the blockchain under different conditions. Nodes, transactions and
+blocks which many tests need are made by the `_node`, `_fake_tx`, `_spend`, `_mine` and `_force_blocks` helpers.
 
 Usage:
     The tests should be run using a test runner that supports pytest.
@@ -42,6 +177,45 @@ Note:
 """
 
 
+def _node(wallet=None, difficulty=8):
+    # low difficulty, so blocks are mined fast
+    db = DB()
+    db.config['difficulty'] = difficulty
+    return Blockchain(db, wallet or Wallet.create())
+
+
+def _fake_tx(wallet, parent, outputs=1, timestamp=None):
+    # mempool and packer need only hashes, inputs and size, so signatures are not real
+    return Tx([Input(parent, 0, wallet.address, 0, signature='ab' * 64)], [Output(wallet.address, 1, i) for i in range(outputs)], timestamp)
+
+
+def _spend(signer, prev, to, amount, change=None, timestamp=None):
+    # spends the last output of prev, change output goes back to the signer
+    inp = Input(prev.hash, len(prev.outputs) - 1, signer.address, 0)
+    inp.sign(signer)
+    outputs = [Output(to.address, amount, 0)]
+    if change is not None:
+        outputs.append(Output(signer.address, change, 1))
+    return Tx([inp], outputs, timestamp)
+
+
+def _mine(bc, txs=(), fee=0):
+    # new coinbase wallet, coinbases made in the same second would have the same hash
+    bc.wallet = Wallet.create()
+    block = Block([bc.create_coinbase_tx(fee)] + list(txs), bc.head.index + 1, bc.head.hash())
+    bc.search_nonce(block, target_digest(bc.db.config['difficulty']))
+    assert API(bc).add_block(block)
+    return block
+
+
+def _force_blocks(bc, count):
+    blocks = []
+    for i in range(count):
+        bc.wallet = Wallet.create()
+        blocks.append(bc.force_block())
+    return blocks
+
+
 def test_tx_verifier():
     w = Wallet.create()
     db = DB()
@@ -58,7 +232,7 @@ def test_tx_verifier():
     assert tv.verify(tx_restored.inputs, tx_restored.outputs) == 0
 
     ####### setting out amount > input amount 
-    db.unspent_txs_by_user_hash[str(out.address)].add((tx.hash,out.hash))
+    db.utxo.add(tx.hash, 0, out.address, out.amount)
     db.transaction_by_hash[tx_restored.hash] = tx_dict
 
     inp = Input(tx_restored.hash,0,w.address,0)
@@ -84,6 +258,735 @@ def test_tx_verifier():
     assert 'Signature verification failed' in str(cm.exception)
    
 
+def test_tx_encoding():
+    w = Wallet.create()
+    inp = Input('COINBASE',0,w.address,0)
+    inp.sign(w)
+    tx = Tx([inp],[Output(w.address, 25, 0), Output(Wallet.create().address, 5, 1)])
+
+    restored = Tx.from_dict(tx.as_dict)
+    assert restored.encode() == tx.encode()
+    assert restored.hash == tx.hash
+    assert [el.hash for el in restored.outputs] == [el.hash for el in tx.outputs]
+    assert tx.outputs[0].hash != tx.outputs[1].hash
+
+    with tc().assertRaises(AttributeError):
+        tx.timestamp = 1
+    with tc().assertRaises(AttributeError):
+        tx.outputs[0].amount = 100
+    with tc().assertRaises(AttributeError):
+        tx.inputs[0].signature = None
+    assert copy.deepcopy(tx).hash == tx.hash
+
+
+def test_wire_format():
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallet)
+    bc.create_first_block()
+    inp = Input(bc.head.txs[0].hash,0,wallet.address,0)
+    inp.sign(wallet)
+    bc.add_tx(Tx([inp],[Output(Wallet.create().address, 20, 0), Output(wallet.address, 4, 1)]))
+    bc.force_block()
+
+    data = wire.encode_list(bc.chain)
+    blocks = wire.decode_blocks(data)
+    assert [b.hash() for b in blocks] == [b.hash() for b in bc.chain]
+    assert [b.as_dict for b in blocks] == [b.as_dict for b in bc.chain]
+    assert Tx.from_bytes(bc.head.txs[1].encode()).hash == bc.head.txs[1].hash
+    assert len(data) < len(str([b.as_dict for b in bc.chain])) / 2
+
+
+def test_merkle_tree():
+    leaves = [sha256(str(i).encode()).hexdigest() for i in range(13)]
+    tree = MerkleTree(leaves)
+    incremental = MerkleTree()
+    for leaf in leaves:
+        incremental.append(leaf)
+    assert incremental.levels == tree.levels
+    for i, leaf in enumerate(leaves):
+        assert verify_proof(leaf, tree.proof(i), tree.root)
+    assert not verify_proof(leaves[0], tree.proof(1), tree.root)
+
+    a, b, c = (bytes.fromhex(el) for el in leaves[:3])
+    assert MerkleTree(leaves[:3]).root == sha256(sha256(a + b).digest() + c).hexdigest()
+
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallet)
+    bc.create_first_block()
+    inp = Input(bc.head.txs[0].hash,0,wallet.address,0)
+    inp.sign(wallet)
+    tx = Tx([inp],[Output(wallet.address, 24, 0)])
+    bc.add_tx(tx)
+    bc.force_block()
+    res = API(bc).get_tx_proof(tx.hash)
+    assert res['block_index'] == 1
+    assert verify_proof(tx.hash, res['proof'], res['header']['merkel_root'])
+
+
+def test_parallel_signatures():
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallet)
+    bc.create_first_block()
+
+    def make_block(signer):
+        inp = Input(bc.head.txs[0].hash,0,wallet.address,0)
+        inp.sign(signer)
+        tx = Tx([inp],[Output(wallet.address, 20, 0)])
+        block = Block([bc.create_coinbase_tx(5), tx], 1, bc.head.hash())
+        bc.search_nonce(block, target_digest(db.config['difficulty']))
+        return block
+
+    good = make_block(wallet)
+    bad = make_block(Wallet.create())
+    with ProcessPoolExecutor(2) as pool:
+        assert BlockVerifier(db, pool, 1).verify(bc.head, good)
+        with tc().assertRaises(Exception) as parallel:
+            BlockVerifier(db, pool, 1).verify(bc.head, bad)
+    with tc().assertRaises(Exception) as serial:
+        BlockVerifier(db).verify(bc.head, bad)
+    assert 'Signature verification failed' in str(serial.exception)
+    assert str(parallel.exception) == str(serial.exception)
+
+
+def test_signature_cache():
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallet, sig_cache=SignatureCache(size=2))
+    bc.create_first_block()
+
+    inp = Input(bc.head.txs[0].hash,0,wallet.address,0)
+    inp.sign(wallet)
+    tx = Tx([inp],[Output(wallet.address, 20, 0)])
+    bc.add_tx(tx)
+    assert (bc.sig_cache.hits, bc.sig_cache.misses, len(bc.sig_cache)) == (0, 1, 1)
+
+    # block verification takes the signature checked on mempool admission
+    block = bc.force_block()
+    assert tx.hash in [el.hash for el in block.txs]
+    assert (bc.sig_cache.hits, bc.sig_cache.misses) == (1, 1)
+
+    # failed checks are not cached and the cache stays bounded
+    bad = Input(block.txs[0].hash,0,wallet.address,0)
+    bad.sign(Wallet.create())
+    with tc().assertRaises(Exception):
+        TxVerifier(db, bc.sig_cache).verify([bad], [Output(wallet.address, 20, 0)])
+    assert len(bc.sig_cache) == 1
+    for i in range(3):
+        bc.sig_cache.add(('key%s' % i,))
+    assert len(bc.sig_cache) == 2
+    assert not bc.sig_cache.check(('key0',))
+
+    def use():
+        for i in range(1000):
+            bc.sig_cache.add(('key%s' % (i % 5),))
+            bc.sig_cache.check(('key%s' % (i % 3),))
+
+    checks = bc.sig_cache.hits + bc.sig_cache.misses
+    threads = [threading.Thread(target=use) for i in range(8)]
+    for el in threads:
+        el.start()
+    for el in threads:
+        el.join()
+    assert len(bc.sig_cache) == 2 and bc.sig_cache.hits + bc.sig_cache.misses == checks + 8000
+
+
+def test_address_cache(monkeypatch):
+    wallet = Wallet.create()
+    address = Address(wallet.address)
+    assert Address(wallet.address) is address
+    assert Address(wallet.address.encode()) is address
+    assert str(address) == wallet.address
+    assert copy.deepcopy(address) is address
+
+    inp = Input('0' * 64, 0, wallet.address, 0)
+    inp.sign(wallet)
+    tx = Tx.from_dict(Tx([inp], [Output(wallet.address, 1, 0)]).as_dict)
+    assert tx.inputs[0].address is address
+    assert tx.outputs[0].address is address
+
+    # threads hitting and evicting the same entries of a small cache
+    keys = [Wallet.create().address for i in range(6)]
+    errors = []
+
+    def parse():
+        try:
+            for i in range(300):
+                key = keys[i % len(keys)]
+                assert str(Address(key)) == key
+        except Exception as e:
+            errors.append(e)
+
+    monkeypatch.setattr(wallet_module, 'ADDRESS_CACHE_SIZE', 4)
+    Address.clear_cache()
+    threads = [threading.Thread(target=parse) for i in range(8)]
+    for el in threads:
+        el.start()
+    for el in threads:
+        el.join()
+    assert not errors and len(Address._cache) <= 4
+
+
+def test_chained_spends():
+    wallet = Wallet.create()
+    other = Wallet.create()
+    third = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallet)
+    bc.create_first_block()
+    coinbase = bc.head.txs[0]
+
+    inp = Input(coinbase.hash,0,wallet.address,0)
+    inp.sign(wallet)
+    first = Tx([inp],[Output(other.address, 25, 0)])
+    inp = Input(first.hash,0,other.address,0)
+    inp.sign(other)
+    second = Tx([inp],[Output(third.address, 25, 0)])
+
+    # double spend of the same output inside one block leaves no changes in DB
+    inp = Input(coinbase.hash,0,wallet.address,0)
+    inp.sign(wallet)
+    double = Tx([inp],[Output(wallet.address, 25, 0)], first.timestamp + 1)
+    block = Block([bc.create_coinbase_tx(), first, double], 1, bc.head.hash())
+    bc.search_nonce(block, target_digest(db.config['difficulty']))
+    state = copy.deepcopy((db.transaction_by_hash, sorted(db.utxo.items())))
+    with tc().assertRaises(BlockVerificationFailed) as e:
+        BlockVerifier(db).verify(bc.head, block)
+    assert 'already spent' in str(e.exception)
+    assert not bc.add_block(block)
+    assert (db.transaction_by_hash, sorted(db.utxo.items())) == state
+    assert not bc.staged
+
+    # second tx spends output of the first one in the same block
+    block = Block([bc.create_coinbase_tx(), first, second], 1, bc.head.hash())
+    bc.search_nonce(block, target_digest(db.config['difficulty']))
+    assert API(bc).add_block(block)
+    assert db.block_index == 1
+    assert not bc.staged
+    assert API(bc).get_user_balance(other.address) == 0
+    assert API(bc).get_user_balance(third.address) == 25
+    assert db.block_index_by_tx_hash[second.hash] == 1
+
+
+def test_tx_batch():
+    wallets = [Wallet.create() for _ in range(4)]
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallets[0])
+    bc.create_first_block()
+
+    # chain of txs passing coins from wallet to wallet, each one spends the previous
+    txs = []
+    prev_hash = bc.head.txs[0].hash
+    for sender, receiver in zip(wallets, wallets[1:]):
+        inp = Input(prev_hash,0,sender.address,0)
+        inp.sign(sender)
+        txs.append(Tx([inp],[Output(receiver.address, 25 - len(txs), 0)]))
+        prev_hash = txs[-1].hash
+    # room for two txs of the chain
+    db.config['max_block_weight'] = Block([bc.create_coinbase_tx()] + txs[:2], 1, bc.head.hash()).weight
+    # spends output already spent by the first tx of the batch
+    inp = Input(bc.head.txs[0].hash,0,wallets[0].address,0)
+    inp.sign(wallets[0])
+    double = Tx([inp],[Output(wallets[0].address, 25, 0)], txs[0].timestamp + 1)
+    # signed by wrong wallet, so its child is rejected as well
+    inp = Input(txs[-1].hash,0,wallets[3].address,0)
+    inp.sign(wallets[0])
+    bad = Tx([inp],[Output(wallets[0].address, 1, 0)])
+    inp = Input(bad.hash,0,wallets[0].address,0)
+    inp.sign(wallets[0])
+    orphan = Tx([inp],[Output(wallets[0].address, 1, 0)])
+
+    res = API(bc).add_txs([el.as_dict for el in [orphan, bad] + list(reversed(txs)) + [double]])
+    assert [el['hash'] for el in res] == [el.hash for el in [orphan, bad] + list(reversed(txs)) + [double]]
+    assert [el['success'] for el in res] == [False, False, True, True, True, False]
+    assert res[0]['msg'] == 'Parent transaction rejected.'
+    assert 'Signature verification failed' in res[1]['msg']
+    assert 'already spent' in res[-1]['msg']
+    assert API(bc).add_txs([txs[0]])[0]['msg'] == 'Duplicate'
+
+    # children have bigger fee, still parents go first
+    assert [el.hash for el in bc.templates.current().txs[1:]] == [el.hash for el in txs[:2]]
+    bc.force_block()
+    bc.force_block()
+    assert not bc.mempool
+    assert API(bc).get_user_balance(wallets[3].address) == 23
+
+
+def test_block_log(tmp_path):
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 8
+    # small segments, so blocks are spread over several files
+    log = BlockLog(str(tmp_path), segment_size=1024, sync_every=2)
+    bc = Blockchain(db, wallet, storage=log)
+    bc.create_first_block()
+    for i in range(6):
+        inp = Input(bc.head.txs[0].hash,0,bc.wallet.address,0)
+        inp.sign(bc.wallet)
+        bc.add_tx(Tx([inp],[Output(wallet.address, 25, 0)]))
+        # coinbase of every block goes to a new wallet, so coinbase txs made within a second differ
+        bc.wallet = Wallet.create()
+        bc.force_block()
+    bc.rollback_block()
+    hashes = [el.hash() for el in bc.chain]
+    assert len(log) == 6
+    assert len([el for el in tmp_path.iterdir() if el.suffix == '.blk']) > 1
+    assert log.height_of(hashes[3]) == 3
+    log.close()
+
+    # torn append: partial record and index entry are cut off on open
+    last_segment = sorted(el for el in tmp_path.iterdir() if el.suffix == '.blk')[-1]
+    with open(last_segment, 'ab') as fp:
+        fp.write(b'\x00\x00\x01\x00partial')
+    with open(tmp_path / 'index', 'ab') as fp:
+        fp.write(b'\x00' * 20)
+
+    log = BlockLog(str(tmp_path))
+    restored = Blockchain(DB(), wallet, storage=log)
+    restored.replay_storage()
+    assert [el.hash() for el in restored.chain] == hashes
+    assert restored.db.block_index == db.block_index
+    assert sorted(restored.db.utxo.items()) == sorted(db.utxo.items())
+    assert API(restored).get_chain(2, 3) == API(bc).get_chain(2, 3)
+    # binary sync is served straight from the mapped log, across segment borders
+    for start, limit in [(0, 20), (2, 3), (5, 4), (9, 2)]:
+        blocks = API(restored).get_chain_blocks(start, limit)
+        assert API(restored).get_chain_encoded(start, limit) == wire.encode_list(blocks)
+
+    # only the window of recent blocks is kept in memory
+    chain = ChainWindow(log, window=2)
+    assert len(chain._recent) == 2
+    assert [el.hash() for el in chain[1:5]] == hashes[1:5]
+    assert chain[-1].hash() == hashes[-1]
+    chain.append(bc.head.__class__.from_bytes(log.read_raw(0)))
+    assert len(chain._recent) == 2 and len(log) == 7
+    chain.pop()
+    assert len(log) == 6 and chain[-1].hash() == hashes[-1]
+    log.close()
+
+
+def test_utxo_set():
+    a, b = Wallet.create().address, Wallet.create().address
+    utxo = UTXOSet()
+    utxo.add('11' * 32, 0, a, 10)
+    utxo.add('11' * 32, 1, b, 5)
+    utxo.add('22' * 32, 0, a, 7)
+    assert len(utxo) == 3 and ('11' * 32, 1) in utxo
+    assert utxo.get('11' * 32, 0) == (a, 10)
+    assert utxo.balance(a) == 17 and utxo.balance(Wallet.create().address) == 0
+    assert sorted(utxo.by_address(a)) == [('11' * 32, 0, 10), ('22' * 32, 0, 7)]
+
+    assert utxo.spend('11' * 32, 0) == (a, 10)
+    assert utxo.get('11' * 32, 0) is None
+    with tc().assertRaises(KeyError):
+        utxo.spend('11' * 32, 0)
+    # output index past reserved run moves the tx to a bigger one
+    utxo.add('22' * 32, 2, b, 1)
+    assert sorted(utxo.items()) == [('11' * 32, 1, b, 5), ('22' * 32, 0, a, 7), ('22' * 32, 2, b, 1)]
+    assert utxo.balance(b) == 6 and utxo.balance(a) == 7
+    # run of fully spent tx is reused
+    slots = len(utxo._owners)
+    utxo.spend('11' * 32, 1)
+    utxo.add('44' * 32, 0, a, 3, size=2)
+    assert len(utxo._owners) == slots
+    assert sorted(utxo.by_address(a)) == [('22' * 32, 0, 7), ('44' * 32, 0, 3)]
+    assert len(utxo) == 3
+
+
+def test_mempool():
+    w = Wallet.create()
+    a = _fake_tx(w, '11' * 32)
+    b = _fake_tx(w, a.hash)
+    c = _fake_tx(w, '22' * 32)
+    pool = Mempool(max_count=3, max_age=100)
+    # child comes back before parent, like on rollback
+    assert pool.add(b, 900) == [] and pool.add(a, 100) == [] and pool.add(c, 400) == []
+    # child pays for its parent, package of both goes before c
+    size = len(a.encode())
+    assert pool.select(3 * size) == [(100, a.hash), (900, b.hash), (400, c.hash)]
+    assert pool.select(size) == [(400, c.hash)]
+    assert pool.size == size * 3
+
+    d = _fake_tx(w, '33' * 32)
+    assert pool.add(d, 300) == [a.hash, b.hash]
+    assert pool.items() == {(400, c.hash), (300, d.hash)}
+    e = _fake_tx(w, '44' * 32)
+    assert pool.add(e, 50) == []
+    assert pool.add(_fake_tx(w, '55' * 32), 10)[0] != e.hash and len(pool) == 3
+    pool.remove(c.hash)
+    assert pool.select(5 * size) == [(300, d.hash), (50, e.hash)]
+
+    # entries expire in order of admission
+    pool = Mempool(max_age=100)
+    old = _fake_tx(w, '66' * 32)
+    pool.add(old, 1000, added=time.time() - 200)
+    child = _fake_tx(w, old.hash)
+    pool.add(child, 1000)
+    pool.add(d, 300)
+    assert pool.expire() == [old.hash, child.hash]
+    assert list(pool) == [d.hash]
+
+
+def test_mempool_conflicts():
+    wallet = Wallet.create()
+    other = Wallet.create()
+    bc = _node(wallet)
+    db = bc.db
+    bc.create_first_block()
+    coinbase = bc.head.txs[0]
+
+    first = _spend(wallet, coinbase, other, 24)
+    assert bc.add_tx(first)
+    with tc().assertRaises(Exception) as e:
+        bc.add_tx(_spend(wallet, coinbase, other, 24, timestamp=first.timestamp + 1))
+    assert 'fee rate too low' in str(e.exception)
+    # fee rate is higher, but the absolute fee is not bigger by min_bump
+    bc.mempool.min_bump = 2
+    with tc().assertRaises(Exception) as e:
+        bc.add_tx(_spend(wallet, coinbase, other, 23))
+    assert 'fee too low' in str(e.exception)
+    assert bc.mempool.items() == {(1, first.hash)}
+
+    bump = _spend(wallet, coinbase, other, 20)
+    assert bc.add_tx(bump)
+    assert bc.mempool.items() == {(5, bump.hash)}
+    assert first.hash not in db.transaction_by_hash
+    bc.mempool.min_bump = None
+    with tc().assertRaises(Exception) as e:
+        bc.add_tx(_spend(wallet, coinbase, other, 10))
+    assert 'already spent by unconfirmed' in str(e.exception)
+    assert API(bc).add_txs([_spend(wallet, coinbase, other, 15)])[0]['msg'].startswith('Output already spent')
+
+    # block spends the same output, the mempool tx is a double spend now
+    confirmed = _spend(wallet, coinbase, other, 25)
+    _mine(bc, [confirmed])
+    assert not bc.mempool and bump.hash not in db.transaction_by_hash
+
+    # rolled back tx comes back to the mempool and indexes its outputs again
+    bc.rollback_block()
+    assert bc.mempool.items() == {(0, confirmed.hash)}
+    assert bc.mempool.conflicts(bump) == [confirmed.hash]
+    bc.mempool.min_bump = 1
+    assert bc.add_tx(bump)
+    assert bc.mempool.items() == {(5, bump.hash)}
+    assert [el[1] for el in bc.select_txs()] == [bump.hash]
+
+
+def test_mempool_packages():
+    wallet = Wallet.create()
+    other = Wallet.create()
+    bc = _node(wallet)
+    bc.create_first_block()
+
+    first = _spend(wallet, bc.head.txs[0], other, 5, 20)
+    second = _spend(wallet, first, other, 5, 14)
+    third = _spend(wallet, second, other, 5, 4)
+    assert bc.add_tx(first) and bc.add_tx(second)
+    assert bc.mempool.entries[second.hash].anc_count == 2
+    bc.mempool.max_ancestors = 2
+    with tc().assertRaises(Exception) as e:
+        bc.add_tx(third)
+    assert 'Too many unconfirmed ancestors' in str(e.exception)
+    bc.mempool.max_ancestors = 25
+    assert API(bc).add_txs([third])[0]['success']
+    assert bc.mempool.entries[third.hash].anc_fee == 6
+
+    # third pays for its ancestors without fee
+    template = bc.create_block_template()
+    assert [tx.hash for tx in template.txs[1:]] == [first.hash, second.hash, third.hash]
+    assert template.txs[0].outputs[0].amount == 25 + 6
+
+    _mine(bc, [first])
+    assert bc.mempool.items() == {(1, second.hash), (5, third.hash)}
+    assert bc.mempool.entries[third.hash].anc_count == 2
+    assert bc.mempool.entries[third.hash].anc_size == len(second.encode()) + len(third.encode())
+
+    bc.rollback_block()
+    assert bc.mempool.entries[third.hash].anc_count == 3
+    assert bc.mempool.entries[third.hash].anc_fee == 6
+    assert [el[1] for el in bc.select_txs()] == [first.hash, second.hash, third.hash]
+
+
+def test_mempool_file(tmp_path):
+    wallet = Wallet.create()
+    other = Wallet.create()
+    bc = _node(wallet)
+    db = bc.db
+    bc.create_first_block()
+
+    _mine(bc)
+    miner = bc.wallet
+    first = _spend(wallet, bc.chain[0].txs[0], other, 5, 19)
+    child = _spend(wallet, first, other, 5, 13)
+    second = _spend(miner, bc.head.txs[0], other, 5, 18)
+    second_child = _spend(miner, second, other, 5, 12)
+    for tx in [first, child, second, second_child]:
+        assert bc.add_tx(tx)
+    path = str(tmp_path / 'mempool.dat')
+    assert bc.dump_mempool(path) == 4
+    added = bc.mempool.entries[second_child.hash].time
+
+    # block confirms second and spends the output of first
+    double = _spend(wallet, bc.chain[0].txs[0], other, 25, 0)
+    _mine(bc, [double, second], 2)
+    assert bc.mempool.items() == {(1, second_child.hash)}
+
+    # restarted node has no unconfirmed txs
+    bc.forget_txs(list(bc.mempool))
+    restored = Blockchain(db, wallet)
+    assert restored.load_mempool(path) == 1
+    assert restored.mempool.items() == {(1, second_child.hash)}
+    assert restored.mempool.entries[second_child.hash].time == added
+
+    with open(path, 'r+b') as fp:
+        fp.truncate(os.path.getsize(path) - 3)
+    assert Blockchain(db, wallet).load_mempool(path) == 0
+    assert Blockchain(db, wallet).load_mempool(str(tmp_path / 'missing')) == 0
+
+
+def test_block_weight():
+    w = Wallet.create()
+    small = _fake_tx(w, '11' * 32)
+    big = _fake_tx(w, '22' * 32, 10)
+    other = _fake_tx(w, '33' * 32)
+    small_size = len(small.encode())
+    big_size = len(big.encode())
+    assert big_size > 2 * small_size
+    pool = Mempool()
+    pool.add(small, small_size * 2)
+    pool.add(big, big_size * 3 // 2)
+    # greedy takes small by fee rate, then big does not fit and replaces it
+    assert pool.select(big_size + small_size - 1) == [(big_size * 3 // 2, big.hash)]
+    assert pool.select(big_size + small_size) == [(small_size * 2, small.hash), (big_size * 3 // 2, big.hash)]
+    # replacing both small txs would lose fees
+    pool.add(other, small_size * 2)
+    pool.remove(big.hash)
+    pool.add(_fake_tx(w, '44' * 32, 10), small_size * 3)
+    assert {el[1] for el in pool.select(big_size + small_size - 1)} == {small.hash, other.hash}
+    assert {el[1] for el in pool.select(big_size + small_size)} != {small.hash, other.hash}
+
+    wallet = Wallet.create()
+    bc = _node(wallet)
+    db = bc.db
+    bc.create_first_block()
+    inp = Input(bc.head.txs[0].hash, 0, wallet.address, 0)
+    inp.sign(wallet)
+    spend = Tx([inp], [Output(wallet.address, 1, i) for i in range(20)])
+    assert bc.add_tx(spend)
+    bc.wallet = Wallet.create()
+    template = bc.create_block_template()
+    assert [el.hash for el in template.txs[1:]] == [spend.hash]
+    db.config['max_block_weight'] = template.weight - 1
+    assert bc.create_block_template().txs[1:] == ()
+    bc.search_nonce(template, target_digest(db.config['difficulty']))
+    assert not API(bc).add_block(template)
+    db.config['max_block_weight'] = template.weight
+    assert API(bc).add_block(template)
+
+
+def test_sqlite_db(tmp_path, monkeypatch):
+    wallet = Wallet.create()
+    path = str(tmp_path / 'chain.sqlite')
+    db = SQLiteDB(path)
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallet, storage=db.blocks)
+    mem = Blockchain(DB(), wallet)
+    mem.db.config['difficulty'] = 8
+    bc.create_first_block()
+    mem.add_block(bc.head)
+    mem.rollover_block(bc.head)
+    for i in range(4):
+        inp = Input(bc.head.txs[0].hash,0,bc.wallet.address,0)
+        inp.sign(bc.wallet)
+        tx = Tx([inp],[Output(wallet.address, 20, 0), Output(Wallet.create().address, 5, 1)])
+        bc.add_tx(tx)
+        # unconfirmed tx is visible but is not written to the database
+        assert tx.hash in db.transaction_by_hash
+        assert not db.execute('SELECT 1 FROM transactions WHERE key = ?', (tx.hash,)).fetchone()
+        bc.wallet = mem.wallet = Wallet.create()
+        block = bc.force_block()
+        assert mem.add_block(block)
+        mem.rollover_block(block)
+    bc.rollback_block()
+    mem.rollback_block()
+    assert db.block_index == mem.db.block_index == 3
+    assert sorted(db.utxo.items()) == sorted(mem.db.utxo.items())
+    assert db.utxo.balance(wallet.address) == mem.db.utxo.balance(wallet.address)
+    assert sorted(db.utxo.by_address(wallet.address)) == sorted(mem.db.utxo.by_address(wallet.address))
+    # rolled back block is served after the chain as a side branch
+    assert API(bc).get_chain_encoded(0, 10) == wire.encode_list(API(mem).get_chain_blocks(0, 10))
+    assert len(API(mem).get_chain_blocks(0, 10)) == 5
+    hashes = [el.hash() for el in bc.chain]
+    utxo = sorted(db.utxo.items())
+    db.close()
+
+    # block appended, but node stopped before its state was committed
+    db = SQLiteDB(path)
+    db.config['difficulty'] = 8
+    restored = Blockchain(db, wallet, storage=db.blocks)
+    assert [el.hash() for el in restored.chain] == hashes
+    assert sorted(db.utxo.items()) == utxo
+    # txs of the rolled back block are not mined again, restarted node has no mempool
+    mem.mempool = Mempool()
+    mem.wallet = Wallet.create()
+    mem_block = mem.force_block()
+    assert restored.add_block(mem_block)
+    db.close()
+
+    db = SQLiteDB(path)
+    restored = Blockchain(db, wallet, storage=db.blocks)
+    assert db.block_index == 3
+    restored.replay_storage()
+    assert db.block_index == mem.db.block_index == 4
+    assert sorted(db.utxo.items()) == sorted(mem.db.utxo.items())
+    assert mem_block.txs[0].hash in db.block_index_by_tx_hash
+    assert len(db.blocks) == 5
+    monkeypatch.chdir(tmp_path)
+    db.backup()
+    copy = SQLiteDB(str(tmp_path / 'block_4.sqlite'))
+    assert sorted(copy.utxo.items()) == sorted(db.utxo.items()) and len(copy.blocks) == 5
+    copy.close()
+
+    # write of another thread during a block transaction is an unconfirmed one, it stays in memory
+    writer = threading.Thread(target=db.transaction_by_hash.update, args=({'ab' * 32: {'unconfirmed': True}},))
+    with db.transaction():
+        writer.start()
+        time.sleep(0.1)
+        assert db.in_transaction
+    writer.join()
+    assert not db.in_transaction
+    assert 'ab' * 32 in db.transaction_by_hash.pending
+    assert db.execute('SELECT 1 FROM transactions WHERE key = ?', ('ab' * 32,)).fetchone() is None
+    db.close()
+
+
+def test_snapshot(tmp_path):
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 8
+    log = BlockLog(str(tmp_path / 'blocks'))
+    snapshots = Snapshots(str(tmp_path / 'snapshots'), keep=2)
+    bc = Blockchain(db, wallet, storage=log, on_new_block=lambda block, db: snapshots.save(db, block))
+    bc.create_first_block()
+    for i in range(4):
+        inp = Input(bc.head.txs[0].hash,0,bc.wallet.address,0)
+        inp.sign(bc.wallet)
+        bc.add_tx(Tx([inp],[Output(wallet.address, 25, 0)]))
+        bc.wallet = Wallet.create()
+        bc.force_block()
+    assert snapshots.heights() == [3, 4]
+    bc.on_new_block = None
+    bc.wallet = Wallet.create()
+    bc.force_block()
+    inp = Input(bc.head.txs[0].hash,0,bc.wallet.address,0)
+    inp.sign(bc.wallet)
+    unconfirmed = Tx([inp],[Output(wallet.address, 25, 0)])
+    bc.add_tx(unconfirmed)
+    snapshots.save(db, bc.head)
+    log.close()
+
+    log = BlockLog(str(tmp_path / 'blocks'))
+    restored = Blockchain(snapshots.load(log), wallet, storage=log)
+    assert restored.replay_storage() == 0
+    assert unconfirmed.hash not in restored.db.transaction_by_hash
+
+    # older snapshot is loaded and only the tail is replayed
+    os.remove(snapshots._file(5))
+    restored = Blockchain(snapshots.load(log), wallet, storage=log)
+    assert restored.db.block_index == 4
+    assert restored.replay_storage() == 1
+    assert restored.db.block_index == db.block_index
+    assert sorted(restored.db.utxo.items()) == sorted(db.utxo.items())
+    assert restored.db.block_index_by_tx_hash == db.block_index_by_tx_hash
+
+    # snapshot ahead of the truncated log is skipped
+    snapshots.save(restored.db, restored.head)
+    log.truncate(5)
+    assert snapshots.heights() == [4, 5]
+    restored = Blockchain(snapshots.load(log), wallet, storage=log)
+    assert restored.db.block_index == 4 and restored.replay_storage() == 0
+    log.close()
+
+
+def test_prune():
+    wallet = Wallet.create()
+    db = DB(prune_depth=2)
+    full = DB()
+    db.config['difficulty'] = full.config['difficulty'] = 8
+    bc = Blockchain(db, wallet)
+    ref = Blockchain(full, wallet)
+    bc.create_first_block()
+    ref.add_block(bc.head)
+    ref.rollover_block(bc.head)
+    for i in range(6):
+        inp = Input(bc.head.txs[0].hash,0,bc.wallet.address,0)
+        inp.sign(bc.wallet)
+        bc.add_tx(Tx([inp],[Output(wallet.address, 25, 0)]))
+        bc.wallet = Wallet.create()
+        block = bc.force_block()
+        assert ref.add_block(block)
+        ref.rollover_block(block)
+
+    # coinbase of block k is spent in block k+1, it is pruned when that block is 2 deep
+    coinbases = [el.txs[0] for el in bc.chain]
+    assert [el.hash in db.transaction_by_hash for el in coinbases] == [False] * 4 + [True] * 3
+    assert all(el.txs[1].hash in db.transaction_by_hash for el in bc.chain[1:])
+    assert not bc.add_tx(coinbases[0])
+    assert len(db.transaction_by_hash) < len(full.transaction_by_hash)
+
+    for i in range(2):
+        bc.rollback_block()
+        ref.rollback_block()
+    assert sorted(db.utxo.items()) == sorted(full.utxo.items())
+    assert all(full.transaction_by_hash[k] == v for k, v in db.transaction_by_hash.items())
+
+
+def test_undo():
+    wallets = [Wallet.create() for _ in range(3)]
+    db = DB()
+    db.config['difficulty'] = 8
+    bc = Blockchain(db, wallets[0])
+    bc.create_first_block()
+    utxo = sorted(db.utxo.items())
+
+    # parent and child in the same block, fees 5 and 2
+    inp = Input(bc.head.txs[0].hash,0,wallets[0].address,0)
+    inp.sign(wallets[0])
+    parent = Tx([inp],[Output(wallets[1].address, 20, 0)])
+    inp = Input(parent.hash,0,wallets[1].address,0)
+    inp.sign(wallets[1])
+    child = Tx([inp],[Output(wallets[2].address, 18, 0)])
+    assert not any(bc.add_txs([child, parent]).values())
+    for i in range(3):
+        bc.wallet = Wallet.create()
+        bc.force_block()
+    assert bc.chain[1].txs[0].outputs[0].amount == 32
+    assert sorted(db.undo) == [0, 1, 2, 3]
+
+    bodies = db.transaction_by_hash
+    db.transaction_by_hash = {}
+    for i in range(3):
+        bc.rollback_block()
+    db.transaction_by_hash = bodies
+    assert db.block_index == 0 and sorted(db.undo) == [0]
+    assert sorted(db.utxo.items()) == utxo
+    assert bc.mempool.items() == {(5, parent.hash), (2, child.hash)}
+    assert parent.hash not in db.block_index_by_tx_hash
+
+    bc.wallet = Wallet.create()
+    block = bc.force_block()
+    assert [el.hash for el in block.txs[1:]] == [parent.hash, child.hash]
+    assert block.txs[0].outputs[0].amount == 32
+
+
 def test_rollback(num_wallets=2, loops=5):
     wallet = Wallet.create()
     __db = DB()
@@ -107,6 +1010,7 @@ def test_rollback(num_wallets=2, loops=5):
             prev_db = copy.deepcopy(__db)
 
     new_block = copy.deepcopy(bc.head)
+    rolled = [copy.deepcopy(el) for el in bc.chain[-loops:]]
 
     for mn in range(loops):
         bc.rollback_block()
@@ -117,14 +1021,91 @@ def test_rollback(num_wallets=2, loops=5):
     for k,v in prev_db.transaction_by_hash.items():
         tt.assertDictEqual(__db.transaction_by_hash.get(k, None), prev_db.transaction_by_hash.get(k, None))
 
-    for tx in new_block.txs:
-        assert __db.transaction_by_hash.get(tx.hash, False)
+    # tx of the first rolled back block spends a confirmed coinbase and goes back to mempool,
+    # later ones spend coinbases of rolled back blocks and are evicted
+    assert __db.transaction_by_hash.get(rolled[0].txs[1].hash, False) and rolled[0].txs[1].hash in bc.mempool
+    for block in rolled[1:]:
+        assert block.txs[1].hash not in bc.mempool
+        assert not __db.transaction_by_hash.get(block.txs[1].hash, False)
+
+    tt.assertListEqual(sorted(__db.utxo.items()), sorted(prev_db.utxo.items()))
+
+def test_block_tree():
+    bc1, bc2, bad = _node(), _node(), _node()
+    bc1.create_first_block()
+    for bc in (bc2, bad):
+        assert API(bc).add_block(bc1.head)
+    bad.db.config['mining_reward'] = 100
+    own = _force_blocks(bc1, 2)
+    fork = _force_blocks(bc2, 3)
+    utxo = sorted(bc1.db.utxo.items())
+
+    assert not API(bc1).add_block(fork[0]) and not API(bc1).add_block(fork[1])
+    assert bc1.head.hash() == own[-1].hash() and sorted(bc1.db.utxo.items()) == utxo
+    assert API(bc1).add_block(fork[2])
+    assert [el.hash() for el in bc1.chain] == [el.hash() for el in bc2.chain]
+    assert sorted(bc1.db.utxo.items()) == sorted(bc2.db.utxo.items())
+    assert bc1.db.block_index == 3
+    assert [el.hash() for el in bc1.tree.side_blocks()] == [el.hash() for el in own]
+    assert [el.height for el in bc1.tree.at_height(1)] == [1, 1]
+
+    # branch with more work, but its first block pays too big reward
+    invalid = _force_blocks(bad, 4)
+    for block in invalid:
+        assert not API(bc1).add_block(block)
+    assert bc1.head.hash() == fork[-1].hash()
+    assert sorted(bc1.db.utxo.items()) == sorted(bc2.db.utxo.items())
+    assert not any(el.hash() in bc1.tree for el in invalid)
 
-    for k,v in __db.unspent_txs_by_user_hash.items():
-        tt.assertSetEqual(v, prev_db.unspent_txs_by_user_hash.get(k, set())) 
+    # branch with more work from genesis, its second block spends a missing output
+    maker = _node()
+    spender = Wallet.create()
+    inp = Input('ff' * 32, 0, spender.address, 0)
+    inp.sign(spender)
+    missing = Tx([inp], [Output(spender.address, 1, 0)])
+    branch = []
+    prev = bc1.chain[0]
+    for index in range(1, 5):
+        maker.wallet = Wallet.create()
+        txs = [maker.create_coinbase_tx()] + ([missing] if index == 2 else [])
+        block = Block(txs, index, prev.hash())
+        maker.search_nonce(block, target_digest(8))
+        branch.append(block)
+        prev = block
+    for block in branch:
+        assert not API(bc1).add_block(block)
+    assert bc1.head.hash() == fork[-1].hash()
+    assert [el.hash() for el in bc1.chain] == [el.hash() for el in bc2.chain]
+    assert sorted(bc1.db.utxo.items()) == sorted(bc2.db.utxo.items())
+    assert not any(el.hash() in bc1.tree for el in branch[1:])
+    assert not any(el.hash() in [side.hash() for side in bc1.tree.side_blocks()] for el in branch[1:])
+
+    tree = BlockTree(depth=1)
+    for block in bc2.chain:
+        tree.add(block, 1)
+    tree.prune(bc2.head.index)
+    assert sorted(tree.by_height) == [2, 3] and tree.get(bc2.head.hash()).work == 4
+
+
+def test_reorg_coinbase_spend():
+    bc1, bc2 = _node(), _node()
+    bc1.create_first_block()
+    assert API(bc2).add_block(bc1.head)
+
+    block = _force_blocks(bc1, 1)[0]
+    tx = _spend(bc1.wallet, block.txs[0], Wallet.create(), 20)
+    assert bc1.add_tx(tx) and tx.hash in bc1.mempool
+
+    fork = _force_blocks(bc2, 2)
+    for el in fork:
+        API(bc1).add_block(el)
+    assert bc1.head.hash() == fork[-1].hash()
+    assert tx.hash not in bc1.mempool and tx.hash not in bc1.db.transaction_by_hash
+
+    mined = _force_blocks(bc1, 1)[0]
+    assert mined is not None and bc1.head.hash() == mined.hash()
+    assert [el.hash for el in mined.txs[1:]] == []
 
-    for k,v in __db.unspent_outputs_amount.items():
-        tt.assertDictEqual(v,prev_db.unspent_outputs_amount.get(k, {}))
 
 def test_split_brain():
     wallet1 = Wallet.create()
@@ -147,3 +1128,157 @@ def test_split_brain():
     # as second blockchain longer first blockchain should make rollback to the 
     # same block on two chains and rollover new blocks from second blockchain
     assert added == True
+
+
+def test_block_header():
+    w = Wallet.create()
+    inp = Input('COINBASE',0,w.address,0)
+    inp.sign(w)
+    block = Block([Tx([inp],[Output(w.address, 25, 0)])], 3, 'ab'*32)
+    header = BlockHeader(*block.header)
+    for nonce in (0, 7, 12345, 2**32-1):
+        block_string = '{}{}{}{}{}'.format(block.build_merkel_tree(), block.prev_hash, block.index, nonce, block.timestamp)
+        expected = sha256(sha256(block_string.encode()).hexdigest().encode('utf8')).hexdigest()
+        assert header.digest(nonce).hex() == expected
+        block.nonce = nonce
+        assert block.hash() == expected
+
+    target = target_digest(12)
+    nonce = header.search(target, 0, 2**32)
+    assert int(header.digest(nonce).hex(), 16) <= 2 ** (256-12)
+    assert all(header.digest(n) > target for n in range(nonce))
+
+
+def test_template_refresh():
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 14
+    bc = Blockchain(db, wallet)
+    bc.create_first_block()
+    template = bc.templates.current()
+    assert bc.templates.current() is template
+
+    inp = Input(bc.head.txs[0].hash,0,wallet.address,0)
+    inp.sign(wallet)
+    tx = Tx([inp],[Output(wallet.address, 20, 0)])
+
+    def refresh():
+        # Tx arrives right after mining started
+        if bc.templates.current() is template:
+            bc.add_tx(tx)
+        return bc.templates.current()
+
+    block = bc.mine_block(template, None, refresh)
+    assert block is not template
+    assert bc.head is block
+    assert [el.hash for el in block.txs[1:]] == [tx.hash]
+    assert block.txs[0].outputs[0].amount == db.config['mining_reward'] + 5
+    # template tree was extended in place, root should be the same as built from scratch
+    assert block.merkel_root == MerkleTree([el.hash for el in block.txs]).root
+    assert not bc.mempool
+    assert bc.templates.current().prev_hash == block.hash()
+
+    # template made before the reward change is rejected and nothing of it is applied
+    template = bc.templates.current()
+    utxo = sorted(db.utxo.items())
+    db.config['mining_reward'] = 30
+    assert bc.mine_block(template) is None
+    assert bc.head is block and sorted(db.utxo.items()) == utxo and not bc.staged
+    # with refresh mining goes on with a new template
+    block = bc.mine_block(bc.templates.current(), None, bc.templates.current)
+    assert bc.head is block and block.txs[0].outputs[0].amount == 30
+
+
+def test_rejected_block_txs():
+    wallet = Wallet.create()
+    other = Wallet.create()
+    bc = _node(wallet)
+    db = bc.db
+    bc.create_first_block()
+
+    good = _spend(wallet, bc.head.txs[0], other, 20)
+    assert bc.add_tx(good)
+    # put to the mempool without verification, spends an output which does not exist
+    inp = Input('ff' * 32, 0, other.address, 0)
+    inp.sign(other)
+    bad = Tx([inp], [Output(other.address, 1, 0)])
+    db.transaction_by_hash[bad.hash] = bad.as_dict
+    bc.mempool.add(bad, 10)
+    assert bad.hash in [el.hash for el in bc.templates.current().txs]
+
+    block = _force_blocks(bc, 1)[0]
+    assert block is not None and bc.head.hash() == block.hash()
+    assert [el.hash for el in block.txs[1:]] == [good.hash]
+    assert bad.hash not in bc.mempool and bad.hash not in db.transaction_by_hash
+
+
+def test_chain_lock():
+    wallet = Wallet.create()
+    other = Wallet.create()
+    bc = _node(wallet)
+    db = bc.db
+    bc.create_first_block()
+    coinbase = bc.head.txs[0]
+
+    db.config['difficulty'] = 256
+    stop = threading.Event()
+    mining = threading.Thread(target=bc.force_block, args=(stop.is_set,))
+    mining.start()
+    try:
+        while not bc.stats.hashes:
+            time.sleep(0.01)
+        assert bc.lock.acquire(timeout=5)
+        bc.lock.release()
+        tx = _spend(wallet, coinbase, other, 20)
+        assert bc.add_tx(tx)
+        # template is refreshed while mining, under the lock as well
+        while tx.hash not in [el.hash for el in bc.templates.current().txs]:
+            time.sleep(0.01)
+    finally:
+        stop.set()
+        mining.join()
+    assert bc.head.index == 0
+
+    db.config['difficulty'] = 8
+    spenders = []
+    prev = tx
+    for i in range(20):
+        prev = _spend(other, prev, other, 19 - i)
+        spenders.append(prev)
+
+    def submit():
+        for el in spenders:
+            bc.add_txs([el])
+
+    threads = [threading.Thread(target=submit), threading.Thread(target=_force_blocks, args=(bc, 5))]
+    for el in threads:
+        el.start()
+    for el in threads:
+        el.join()
+    assert bc.head.index == 5 and not bc.staged
+    for el in [tx] + spenders:
+        assert (el.hash in bc.mempool) != (el.hash in db.block_index_by_tx_hash)
+        assert db.transaction_by_hash.get(el.hash)
+
+
+def test_miner_workers():
+    wallet = Wallet.create()
+    db = DB()
+    db.config['difficulty'] = 14
+    miner = Miner(2)
+    try:
+        bc = Blockchain(db, wallet, miner=miner)
+        bc.create_first_block()
+        bc.force_block()
+        assert bc.head.index == 1
+        assert BlockVerifier(db).verify(bc.chain[0], bc.head)
+        # workers report hashes back to the node stats
+        assert bc.stats.hashes > 0
+        assert bc.stats.blocks == 2
+        assert sum(bc.stats.time_to_block['buckets'].values()) == 2
+
+        db.config['difficulty'] = 256
+        bc.force_block(lambda: True)
+        assert bc.head.index == 1
+    finally:
+        miner.stop()
@@ -1,8 +1,11 @@
 import time
+import struct
+from base64 import b64decode, b64encode
+from binascii import hexlify
 from hashlib import sha256
-from merkletools import MerkleTools
 
 from .wallet import Address
+from .merkle import MerkleTree
 
 """
 This module defines the fundamental components of a blockchain: Inputs, Outputs, Transactions (Tx), and Blocks.
@@ -34,46 +37,179 @@ Functions:
     Tx.hash:
         Generates a unique hash for the transaction based on its contents and timestamp.
 
+    Input.encode(), Output.encode(), Tx.encode(), Block.encode():
+        Canonical byte encoding. Integers are fixed size big endian, hashes are 32 raw bytes, addresses and
+        signatures are raw bytes with 2 bytes length prefix. All hashes are double sha256 of these bytes.
+        `decode`/`from_bytes` class methods read objects back from these bytes.
+
+    Block.weight:
+        Size of the encoded block, which is limited by `max_block_weight` of the DB config.
+
     Block.build_merkel_tree():
         Builds a Merkle tree from the transaction hashes within the block to quickly verify the block's contents.
 
+    Block.tx_proof(tx_hash):
+        Returns Merkle inclusion proof of a transaction, so it can be checked against the block header only.
+
+    header_hash(merkel_root, prev_hash, index, nonce, timestamp):
+        Calculates the Proof of Work hash of a block header as hex string.
+
+    target_digest(difficulty):
+        Returns the difficulty target as 32 bytes to compare with raw digests.
+
+    BlockHeader.search(target, start, stop, step):
+        Searches a nonce range reusing sha256 state of the constant header prefix.
+
 Usage:
     These classes are instantiated and manipulated by the blockchain system to record, verify, and process transactions.
+    Input can be signed after creation, but once it is encoded or hashed it can not be changed. Outputs are sealed
+    when Tx is created, Tx is immutable and its bytes and hashes are computed once in the constructor. For a Block
+    only the nonce changes during mining.
 
 Note:
-    The classes depend on external libraries such as `hashlib` for hashing and `merkletools` for Merkle tree generation.
+    The classes depend on `hashlib` for hashing and `merkle.MerkleTree` for Merkle tree generation.
     `wallet.Address` is used to represent cryptocurrency addresses.
 """
 
 
+NULL_HASH = bytes(32)
+
+# fields of a Block which can change after it was created
+MUTABLE_BLOCK_FIELDS = 'nonce', 'merkel_root', '_merkle_tree', '_hash', '_hash_nonce'
+
+# length prefix of every tx in encoded block
+TX_WEIGHT_OVERHEAD = 4
+
+
+def header_hash(merkel_root, prev_hash, index, nonce, timestamp):
+    return BlockHeader(merkel_root, prev_hash, index, timestamp).digest(nonce).hex()
+
+
+def target_digest(difficulty):
+    """
+    Target as 32 bytes big endian, so it can be compared with sha256 digest directly without int conversion.
+    """
+    return min(2 ** (256 - difficulty), 2 ** 256 - 1).to_bytes(32, 'big')
+
+
+class BlockHeader:
+    """
+    Block header prepared for nonce search. Hash string is merkel root, prev hash, index, nonce, timestamp.
+    Everything before the nonce is constant, so it is hashed once and for every nonce only copy of that
+    sha256 state is updated with nonce and timestamp. Result is the same as hashing the whole string.
+    """
+
+    __slots__ = '_midstate', '_tail'
+
+    def __init__(self, merkel_root, prev_hash, index, timestamp):
+        self._midstate = sha256('{}{}{}'.format(merkel_root, prev_hash, index).encode())
+        self._tail = str(timestamp).encode()
+
+    def digest(self, nonce):
+        inner = self._midstate.copy()
+        inner.update(b'%d%b' % (nonce, self._tail))
+        return sha256(hexlify(inner.digest())).digest()
+
+    def search(self, target, start, stop, step=1):
+        '''
+        Returns first nonce in the range with digest not bigger then target, or None
+        '''
+        copy = self._midstate.copy
+        tail = self._tail
+        for nonce in range(start, stop, step):
+            inner = copy()
+            inner.update(b'%d%b' % (nonce, tail))
+            if sha256(hexlify(inner.digest())).digest() <= target:
+                return nonce
+        return None
+
+
+def dsha256(data):
+    return sha256(sha256(data).digest()).hexdigest()
+
+
+def pack_hash(value):
+    '''
+    Hex hash as 32 raw bytes. COINBASE inputs and genesis prev hash are stored as zero hash.
+    '''
+    if value == 'COINBASE' or value == 0 or value == '0':
+        return NULL_HASH
+    return bytes.fromhex(value)
+
+
+def pack_address(address):
+    # address string is base64 of the DER public key, raw key is 25% shorter
+    data = b64decode(str(address))
+    return struct.pack('>H', len(data)) + data
+
+
+def pack_signature(signature):
+    data = bytes.fromhex(signature)
+    return struct.pack('>H', len(data)) + data
+
+
+def unpack_hash(data, offset):
+    raw = data[offset:offset+32]
+    if len(raw) != 32:
+        raise ValueError('Unexpected end of data')
+    return (None if raw == NULL_HASH else raw.hex()), offset + 32
+
+
+def unpack_bytes(data, offset):
+    size, = struct.unpack_from('>H', data, offset)
+    offset += 2
+    if len(data) < offset + size:
+        raise ValueError('Unexpected end of data')
+    return data[offset:offset+size], offset + size
+
+
 class Input:
-    __slots__ = 'prev_tx_hash', 'output_index', 'signature', '_hash', 'address', 'index', 'amount'
+    __slots__ = 'prev_tx_hash', 'output_index', 'signature', '_hash', '_encoded', 'address', 'index', 'amount'
 
-    def __init__(self, prev_tx_hash, output_index, address, index=0):
+    def __init__(self, prev_tx_hash, output_index, address, index=0, signature=None):
         self.prev_tx_hash = prev_tx_hash
         self.output_index = output_index
         self.address = address
         self.index = 0
         self._hash = None
-        self.signature = None
+        self._encoded = None
+        self.signature = signature
         self.amount = None
 
+    def __setattr__(self, name, value):
+        if getattr(self, '_encoded', None) is not None:
+            raise AttributeError('Input can not be changed after it is hashed')
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        # copy and pickle should build a new object instead of setting fields one by one
+        return self.__class__, (self.prev_tx_hash, self.output_index, self.address, self.index, self.signature)
+
     def sign(self, wallet):
         hash_string = '{}{}{}{}'.format(
             self.prev_tx_hash, self.output_index, self.address, self.index
         ).encode()
         self.signature = wallet.sign(hash_string)
 
-    @property
-    def hash(self):
-        if self._hash:
-            return self._hash
+    def encode(self):
+        if self._encoded is not None:
+            return self._encoded
         if not self.signature and self.prev_tx_hash != 'COINBASE':
             raise Exception('Sing the input first')
-        hash_string = '{}{}{}{}'.format(
-            self.prev_tx_hash, self.output_index, self.address, self.signature, self.index
-        )
-        self._hash = sha256(sha256(hash_string.encode()).hexdigest().encode('utf8')).hexdigest()
+        encoded = b''.join((
+            pack_hash(self.prev_tx_hash),
+            struct.pack('>I', self.output_index),
+            pack_address(self.address),
+            struct.pack('>I', self.index),
+            pack_signature(self.signature or ''),
+        ))
+        object.__setattr__(self, '_encoded', encoded)
+        return encoded
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', dsha256(self.encode()))
         return self._hash
 
     @property
@@ -89,37 +225,69 @@ class Input:
 
     @classmethod
     def from_dict(cls, data):
-        inst = cls(
+        return cls(
             data['prev_tx_hash'],
             data['output_index'],
             Address(data['address']),
             data['index'],
+            data['signature'],
+        )
+
+    @classmethod
+    def decode(cls, data, offset=0):
+        '''
+        Reads input from bytes made by encode. Returns input and offset of the next byte.
+        '''
+        prev_tx_hash, offset = unpack_hash(data, offset)
+        output_index, = struct.unpack_from('>I', data, offset)
+        address, offset = unpack_bytes(data, offset + 4)
+        index, = struct.unpack_from('>I', data, offset)
+        signature, offset = unpack_bytes(data, offset + 4)
+        inst = cls(
+            prev_tx_hash or 'COINBASE',
+            output_index,
+            Address(b64encode(address).decode()),
+            index,
+            signature.hex() or None,
         )
-        inst.signature = data['signature']
-        inst._hash = None
-        return inst
+        return inst, offset
         
 
 class Output:
-    __slots__ = '_hash', 'address', 'index', 'amount', 'input_hash'
+    __slots__ = '_hash', '_encoded', 'address', 'index', 'amount', 'input_hash'
 
-    def __init__(self, address, amount, index=0):
+    def __init__(self, address, amount, index=0, input_hash=None):
         self.address = address
         self.index = 0
         self.amount = int(amount)
         # i use input hash here to make output hash unique, especialy for COINBASE tx
-        self.input_hash = None
+        self.input_hash = input_hash
         self._hash = None
+        self._encoded = None
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_hash', None) is not None:
+            raise AttributeError('Output can not be changed after it is hashed')
+        object.__setattr__(self, name, value)
+
+    def __reduce__(self):
+        return self.__class__, (self.address, self.amount, self.index, self.input_hash)
+
+    def encode(self):
+        '''
+        Output bytes as they go into Tx. Input hash is not part of it, as Tx calculates it from its inputs.
+        '''
+        if self._encoded is None:
+            object.__setattr__(self, '_encoded', struct.pack('>QI', self.amount, self.index) + pack_address(self.address))
+        return self._encoded
 
     @property
     def hash(self):
-        if self._hash:
+        if self._hash is not None:
             return self._hash
-   
-        hash_string = '{}{}{}{}'.format(
-            self.amount, self.index, self.address, self.input_hash
-        )
-        self._hash = sha256(sha256(hash_string.encode()).hexdigest().encode('utf8')).hexdigest()
+        if self.input_hash is None:
+            raise Exception('Output is not a part of Tx yet')
+        object.__setattr__(self, '_hash', dsha256(self.encode() + pack_hash(self.input_hash)))
         return self._hash
 
     @property
@@ -134,45 +302,60 @@ class Output:
         
     @classmethod
     def from_dict(cls, data):
-        inst = cls(
+        return cls(
             Address(data['address']),
             data['amount'],
             data['index'],
+            data['input_hash'],
         )
-        inst.input_hash = data['input_hash']
-        inst._hash = None
-        return inst
+
+    @classmethod
+    def decode(cls, data, offset=0):
+        amount, index = struct.unpack_from('>QI', data, offset)
+        address, offset = unpack_bytes(data, offset + 12)
+        return cls(Address(b64encode(address).decode()), amount, index), offset
+
 
 class Tx:
-    __slots__ = 'inputs', 'outputs', 'timestamp', '_hash'
+    __slots__ = 'inputs', 'outputs', 'timestamp', 'input_hash', '_hash', '_encoded'
 
     def __init__(self, inputs, outputs, timestamp=None):   
-        self.inputs = inputs
-        self.outputs = outputs
-        self.timestamp = timestamp or int(time.time())
-        self._hash = None
-
-    @property
-    def hash(self):
-        if self._hash:
-            return self._hash
+        object.__setattr__(self, 'inputs', tuple(inputs))
+        object.__setattr__(self, 'outputs', tuple(outputs))
+        object.__setattr__(self, 'timestamp', timestamp or int(time.time()))
 
-        # calculating input_hash for outputs
-        inp_hash = sha256((str([el.as_dict for el in self.inputs]) + str(self.timestamp)).encode()).hexdigest()
+        # calculating input_hash for outputs, it makes outputs of different Txs unique
+        inputs = b''.join(el.encode() for el in self.inputs)
+        object.__setattr__(self, 'input_hash', sha256(inputs + struct.pack('>Q', self.timestamp)).hexdigest())
         for el in self.outputs:
-            el.input_hash = inp_hash
+            el.input_hash = self.input_hash
+            # hashing seals the output
+            el.hash
 
-        hash_string = '{}{}{}'.format(
-            [el.as_dict for el in self.inputs], [el.as_dict for el in self.outputs], self.timestamp
-        )
-        self._hash = sha256(sha256(hash_string.encode()).hexdigest().encode('utf8')).hexdigest()
+        object.__setattr__(self, '_encoded', b''.join((
+            struct.pack('>H', len(self.inputs)),
+            inputs,
+            struct.pack('>H', len(self.outputs)),
+            b''.join(el.encode() for el in self.outputs),
+            struct.pack('>Q', self.timestamp),
+        )))
+        object.__setattr__(self, '_hash', dsha256(self._encoded))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Tx can not be changed')
+
+    def __reduce__(self):
+        return self.__class__, (self.inputs, self.outputs, self.timestamp)
+
+    def encode(self):
+        return self._encoded
+
+    @property
+    def hash(self):
         return self._hash
 
     @property
     def as_dict(self):
-        inp_hash = sha256((str([el.as_dict for el in self.inputs]) + str(self.timestamp)).encode()).hexdigest()
-        for el in self.outputs:
-            el.input_hash = inp_hash
         return {
             "inputs":[el.as_dict for el in self.inputs],
             "outputs":[el.as_dict for el in self.outputs],
@@ -182,32 +365,58 @@ class Tx:
 
     @classmethod
     def from_dict(cls, data):
-        inps = [Input.from_dict(el) for el in data['inputs']]
-        outs = [Output.from_dict(el) for el in data['outputs']]
-        inp_hash = sha256((str([el.as_dict for el in inps]) + str(data['timestamp'])).encode()).hexdigest()
-        for el in outs:
-            el.input_hash = inp_hash
-            
-        inst = cls(
-            inps,
-            outs,
+        return cls(
+            [Input.from_dict(el) for el in data['inputs']],
+            [Output.from_dict(el) for el in data['outputs']],
             data['timestamp'],
         )
-        inst._hash = None
-        return inst
+
+    @classmethod
+    def decode(cls, data, offset=0):
+        inputs = []
+        outputs = []
+        count, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        for _ in range(count):
+            inp, offset = Input.decode(data, offset)
+            inputs.append(inp)
+        count, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        for _ in range(count):
+            out, offset = Output.decode(data, offset)
+            outputs.append(out)
+        timestamp, = struct.unpack_from('>Q', data, offset)
+        return cls(inputs, outputs, timestamp), offset + 8
+
+    @classmethod
+    def from_bytes(cls, data):
+        tx, offset = cls.decode(data)
+        if offset != len(data):
+            raise ValueError('Extra data after Tx')
+        return tx
 
 
 class Block:
 
-    __slots__ = 'nonce', 'prev_hash', 'index', 'txs', 'timestamp', 'merkel_root'
+    __slots__ = 'nonce', 'prev_hash', 'index', 'txs', 'timestamp', 'merkel_root', '_merkle_tree', '_hash', '_hash_nonce'
 
-    def __init__(self, txs, index, prev_hash, timestamp=None, nonce=0):
-        self.txs = txs or []
+    def __init__(self, txs, index, prev_hash, timestamp=None, nonce=0, merkle_tree=None):
+        self.txs = tuple(txs or ())
         self.prev_hash = prev_hash
         self.index = index
         self.nonce = nonce
         self.timestamp = timestamp or int(time.time())
-        self.merkel_root = None
+        # template builder can pass already built tree of the same txs
+        self._merkle_tree = merkle_tree
+        self.merkel_root = merkle_tree.root if merkle_tree else None
+        self._hash = None
+        self._hash_nonce = None
+
+    def __setattr__(self, name, value):
+        # only nonce is changed by mining, everything else is fixed once block is created
+        if name not in MUTABLE_BLOCK_FIELDS and getattr(self, name, None) is not None:
+            raise AttributeError('Block field %s can not be changed' % name)
+        object.__setattr__(self, name, value)
 
     def build_merkel_tree(self):
         """
@@ -218,20 +427,51 @@ class Block:
         """
         if self.merkel_root:
             return self.merkel_root
-        mt = MerkleTools(hash_type="SHA256")
-        for el in self.txs:
-            mt.add_leaf(el.hash)
-        mt.make_tree()
-        self.merkel_root = mt.get_merkle_root()
+        self.merkel_root = self.merkle_tree.root
         return self.merkel_root
 
+    @property
+    def merkle_tree(self):
+        if self._merkle_tree is None:
+            self._merkle_tree = MerkleTree([el.hash for el in self.txs])
+        return self._merkle_tree
+
+    def tx_proof(self, tx_hash):
+        for i, tx in enumerate(self.txs):
+            if tx.hash == tx_hash:
+                return self.merkle_tree.proof(i)
+        return None
+
+    @property
+    def header(self):
+        """
+        Everything that goes into the block hash except the nonce. Used by miner workers
+        so they dont need the whole block with Txs to search the nonce.
+        """
+        return self.build_merkel_tree(), self.prev_hash, self.index, self.timestamp
+
     def hash(self, nonce=None):
         if nonce:
             self.nonce = nonce
-        block_string = '{}{}{}{}{}'.format(
-            self.build_merkel_tree(), self.prev_hash, self.index, self.nonce, self.timestamp
-        )
-        return sha256(sha256(block_string.encode()).hexdigest().encode('utf8')).hexdigest()
+        if self._hash_nonce != self.nonce:
+            self._hash = header_hash(self.build_merkel_tree(), self.prev_hash, self.index, self.nonce, self.timestamp)
+            self._hash_nonce = self.nonce
+        return self._hash
+
+    @property
+    def weight(self):
+        '''
+        Size of the encoded block in bytes, checked against `max_block_weight`. Every tx adds its size and TX_WEIGHT_OVERHEAD.
+        '''
+        return len(self.encode())
+
+    def encode(self):
+        txs = [el.encode() for el in self.txs]
+        return b''.join([
+            struct.pack('>QQ', self.index, self.timestamp),
+            pack_hash(self.prev_hash),
+            struct.pack('>QI', self.nonce, len(txs)),
+        ] + [struct.pack('>I', len(el)) + el for el in txs])
 
     @property
     def as_dict(self):
@@ -253,4 +493,21 @@ class Block:
             data['prev_hash'],
             data['timestamp'],
             data['nonce']
-        )
\ No newline at end of file
+        )
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = memoryview(data)
+        index, timestamp = struct.unpack_from('>QQ', data, 0)
+        prev_hash, offset = unpack_hash(data, 16)
+        nonce, count = struct.unpack_from('>QI', data, offset)
+        offset += 12
+        txs = []
+        for _ in range(count):
+            size, = struct.unpack_from('>I', data, offset)
+            offset += 4
+            txs.append(Tx.from_bytes(data[offset:offset+size]))
+            offset += size
+        if offset != len(data):
+            raise ValueError('Extra data after Block')
+        return cls(txs, index, prev_hash or 0, timestamp, nonce)
@@ -1,5 +1,8 @@
 import pickle
-from collections import defaultdict
+from collections import ChainMap
+from contextlib import contextmanager
+
+from .utxo import UTXOSet
 
 """
 A simple database emulation class for storing blockchain data. It manages configurations, transactions, 
@@ -7,13 +10,21 @@ and unspent transaction outputs (UTXOs) using in-memory structures. Additionally
 for persisting and restoring the database state.
 
 Attributes:
-    config (dict): Configuration settings for the blockchain, including the number of transactions per block,
-                   mining rewards, and difficulty level.
+    config (dict): Configuration settings for the blockchain, including the maximum block weight (size of the
+                   encoded block in bytes), mining rewards, and difficulty level.
     block_index (int): The current block index in the blockchain.
     transaction_by_hash (dict): A mapping from transaction hashes to transaction data.
-    unspent_txs_by_user_hash (defaultdict(set)): A mapping from user addresses to sets of unspent transaction hashes.
-    unspent_outputs_amount (defaultdict(dict)): A mapping from user addresses to dictionaries mapping output hashes to amounts, 
-                                                representing unspent outputs available for spending.
+    block_index_by_tx_hash (dict): A mapping from confirmed transaction hashes to index of the block holding them.
+    utxo (UTXOSet): Unspent transaction outputs by (transaction hash, output index) with their address and amount,
+                    indexed by address as well.
+    prune_depth (int): Pruning mode when set. Bodies of transactions with all outputs spent are dropped from
+                       `transaction_by_hash` once the block spending the last output is this many blocks deep.
+                       Unspent outputs stay in `utxo`. Blocks deeper than this can not be rolled back.
+    spent_at (dict): Block index -> hashes of transactions whose last unspent output was spent in that block,
+                     kept for pruning only.
+    undo (dict): Block index -> undo record written when the block is committed: outputs it spent with their
+                 address and amount, outputs it created and fee of every non coinbase transaction. Rollback
+                 applies the record and never reads `transaction_by_hash`. Records are pruned with `prune_depth`.
 
 Methods:
     backup(self):
@@ -24,6 +35,32 @@ Methods:
         A class method that deserializes and restores the database state from a file corresponding to the specified block index. 
         Returns an instance of `DB` with the restored state.
 
+    get_unspent(self, tx_hash, output_index):
+        Returns (address, amount) of an unspent output or None. Used by verifiers.
+
+    view(self):
+        Returns a new `UTXOView` on top of this DB.
+
+    prune(self):
+        Drops bodies of fully spent transactions and undo records deeper than `prune_depth`. Called on every
+        block commit.
+
+    undo_block(self, block):
+        Reverts UTXO and transaction block indexes to the state before the block with its undo record.
+        Returns fees of its transactions by hash, so they can go back to unconfirmed.
+
+    transaction(self):
+        Context of one block applied or rolled back. Does nothing here, `sqlite_db.SQLiteDB` commits the
+        changes made inside it as one SQLite transaction.
+
+Classes:
+    UTXOView:
+        Copy-on-write overlay over DB with the same lookups. Block verification applies every transaction to the view
+        right after checking it, so later transactions of the same block can spend its outputs and a double spend
+        inside a block is caught. Nothing touches the DB until `commit`, which writes all changes at once together with
+        the undo record of the block, so a block that fails verification leaves no partial state, the view is just
+        dropped.
+
 Usage:
     This class is intended to be used within a blockchain system to store and manage the state of the blockchain, including 
     transactions and UTXOs. It provides simple methods for persisting the blockchain state across sessions, aiding in 
@@ -50,17 +87,20 @@ class DB:
     """
     Class that just emulates some sort of DB used to save all data
     """
-    def __init__(self):
+    def __init__(self, prune_depth=None):
         self.config = {
-            'txs_per_block': 4,
+            'max_block_weight': 250000,
             'mining_reward': 25,
             'difficulty': 22,
         }
 
         self.block_index = 0
         self.transaction_by_hash = {}
-        self.unspent_txs_by_user_hash = defaultdict(set)
-        self.unspent_outputs_amount = defaultdict(dict)
+        self.block_index_by_tx_hash = {}
+        self.utxo = UTXOSet()
+        self.prune_depth = prune_depth
+        self.spent_at = {}
+        self.undo = {}
 
     '''
         Just simple routine to save/restore db data for block number
@@ -76,4 +116,118 @@ class DB:
 
         inst = cls()
         inst.__dict__ = data
-        return inst
\ No newline at end of file
+        return inst
+
+    def get_unspent(self, tx_hash, output_index):
+        return self.utxo.get(tx_hash, output_index)
+
+    @contextmanager
+    def transaction(self):
+        # in-memory state has nothing to commit, persistent backends apply a block atomically here
+        yield
+
+    def close(self):
+        pass
+
+    def view(self):
+        return UTXOView(self)
+
+    def prune(self):
+        if self.prune_depth is None:
+            return
+        for height in [el for el in self.spent_at if el <= self.block_index - self.prune_depth]:
+            for tx_hash in self.spent_at.pop(height):
+                self.transaction_by_hash.pop(tx_hash, None)
+        for height in [el for el in self.undo if el <= self.block_index - self.prune_depth]:
+            del self.undo[height]
+
+    def undo_block(self, block):
+        undo = self.undo.pop(block.index)
+        self.utxo.spend_many(undo['created'])
+        self.utxo.add_many(undo['spent'])
+        for tx in block.txs:
+            self.block_index_by_tx_hash.pop(tx.hash, None)
+        self.spent_at.pop(block.index, None)
+        self.block_index = block.index - 1
+        return undo['fees']
+
+
+class UTXOView:
+    '''
+    Changes of one block on top of DB. Outputs created and spent inside the view never reach the DB.
+    '''
+
+    __slots__ = 'db', 'config', 'block_index', 'transaction_by_hash', 'block_index_by_tx_hash', 'added', 'spent', 'fees'
+
+    def __init__(self, db):
+        self.db = db
+        self.config = db.config
+        self.block_index = db.block_index
+        # new txs go to the first map, reads fall through to the DB
+        self.transaction_by_hash = ChainMap({}, db.transaction_by_hash)
+        self.block_index_by_tx_hash = {}
+        # (tx hash, output index) -> (address, amount) of outputs created in the view
+        self.added = {}
+        # (tx hash, output index) -> (address, amount) of DB outputs spent in the view
+        self.spent = {}
+        # tx hash -> fee of applied non coinbase txs
+        self.fees = {}
+
+    def get_unspent(self, tx_hash, output_index):
+        key = (tx_hash, output_index)
+        if key in self.added:
+            return self.added[key]
+        if key in self.spent:
+            return None
+        return self.db.get_unspent(tx_hash, output_index)
+
+    def add_txs(self, txs):
+        '''
+        Makes txs visible for output lookups only, their outputs are unspendable until the tx is applied.
+        '''
+        for tx in txs:
+            self.transaction_by_hash.maps[0][tx.hash] = tx.as_dict
+
+    def apply_tx(self, tx, block_index):
+        if tx.hash not in self.transaction_by_hash.maps[0]:
+            self.transaction_by_hash.maps[0][tx.hash] = tx.as_dict
+        self.block_index_by_tx_hash[tx.hash] = block_index
+        amount_in = 0
+        for inp in tx.inputs:
+            if inp.prev_tx_hash == 'COINBASE':
+                continue
+            key = (inp.prev_tx_hash, inp.output_index)
+            if key in self.added:
+                amount_in += self.added.pop(key)[1]
+            else:
+                out = self.db.get_unspent(*key)
+                if out is not None:
+                    self.spent[key] = out
+                    amount_in += out[1]
+        for i, out in enumerate(tx.outputs):
+            self.added[(tx.hash, i)] = (str(out.address), int(out.amount))
+        if tx.inputs[0].prev_tx_hash != 'COINBASE':
+            self.fees[tx.hash] = amount_in - sum(int(out.amount) for out in tx.outputs)
+
+    def apply_block(self, block):
+        for tx in block.txs:
+            self.apply_tx(tx, block.index)
+        self.block_index = block.index
+
+    def commit(self):
+        db = self.db
+        db.transaction_by_hash.update(self.transaction_by_hash.maps[0])
+        db.block_index_by_tx_hash.update(self.block_index_by_tx_hash)
+        db.utxo.add_many([(tx_hash, index, address, amount) for (tx_hash, index), (address, amount) in self.added.items()])
+        db.utxo.spend_many(self.spent)
+        db.block_index = self.block_index
+        db.undo[self.block_index] = {
+            'spent': [key + tuple(out) for key, out in self.spent.items()],
+            'created': list(self.added),
+            'fees': self.fees,
+        }
+        if db.prune_depth is not None:
+            # txs of the block with no outputs left and older txs whose last output the block spent
+            touched = set(self.block_index_by_tx_hash) | {tx_hash for tx_hash, _ in self.spent}
+            db.spent_at[self.block_index] = [el for el in touched if not db.utxo.has_unspent(el)]
+            db.prune()
\ No newline at end of file
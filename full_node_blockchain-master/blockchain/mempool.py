@@ -0,0 +1,488 @@
+import heapq
+import itertools
+import logging
+import os
+import struct
+import time
+
+from .blocks import Tx
+from . import wire
+
+"""
+This module keeps unconfirmed transactions ordered by fee rate, so block templates are built from the best paying
+transactions without sorting the whole pool and the pool stays bounded under spam.
+
+Classes:
+    MempoolEntry:
+        Fee, encoded size, fee rate (fee per byte), time of admission and hashes of transactions whose outputs
+        the transaction spends. Fee, size and count of the package of the transaction with all its unconfirmed
+        ancestors, which a block has to include together with it.
+
+    Mempool:
+        Entries by tx hash with two heaps, package fee rate highest first for block templates and own fee rate
+        lowest first for eviction. Removed and updated entries stay in the heaps until popped and are skipped, so
+        insert and remove are O(log n). Heaps are rebuilt when they hold more stale items than live ones.
+        A tx may spend outputs of other entries, up to `max_ancestors` unconfirmed ancestors. Package of an entry
+        is updated when an ancestor is confirmed or comes back. `select` fills a block size by packages in order
+        of their fee rate, so a high fee child pays for its low fee parent, and puts every tx after its parents.
+        Packages which did not fit get a second chance in place of selected low fee txs.
+        Spends are indexed by parent hash, so children of an unconfirmed parent are found at once, even when the
+        parent comes back to the pool after its child, like on a rollback.
+        Spent outpoints are indexed too, so a tx spending an output already spent in the pool is found in
+        O(inputs). It is rejected unless it replaces the conflicting txs by the fee-bump policy: its fee rate is
+        higher than the fee rate of each of them, it pays at least `min_bump` more than all txs it evicts
+        (conflicting txs and their descendants), evicts no more than `max_replaced` txs and spends none of them.
+        With `min_bump=None` conflicting txs are always rejected.
+        When count or total size is over the limit, entries with the lowest fee rate are evicted together with
+        their descendants. Entries older than `max_age` expire the same way.
+        `version` is bumped on every change and marks the pool for template refresh.
+
+    MempoolView:
+        DB lookups with outputs of mempool txs, so txs spending unconfirmed outputs are verified by the same
+        `TxVerifier`. Whether the output is spent in the pool is left to the conflict index of `Mempool.add`.
+
+Functions:
+    save_mempool(path, records), load_mempool(path):
+        Mempool file of (admission time, tx) records in admission order. Every record is 8 bytes of time followed
+        by the canonical encoding of the tx, records are framed like `wire.join_encoded` after 4 bytes of format
+        version. The file is written under a temporary name and renamed, so a crash leaves the previous one.
+
+Usage:
+    mempool = Mempool(max_count=50000, max_bytes=32 * 2**20)
+    fee = TxVerifier(MempoolView(db, mempool)).verify(tx.inputs, tx.outputs)
+    evicted = mempool.add(tx, fee)
+    mempool.select(max_size=250000, tx_overhead=4)
+    mempool.confirm(tx)
+    expired = mempool.expire()
+
+Note:
+    Mempool keeps only the ordering data, transaction bodies are kept in `DB.transaction_by_hash`. Methods which
+    drop entries return their hashes, so the caller can drop the bodies as well.
+    Loaded records are not trusted, `Blockchain.load_mempool` verifies them again like txs from a peer.
+"""
+
+
+logger = logging.getLogger('Blockchain')
+
+MEMPOOL_FILE_VERSION = 1
+
+
+class MempoolEntry:
+
+    __slots__ = 'tx_hash', 'fee', 'size', 'rate', 'time', 'seq', 'parents', 'outpoints', 'anc_fee', 'anc_size', 'anc_count', 'key'
+
+    def __init__(self, tx_hash, fee, size, parents, outpoints, seq, added=None):
+        self.tx_hash = tx_hash
+        self.fee = fee
+        self.size = size
+        self.rate = fee / size
+        self.time = added if added is not None else time.time()
+        self.seq = seq
+        self.parents = parents
+        self.outpoints = outpoints
+        # package of the tx with its unconfirmed ancestors
+        self.anc_fee = fee
+        self.anc_size = size
+        self.anc_count = 1
+        # sequence of the current item in the package heap
+        self.key = None
+
+
+class Mempool:
+
+    __slots__ = (
+        'max_count', 'max_bytes', 'max_age', 'min_bump', 'max_replaced', 'max_ancestors', 'entries', 'size', 'version',
+        '_high', '_low', '_spenders', '_spent', '_seq'
+    )
+
+    def __init__(self, max_count=50000, max_bytes=32 * 2**20, max_age=3 * 24 * 3600, min_bump=1, max_replaced=100, max_ancestors=25):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_bump = min_bump
+        self.max_replaced = max_replaced
+        self.max_ancestors = max_ancestors
+        # insertion ordered, so the oldest entries go first
+        self.entries = {}
+        self.size = 0
+        self.version = 0
+        # (-package rate, key, hash) and (rate, -seq, hash), newer entry goes first on the same rate
+        self._high = []
+        self._low = []
+        # parent tx hash -> hashes of entries spending its outputs
+        self._spenders = {}
+        # (tx hash, output index) -> hash of the entry spending it
+        self._spent = {}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def items(self):
+        '''
+        (fee, tx hash) of all entries.
+        '''
+        return {(el.fee, el.tx_hash) for el in self.entries.values()}
+
+    def fee(self, tx_hash):
+        return self.entries[tx_hash].fee
+
+    def _live(self, item):
+        entry = self.entries.get(item[2])
+        if entry is None or entry.seq != -item[1]:
+            return None
+        return entry
+
+    def _current(self, item):
+        entry = self.entries.get(item[2])
+        if entry is None or entry.key != item[1]:
+            return None
+        return entry
+
+    def _push(self, entry):
+        entry.key = next(self._seq)
+        heapq.heappush(self._high, (-entry.anc_fee / entry.anc_size, entry.key, entry.tx_hash))
+        if len(self._high) > 2 * len(self.entries) + 64:
+            self._compact()
+
+    def ancestors(self, parents):
+        '''
+        Hashes of entries among the parents and their ancestors in the pool.
+        '''
+        res = []
+        queue = [el for el in parents if el in self.entries]
+        seen = set(queue)
+        while queue:
+            tx_hash = queue.pop()
+            res.append(tx_hash)
+            for parent in self.entries[tx_hash].parents:
+                if parent in self.entries and parent not in seen:
+                    seen.add(parent)
+                    queue.append(parent)
+        return res
+
+    def _update_package(self, entry):
+        ancestors = [self.entries[el] for el in self.ancestors(entry.parents)]
+        entry.anc_fee = entry.fee + sum(el.fee for el in ancestors)
+        entry.anc_size = entry.size + sum(el.size for el in ancestors)
+        entry.anc_count = 1 + len(ancestors)
+        self._push(entry)
+
+    def conflicts(self, tx):
+        '''
+        Hashes of entries spending any output the tx spends.
+        '''
+        res = []
+        for inp in tx.inputs:
+            spender = self._spent.get((inp.prev_tx_hash, inp.output_index))
+            if spender is not None and spender != tx.hash and spender not in res:
+                res.append(spender)
+        return res
+
+    def check_replacement(self, entry, conflicts):
+        '''
+        Raises if the entry may not replace conflicting entries. Returns hashes it would evict.
+        '''
+        if self.min_bump is None:
+            raise Exception('Output already spent by unconfirmed transaction %s.' % conflicts[0])
+        replaced = []
+        for tx_hash in conflicts:
+            replaced += [el for el in [tx_hash] + self.descendants(tx_hash) if el not in replaced]
+        if len(replaced) > self.max_replaced:
+            raise Exception('Replacement evicts too many transactions.')
+        if any(el in replaced for el in entry.parents):
+            raise Exception('Replacement spends transaction it replaces.')
+        if any(entry.rate <= self.entries[el].rate for el in conflicts):
+            raise Exception('Replacement fee rate too low.')
+        if entry.fee < sum(self.entries[el].fee for el in replaced) + self.min_bump:
+            raise Exception('Replacement fee too low.')
+        return replaced
+
+    def add(self, tx, fee, added=None, force=False):
+        '''
+        Adds tx and evicts entries over the limits. Returns evicted hashes, the tx itself can be among them.
+        Conflicting entries are replaced if the tx passes the fee-bump policy, otherwise it raises. With force
+        they are replaced anyway, used for txs of rolled back blocks, which were valid in the chain.
+        '''
+        if tx.hash in self.entries:
+            return []
+        parents = tuple({inp.prev_tx_hash for inp in tx.inputs if inp.prev_tx_hash != 'COINBASE'})
+        outpoints = tuple((inp.prev_tx_hash, inp.output_index) for inp in tx.inputs if inp.prev_tx_hash != 'COINBASE')
+        entry = MempoolEntry(tx.hash, fee, len(tx.encode()), parents, outpoints, next(self._seq), added)
+        if not force and len(self.ancestors(parents)) >= self.max_ancestors:
+            raise Exception('Too many unconfirmed ancestors.')
+        conflicts = self.conflicts(tx)
+        res = []
+        if conflicts:
+            if not force:
+                self.check_replacement(entry, conflicts)
+            for tx_hash in conflicts:
+                res += self.evict(tx_hash)
+        self.entries[tx.hash] = entry
+        self.size += entry.size
+        for parent in parents:
+            self._spenders.setdefault(parent, set()).add(tx.hash)
+        for outpoint in outpoints:
+            self._spent[outpoint] = tx.hash
+        self._update_package(entry)
+        heapq.heappush(self._low, (entry.rate, -entry.seq, tx.hash))
+        # children already in the pool, when a parent comes back on rollback
+        for child in self.descendants(tx.hash):
+            self._update_package(self.entries[child])
+        self.version += 1
+        return res + self._trim()
+
+    def remove(self, tx_hash):
+        '''
+        Removes the entry only, used for confirmed txs, whose children stay valid.
+        '''
+        if tx_hash not in self.entries:
+            return False
+        descendants = self.descendants(tx_hash)
+        entry = self.entries.pop(tx_hash)
+        self.size -= entry.size
+        for child in descendants:
+            child = self.entries[child]
+            child.anc_fee -= entry.fee
+            child.anc_size -= entry.size
+            child.anc_count -= 1
+            self._push(child)
+        for parent in entry.parents:
+            spenders = self._spenders.get(parent)
+            if spenders is not None:
+                spenders.discard(tx_hash)
+                if not spenders:
+                    del self._spenders[parent]
+        for outpoint in entry.outpoints:
+            if self._spent.get(outpoint) == tx_hash:
+                del self._spent[outpoint]
+        self.version += 1
+        if len(self._high) > 2 * len(self.entries) + 64:
+            self._compact()
+        return True
+
+    def confirm(self, tx):
+        '''
+        Removes tx confirmed by a block and evicts entries spending the same outputs with their descendants,
+        they can never be valid. Returns evicted hashes, the tx itself is not among them.
+        '''
+        if self.remove(tx.hash):
+            return []
+        res = []
+        for tx_hash in self.conflicts(tx):
+            res += self.evict(tx_hash)
+        return res
+
+    def descendants(self, tx_hash):
+        res = []
+        queue = [tx_hash]
+        seen = {tx_hash}
+        while queue:
+            for child in self._spenders.get(queue.pop(), ()):
+                if child not in seen:
+                    seen.add(child)
+                    res.append(child)
+                    queue.append(child)
+        return res
+
+    def evict(self, tx_hash):
+        '''
+        Removes the entry with all its descendants, which can not be valid without it. Returns removed hashes.
+        '''
+        # children go first, so removals rarely update packages of entries about to go
+        res = [el for el in reversed([tx_hash] + self.descendants(tx_hash)) if self.remove(el)]
+        res.reverse()
+        return res
+
+    def _trim(self):
+        res = []
+        while self.entries and (len(self.entries) > self.max_count or self.size > self.max_bytes):
+            item = heapq.heappop(self._low)
+            if self._live(item) is not None:
+                res += self.evict(item[2])
+        return res
+
+    def expire(self, now=None):
+        '''
+        Evicts entries older than `max_age` with their descendants. Returns evicted hashes.
+        '''
+        deadline = (now if now is not None else time.time()) - self.max_age
+        res = []
+        for tx_hash in [k for k, v in itertools.takewhile(lambda el: el[1].time < deadline, self.entries.items())]:
+            if tx_hash in self.entries:
+                res += self.evict(tx_hash)
+        return res
+
+    def _compact(self):
+        self._high = [el for el in self._high if self._current(el) is not None]
+        self._low = [el for el in self._low if self._live(el) is not None]
+        heapq.heapify(self._high)
+        heapq.heapify(self._low)
+
+    def select(self, max_size, tx_overhead=0, max_failures=1000, max_refine=50):
+        '''
+        (fee, tx hash) of txs fitting max_size, where every tx takes its size and tx_overhead, every tx after its
+        parents. Greedy first: packages of a tx with its unconfirmed ancestors by their fee rate, the highest first,
+        walking the heap from the top without popping. Txs whose ancestors are taken already compete with the rate
+        of the rest of their package, kept in a separate heap. Packages which do not fit are skipped, the walk stops
+        after max_failures of them in a row. Then up to max_refine skipped packages with the biggest fee try to
+        replace selected txs without selected children, lowest fee rate first, if the block gets more fees.
+        '''
+        heap = self._high
+        selected = []
+        chosen = set()
+        used = 0
+        # tx hash -> (fee, size, key) of the package without chosen ancestors
+        modified = {}
+        modified_heap = []
+        keys = itertools.count()
+        skipped = []
+        failures = 0
+        frontier = [(heap[0], 0)] if heap else []
+        while (frontier or modified_heap) and failures < max_failures:
+            if modified_heap and (not frontier or modified_heap[0] < frontier[0][0]):
+                item = heapq.heappop(modified_heap)
+                if item[2] in chosen or modified[item[2]][2] != item[1]:
+                    continue
+                entry = self.entries[item[2]]
+            else:
+                item, i = heapq.heappop(frontier)
+                for child in (2 * i + 1, 2 * i + 2):
+                    if child < len(heap):
+                        heapq.heappush(frontier, (heap[child], child))
+                entry = self._current(item)
+                if entry is None or entry.tx_hash in chosen or entry.tx_hash in modified:
+                    continue
+            package = self._package(entry, chosen)
+            size = sum(el.size + tx_overhead for el in package)
+            if used + size > max_size:
+                skipped.append(entry)
+                failures += 1
+                continue
+            failures = 0
+            used += size
+            self._take(package, selected, chosen)
+            for el in package:
+                for child in self.descendants(el.tx_hash):
+                    if child in chosen:
+                        continue
+                    child_entry = self.entries[child]
+                    child_fee, child_size, _ = modified.get(child, (child_entry.anc_fee, child_entry.anc_size, None))
+                    key = next(keys)
+                    modified[child] = (child_fee - el.fee, child_size - el.size, key)
+                    heapq.heappush(modified_heap, (-(child_fee - el.fee) / (child_size - el.size), key, child))
+
+        skipped.sort(key=lambda el: el.anc_fee, reverse=True)
+        # selected txs without selected children, lowest fee rate first, built again after every replacement
+        leaves = None
+        for entry in skipped[:max_refine]:
+            if entry.tx_hash in chosen:
+                continue
+            package = self._package(entry, chosen)
+            size = sum(el.size + tx_overhead for el in package)
+            need = used + size - max_size
+            if size > max_size:
+                continue
+            drop = []
+            if need > 0:
+                if leaves is None:
+                    leaves = [el for el in selected if not any(child in chosen for child in self._spenders.get(el.tx_hash, ()))]
+                    leaves.sort(key=lambda el: el.rate)
+                ancestors = set(self.ancestors(entry.parents))
+                freed = 0
+                for leaf in leaves:
+                    if freed >= need:
+                        break
+                    if leaf.tx_hash not in ancestors:
+                        drop.append(leaf)
+                        freed += leaf.size + tx_overhead
+                if freed < need or sum(el.fee for el in drop) >= sum(el.fee for el in package):
+                    continue
+                dropped = {el.tx_hash for el in drop}
+                selected = [el for el in selected if el.tx_hash not in dropped]
+                chosen -= dropped
+                used -= freed
+            used += size
+            self._take(package, selected, chosen)
+            leaves = None
+        return [(el.fee, el.tx_hash) for el in selected]
+
+    def _package(self, entry, chosen):
+        '''
+        Entry with its ancestors which are not chosen yet, parents first.
+        '''
+        package = [self.entries[el] for el in self.ancestors(entry.parents) if el not in chosen] + [entry]
+        # an ancestor always has fewer ancestors than its descendant
+        package.sort(key=lambda el: el.anc_count)
+        return package
+
+    def _take(self, package, selected, chosen):
+        for el in package:
+            selected.append(el)
+            chosen.add(el.tx_hash)
+
+
+class MempoolView:
+
+    __slots__ = 'db', 'mempool'
+
+    def __init__(self, db, mempool):
+        self.db = db
+        self.mempool = mempool
+
+    @property
+    def config(self):
+        return self.db.config
+
+    @property
+    def block_index(self):
+        return self.db.block_index
+
+    @property
+    def transaction_by_hash(self):
+        return self.db.transaction_by_hash
+
+    def get_unspent(self, tx_hash, output_index):
+        out = self.db.get_unspent(tx_hash, output_index)
+        if out is not None or tx_hash not in self.mempool:
+            return out
+        outputs = self.db.transaction_by_hash[tx_hash]['outputs']
+        if not 0 <= output_index < len(outputs):
+            return None
+        return str(outputs[output_index]['address']), int(outputs[output_index]['amount'])
+
+
+def save_mempool(path, records):
+    data = struct.pack('>I', MEMPOOL_FILE_VERSION) + wire.join_encoded(
+        [struct.pack('>d', added) + tx.encode() for added, tx in records]
+    )
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def load_mempool(path):
+    '''
+    Returns (admission time, tx) records of the file, empty list if there is no file or it can not be read.
+    '''
+    if not os.path.exists(path):
+        return []
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    try:
+        version, = struct.unpack_from('>I', data, 0)
+        if version != MEMPOOL_FILE_VERSION:
+            raise ValueError('Unknown mempool file version %s' % version)
+        records = wire.split_encoded(memoryview(data)[4:])
+        return [(struct.unpack_from('>d', el, 0)[0], Tx.from_bytes(el[8:])) for el in records]
+    except Exception as e:
+        logger.error('Mempool file %s skipped: %s' % (path, e))
+        return []
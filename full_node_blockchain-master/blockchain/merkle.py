@@ -0,0 +1,101 @@
+from hashlib import sha256
+
+"""
+This module implements the Merkle tree used to summarize transactions of a block.
+
+Classes:
+    MerkleTree:
+        Keeps all levels of the tree, leaves first. Leaves are transaction hashes in hex. Pairs of nodes are joined
+        as raw bytes and hashed with single sha256, odd node at the end of a level goes up as is. The layout is
+        the same as `merkletools` had, so roots did not change when it was replaced.
+        Appending or replacing a leaf recalculates only the path to the root, which is O(log n), so block
+        templates can take new transactions without rehashing the whole tree.
+
+Functions:
+    verify_proof(leaf, proof, root):
+        Checks an inclusion proof made by `MerkleTree.proof`. Used by light clients, which have only block headers.
+
+Usage:
+    tree = MerkleTree([tx.hash for tx in txs])
+    tree.append(new_tx.hash)
+    root = tree.root
+    proof = tree.proof(1)
+    verify_proof(txs[1].hash, proof, root)
+"""
+
+
+def _join(left, right):
+    return sha256(left + right).digest()
+
+
+class MerkleTree:
+
+    __slots__ = 'levels'
+
+    def __init__(self, leaves=()):
+        level = [bytes.fromhex(el) for el in leaves]
+        self.levels = [level]
+        while len(level) > 1:
+            level = [_join(level[i], level[i+1]) for i in range(0, len(level) - 1, 2)] + level[len(level) - len(level) % 2:]
+            self.levels.append(level)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    @property
+    def root(self):
+        if not self.levels[0]:
+            return None
+        return self.levels[-1][0].hex()
+
+    def copy(self):
+        inst = self.__class__()
+        inst.levels = [list(el) for el in self.levels]
+        return inst
+
+    def append(self, leaf):
+        self.levels[0].append(bytes.fromhex(leaf))
+        self._update_path(len(self.levels[0]) - 1)
+
+    def update(self, index, leaf):
+        self.levels[0][index] = bytes.fromhex(leaf)
+        self._update_path(index)
+
+    def _update_path(self, index):
+        level = 0
+        while len(self.levels[level]) > 1:
+            nodes = self.levels[level]
+            parent = index // 2
+            left = parent * 2
+            value = _join(nodes[left], nodes[left+1]) if left + 1 < len(nodes) else nodes[left]
+            if level + 1 == len(self.levels):
+                self.levels.append([])
+            upper = self.levels[level+1]
+            if parent < len(upper):
+                upper[parent] = value
+            else:
+                upper.append(value)
+            index = parent
+            level += 1
+
+    def proof(self, index):
+        '''
+        List of sibling hashes from leaf to the root. Each item tells from which side sibling joins.
+        '''
+        res = []
+        for nodes in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling < len(nodes):
+                res.append({'left' if sibling < index else 'right': nodes[sibling].hex()})
+            index //= 2
+        return res
+
+
+def verify_proof(leaf, proof, root):
+    value = bytes.fromhex(leaf)
+    for step in proof:
+        if 'left' in step:
+            value = _join(bytes.fromhex(step['left']), value)
+        else:
+            value = _join(value, bytes.fromhex(step['right']))
+    return value.hex() == root
@@ -0,0 +1,173 @@
+import logging
+import multiprocessing
+import queue
+
+from .blocks import BlockHeader
+
+"""
+This module provides a multi-process Proof of Work engine. The nonce space of a block is split between a pool
+of worker processes, so mining uses all cores of the host and does not fight the node event loop for the GIL.
+
+Classes:
+    Miner:
+        Owns the pool of worker processes. Each mining job sends only the block header (merkel root, previous hash,
+        index and timestamp) to the workers. Worker `i` of `n` checks nonces `i, i+n, i+2n, ...` so the ranges never
+        overlap. As soon as one worker finds a valid nonce, or the stop callback fires, all workers drop the job.
+        When the block template changes workers get the new header in place, the processes keep running.
+
+Functions:
+    search_nonce(header, target, start, stop, step=1, check_stop=None, progress=None):
+        Walks a strided nonce range of a `BlockHeader` in chunks and returns the first nonce with digest under
+        the target, or None if the range is exhausted or `check_stop` fired. `progress` gets number of hashes
+        done after every chunk. Used by workers and by the single thread mining in `Blockchain`.
+
+Usage:
+    miner = Miner(workers=4)
+    miner.start()
+    bc = Blockchain(db, wallet, miner=miner)
+    ...
+    miner.stop()
+
+Note:
+    Workers check the shared job counter every `CHECK_EVERY` nonces, so stopping costs at most that many
+    hashes per worker. Processes are daemonic and die together with the node.
+"""
+
+
+logger = logging.getLogger('Blockchain')
+
+# how many nonces worker checks before looking if the job is still actual
+CHECK_EVERY = 4096
+
+# job id used when workers should stay idle
+IDLE = 0
+
+
+def search_nonce(header, target, start, stop, step=1, check_stop=None, progress=None):
+    chunk = step * CHECK_EVERY
+    for chunk_start in range(start, stop, chunk):
+        if check_stop and check_stop():
+            return None
+        chunk_stop = min(chunk_start + chunk, stop)
+        nonce = header.search(target, chunk_start, chunk_stop, step)
+        if progress:
+            progress(len(range(chunk_start, chunk_stop if nonce is None else nonce + 1, step)))
+        if nonce is not None:
+            return nonce
+    return None
+
+
+def _worker(index, jobs, results, current_job, hashes):
+    def progress(count):
+        hashes[index] += count
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, header, target, start, stop, step = job
+        nonce = search_nonce(
+            BlockHeader(*header), target, start, stop, step, lambda: current_job.value != job_id, progress
+        )
+        results.put((job_id, nonce))
+
+
+class Miner:
+
+    __slots__ = 'workers', '_processes', '_jobs', '_results', '_current_job', '_job_id', '_hashes', '_reported'
+
+    def __init__(self, workers=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self._processes = []
+        self._jobs = []
+        self._results = None
+        self._current_job = None
+        self._job_id = IDLE
+        self._hashes = None
+        self._reported = 0
+
+    def start(self):
+        if self._processes:
+            return
+        ctx = multiprocessing.get_context()
+        # only main process writes the job id, workers just poll it
+        self._current_job = ctx.Value('Q', IDLE, lock=False)
+        self._results = ctx.Queue()
+        # hash counter per worker, so workers never write the same value
+        self._hashes = ctx.Array('Q', self.workers, lock=False)
+        self._reported = 0
+        for i in range(self.workers):
+            jobs = ctx.Queue()
+            p = ctx.Process(target=_worker, args=(i, jobs, self._results, self._current_job, self._hashes), daemon=True)
+            p.start()
+            self._jobs.append(jobs)
+            self._processes.append(p)
+        logger.info('Miner started with %s workers' % self.workers)
+
+    def stop(self):
+        if not self._processes:
+            return
+        self._current_job.value = IDLE
+        for jobs in self._jobs:
+            jobs.put(None)
+        for p in self._processes:
+            p.join(timeout=1)
+            if p.is_alive():
+                p.terminate()
+        self._processes = []
+        self._jobs = []
+        logger.info('Miner stopped')
+
+    def mine(self, block, target, max_nonce, check_stop=None, refresh=None, progress=None):
+        '''
+        Search nonce for the block on all workers. Returns block with found nonce, or None if stopped.
+        With refresh callback workers are switched to the new template in place once it returns another block.
+        Progress callback gets number of hashes done by all workers since previous call.
+        '''
+        self.start()
+        job_id = self._submit(block, target, max_nonce)
+        exhausted = 0
+        try:
+            while exhausted < self.workers:
+                if progress:
+                    self._report(progress)
+                if check_stop and check_stop():
+                    logger.error('Mining interrupted.')
+                    return None
+                if refresh and refresh() is not block:
+                    block = refresh()
+                    job_id = self._submit(block, target, max_nonce)
+                    exhausted = 0
+                try:
+                    res_job, nonce = self._results.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                # result of some old job, which was interrupted
+                if res_job != job_id:
+                    continue
+                if nonce is None:
+                    exhausted += 1
+                    continue
+                block.nonce = nonce
+                return block
+            logger.error('Nonce range exhausted.')
+            return None
+        finally:
+            self._current_job.value = IDLE
+            if progress:
+                self._report(progress)
+
+    def _report(self, progress):
+        total = sum(self._hashes)
+        if total != self._reported:
+            progress(total - self._reported)
+            self._reported = total
+
+    def _submit(self, block, target, max_nonce):
+        # new job id makes workers drop whatever they search now and take the next job
+        self._job_id += 1
+        self._current_job.value = self._job_id
+        header = block.header
+        for i, jobs in enumerate(self._jobs):
+            jobs.put((self._job_id, header, target, i, max_nonce, self.workers))
+        return self._job_id
@@ -0,0 +1,78 @@
+import logging
+import os
+import pickle
+
+from .db import DB
+
+"""
+This module saves the in-memory DB state to local snapshot files, so a restarted node loads the state at once and
+replays only the blocks stored in the block log after the snapshot.
+
+Classes:
+    Snapshots:
+        Directory of state snapshots named after the height of the block they end with. A snapshot holds the DB
+        state of confirmed transactions only, unconfirmed ones are left out, and the hash of its head block.
+        Files are written under a temporary name and renamed, so a crash never leaves a partial snapshot. Only
+        the last `keep` snapshots are kept.
+        `load` takes the newest snapshot whose head block is in the block log at the same height. A snapshot
+        ahead of the log, after a torn append or a rollback, is skipped, and an older one is tried.
+
+Usage:
+    snapshots = Snapshots('data/snapshots')
+    db = snapshots.load(log) or DB()
+    bc = Blockchain(db, wallet, storage=log)
+    bc.replay_storage()
+    ...
+    snapshots.save(bc.db, bc.head)
+
+Note:
+    Snapshots use `pickle` like `DB.backup`, never load them from an untrusted source. The block log is synced
+    before a snapshot is written, so every snapshot points to blocks which are on disk.
+"""
+
+
+logger = logging.getLogger('Blockchain')
+
+
+class Snapshots:
+
+    __slots__ = 'path', 'keep'
+
+    def __init__(self, path, keep=2):
+        self.path = path
+        self.keep = keep
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, height):
+        return os.path.join(self.path, 'state_%010d' % height)
+
+    def heights(self):
+        return sorted(int(el[6:]) for el in os.listdir(self.path) if el.startswith('state_') and el[6:].isdigit())
+
+    def save(self, db, head):
+        confirmed = db.block_index_by_tx_hash
+        state = dict(db.__dict__)
+        state['transaction_by_hash'] = {k: v for k, v in db.transaction_by_hash.items() if k in confirmed}
+        path = self._file(head.index)
+        with open(path + '.tmp', 'wb') as fp:
+            pickle.dump({'head': head.hash(), 'state': state}, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + '.tmp', path)
+        for height in self.heights()[:-self.keep]:
+            os.remove(self._file(height))
+
+    def load(self, log):
+        '''
+        Returns DB restored from the newest snapshot matching the block log or None.
+        '''
+        for height in reversed(self.heights()):
+            with open(self._file(height), 'rb') as fp:
+                data = pickle.load(fp)
+            if log.height_of(data['head']) != height:
+                logger.error('Snapshot at #%s does not match block log, skipped' % height)
+                continue
+            db = DB()
+            db.__dict__.update(data['state'])
+            return db
+        return None
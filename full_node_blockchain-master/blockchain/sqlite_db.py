@@ -0,0 +1,318 @@
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+from .blocks import Block
+from .db import DB
+from . import wire
+
+"""
+This module provides a DB backend on top of SQLite, so the node state survives a restart or a crash without
+syncing the chain again.
+
+Classes:
+    SQLiteDB:
+        Same interface as the in-memory `DB`. Transactions, block index of transactions, UTXOs with the address
+        index and blocks are kept in SQLite tables, the database runs in WAL mode. `transaction` context wraps
+        `rollover_block` and `rollback_block`, so every block is applied or reverted in one SQLite transaction.
+        Unconfirmed transactions stored outside of it stay in memory and reach the disk only with their block.
+        `backup` copies the database to `block_<index>.sqlite` with the SQLite online backup, like `DB.backup`.
+
+    SQLiteMapping:
+        Dict-like table of JSON values, used for `transaction_by_hash`, `block_index_by_tx_hash` and block undo
+        records by height.
+        `update` writes all items with one prepared statement.
+
+    SQLiteUTXOSet:
+        Same interface as `utxo.UTXOSet`. Outpoint is the primary key of the table, addresses are stored once and
+        referenced by id, an index on address id serves balance lookups. `add_many` and `spend_many` run
+        batches of one prepared statement.
+
+    SQLiteBlockStore:
+        Same interface as `storage.BlockLog` over a table of encoded blocks by height, so `ChainWindow` can keep
+        only recent blocks in memory and sync is served from stored bytes.
+
+Usage:
+    db = SQLiteDB('data/chain.sqlite')
+    bc = Blockchain(db, wallet, storage=db.blocks)
+    bc.replay_storage()
+    ...
+    db.close()
+
+Note:
+    Connection is shared by the node threads, all statements are serialized by a lock. Blocks are written as
+    soon as they are accepted, before their state is committed. `Blockchain.replay_storage` applies blocks
+    which are stored but have no committed state after a crash. The block transaction belongs to the thread which
+    opened it, writes of other threads are never part of it.
+"""
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS blocks (height INTEGER PRIMARY KEY, hash TEXT UNIQUE, data BLOB);
+CREATE TABLE IF NOT EXISTS transactions (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tx_blocks (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS undo (key INTEGER PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS addresses (id INTEGER PRIMARY KEY, address TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS utxos (
+    tx_hash BLOB, output_index INTEGER, address_id INTEGER, amount INTEGER,
+    PRIMARY KEY (tx_hash, output_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS utxos_by_address ON utxos (address_id);
+'''
+
+
+class SQLiteMapping(MutableMapping):
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        # writes outside of block transaction, like unconfirmed txs, are not persisted
+        self.pending = {}
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        row = self.db.execute('SELECT value FROM %s WHERE key = ?' % self.table, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __contains__(self, key):
+        if key in self.pending:
+            return True
+        return self.db.execute('SELECT 1 FROM %s WHERE key = ?' % self.table, (key,)).fetchone() is not None
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def update(self, items):
+        # checked under the lock, a transaction of another thread can not start or end in between
+        with self.db.lock:
+            if not self.db.in_transaction:
+                self.pending.update(items)
+                return
+            items = dict(items)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)' % self.table,
+                [(k, json.dumps(v)) for k, v in items.items()]
+            )
+            for key in items:
+                self.pending.pop(key, None)
+
+    def __delitem__(self, key):
+        with self.db.lock:
+            if key in self.pending:
+                del self.pending[key]
+                return
+            if not self.db.execute('DELETE FROM %s WHERE key = ?' % self.table, (key,)).rowcount:
+                raise KeyError(key)
+
+    def __iter__(self):
+        yield from list(self.pending)
+        for row in self.db.execute('SELECT key FROM %s' % self.table).fetchall():
+            if row[0] not in self.pending:
+                yield row[0]
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return bool(self.pending) or self.db.execute('SELECT 1 FROM %s LIMIT 1' % self.table).fetchone() is not None
+
+
+class SQLiteUTXOSet:
+
+    __slots__ = 'db'
+
+    def __init__(self, db):
+        self.db = db
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM utxos').fetchone()[0]
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+    def add(self, tx_hash, index, address, amount, size=1):
+        self.add_many([(tx_hash, index, address, amount)])
+
+    def add_many(self, outputs):
+        outputs = [(bytes.fromhex(tx_hash), index, str(address), amount) for tx_hash, index, address, amount in outputs]
+        self.db.executemany('INSERT OR IGNORE INTO addresses (address) VALUES (?)', [(el[2],) for el in outputs])
+        self.db.executemany(
+            'INSERT OR REPLACE INTO utxos (tx_hash, output_index, address_id, amount) '
+            'VALUES (?, ?, (SELECT id FROM addresses WHERE address = ?), ?)',
+            outputs
+        )
+
+    def has_unspent(self, tx_hash):
+        return self.db.execute('SELECT 1 FROM utxos WHERE tx_hash = ? LIMIT 1', (bytes.fromhex(tx_hash),)).fetchone() is not None
+
+    def get(self, tx_hash, index):
+        row = self.db.execute(
+            'SELECT address, amount FROM utxos JOIN addresses ON addresses.id = address_id '
+            'WHERE tx_hash = ? AND output_index = ?',
+            (bytes.fromhex(tx_hash), index)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def spend(self, tx_hash, index):
+        with self.db.lock:
+            res = self.get(tx_hash, index)
+            if res is None:
+                raise KeyError((tx_hash, index))
+            self.spend_many([(tx_hash, index)])
+            return res
+
+    def spend_many(self, outpoints):
+        self.db.executemany(
+            'DELETE FROM utxos WHERE tx_hash = ? AND output_index = ?',
+            [(bytes.fromhex(tx_hash), index) for tx_hash, index in outpoints]
+        )
+
+    def by_address(self, address):
+        rows = self.db.execute(
+            'SELECT tx_hash, output_index, amount FROM utxos '
+            'WHERE address_id = (SELECT id FROM addresses WHERE address = ?)',
+            (str(address),)
+        ).fetchall()
+        return [(tx_hash.hex(), index, amount) for tx_hash, index, amount in rows]
+
+    def balance(self, address):
+        return self.db.execute(
+            'SELECT COALESCE(SUM(amount), 0) FROM utxos WHERE address_id = (SELECT id FROM addresses WHERE address = ?)',
+            (str(address),)
+        ).fetchone()[0]
+
+    def items(self):
+        rows = self.db.execute(
+            'SELECT tx_hash, output_index, address, amount FROM utxos JOIN addresses ON addresses.id = address_id'
+        ).fetchall()
+        for tx_hash, index, address, amount in rows:
+            yield tx_hash.hex(), index, address, amount
+
+
+class SQLiteBlockStore:
+
+    __slots__ = 'db'
+
+    def __init__(self, db):
+        self.db = db
+
+    def __len__(self):
+        # heights go from 0 without gaps, max of the primary key is one index lookup unlike COUNT(*)
+        return self.db.execute('SELECT COALESCE(MAX(height) + 1, 0) FROM blocks').fetchone()[0]
+
+    def append(self, block):
+        self.db.execute(
+            'INSERT INTO blocks (height, hash, data) VALUES (?, ?, ?)', (len(self), block.hash(), block.encode())
+        )
+
+    def read_raw(self, height):
+        row = self.db.execute('SELECT data FROM blocks WHERE height = ?', (height,)).fetchone()
+        if row is None:
+            raise IndexError(height)
+        return row[0]
+
+    def read(self, height):
+        return Block.from_bytes(self.read_raw(height))
+
+    def read_records(self, start, stop):
+        rows = self.db.execute(
+            'SELECT data FROM blocks WHERE height >= ? AND height < ? ORDER BY height', (start, stop)
+        ).fetchall()
+        return b''.join([wire.frame(row[0]) for row in rows])
+
+    def height_of(self, block_hash):
+        row = self.db.execute('SELECT height FROM blocks WHERE hash = ?', (block_hash,)).fetchone()
+        return row[0] if row else None
+
+    def truncate(self, height):
+        self.db.execute('DELETE FROM blocks WHERE height >= ?', (height,))
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteDB(DB):
+
+    def __init__(self, path):
+        self.config = {
+            'max_block_weight': 250000,
+            'mining_reward': 25,
+            'difficulty': 22,
+        }
+        self.lock = threading.RLock()
+        # ident of the thread which runs the open block transaction
+        self.owner = None
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # with WAL a crash can lose last commits on power loss only, not corrupt the database
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self.transaction_by_hash = SQLiteMapping(self, 'transactions')
+        self.block_index_by_tx_hash = SQLiteMapping(self, 'tx_blocks')
+        self.utxo = SQLiteUTXOSet(self)
+        self.blocks = SQLiteBlockStore(self)
+        # transactions are on disk, pruning is for the in-memory DB
+        self.prune_depth = None
+        self.spent_at = {}
+        self.undo = SQLiteMapping(self, 'undo')
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, params):
+        with self.lock:
+            return self.conn.executemany(sql, params)
+
+    @property
+    def block_index(self):
+        row = self.execute("SELECT value FROM meta WHERE key = 'block_index'").fetchone()
+        return int(row[0]) if row else 0
+
+    @block_index.setter
+    def block_index(self, value):
+        self.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('block_index', ?)", (str(value),))
+
+    @property
+    def in_transaction(self):
+        return self.owner == threading.get_ident()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.in_transaction:
+                yield
+                return
+            self.conn.execute('BEGIN')
+            self.owner = threading.get_ident()
+            try:
+                yield
+            except:
+                self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.conn.execute('COMMIT')
+            finally:
+                self.owner = None
+
+    def backup(self):
+        # every block is committed already, the copy is a consistent snapshot for offline use
+        with self.lock:
+            target = sqlite3.connect('block_%s.sqlite' % self.block_index)
+            try:
+                self.conn.backup(target)
+            finally:
+                target.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,95 @@
+import time
+from collections import deque
+
+"""
+This module collects mining telemetry, so difficulty and hardware can be sized from real numbers.
+
+Classes:
+    MiningStats:
+        Keeps total hashes with rolling hashes-per-second rates, a histogram of time-to-block, counters of mined
+        and stale blocks. Hash counters are fed by nonce search every chunk of nonces, both by
+        the single thread search and by the miner workers.
+
+Usage:
+    stats = MiningStats()
+    stats.add_hashes(4096)
+    stats.block_found(12.5)
+    stats.as_dict()
+
+Note:
+    Rates are calculated from samples taken at most once per `SAMPLE_EVERY` seconds, so a rate for a window is
+    available only after mining ran at least for two samples.
+"""
+
+
+class MiningStats:
+
+    # windows in seconds for rolling hashrate
+    WINDOWS = (10, 60, 300)
+    SAMPLE_EVERY = 1
+    # upper bounds in seconds of time-to-block histogram buckets
+    BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800)
+
+    __slots__ = 'hashes', 'blocks', 'stale_blocks', 'started', '_samples', '_histogram', '_block_time_sum'
+
+    def __init__(self):
+        self.hashes = 0
+        self.blocks = 0
+        self.stale_blocks = 0
+        self.started = time.time()
+        self._samples = deque()
+        self._histogram = [0] * (len(self.BUCKETS) + 1)
+        self._block_time_sum = 0
+
+    def add_hashes(self, count):
+        self.hashes += count
+        now = time.time()
+        if not self._samples or now - self._samples[-1][0] >= self.SAMPLE_EVERY:
+            self._samples.append((now, self.hashes))
+            while now - self._samples[0][0] > self.WINDOWS[-1] + self.SAMPLE_EVERY:
+                self._samples.popleft()
+
+    def hashrate(self, window):
+        '''
+        Hashes per second for last window seconds
+        '''
+        if not self._samples:
+            return 0
+        last_time, last_hashes = self._samples[-1]
+        for sample_time, sample_hashes in self._samples:
+            if last_time - sample_time <= window:
+                break
+        if last_time == sample_time:
+            return 0
+        return (last_hashes - sample_hashes) / (last_time - sample_time)
+
+    def block_found(self, seconds):
+        self.blocks += 1
+        self._block_time_sum += seconds
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self._histogram[i] += 1
+                break
+        else:
+            self._histogram[-1] += 1
+
+    @property
+    def time_to_block(self):
+        buckets = {str(bound): count for bound, count in zip(self.BUCKETS, self._histogram)}
+        buckets['inf'] = self._histogram[-1]
+        return {
+            "buckets": buckets,
+            "count": self.blocks,
+            "sum": self._block_time_sum,
+            "avg": self._block_time_sum / self.blocks if self.blocks else 0,
+        }
+
+    def as_dict(self):
+        return {
+            "hashes": self.hashes,
+            "hashrate": {'%ss' % w: self.hashrate(w) for w in self.WINDOWS},
+            "blocks_mined": self.blocks,
+            "stale_blocks": self.stale_blocks,
+            "time_to_block": self.time_to_block,
+            "uptime": time.time() - self.started,
+        }
@@ -0,0 +1,265 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from .blocks import Block
+
+"""
+This module stores accepted blocks on disk, so the node does not keep the whole chain in memory and does not need
+to pickle its state to survive a restart.
+
+Classes:
+    BlockLog:
+        Append-only log of blocks split into segment files. Every record is 4 bytes length followed by the canonical
+        block encoding, the same framing as lists of the wire format. A separate index file has one fixed size entry
+        per height: segment number, offset, size and block hash, so any block is found by height or hash with a
+        single read. Appends are flushed to the OS at once and fsynced every `sync_every` blocks.
+        Segments are read through `mmap`. Records of consecutive heights lie back to back, so a range of blocks
+        is served to syncing peers as one slice of mapped bytes per segment, without decoding any block.
+        On open, index entries pointing past the written data and data past the last index entry are cut off,
+        so a crash in the middle of append loses at most the unsynced blocks.
+
+    ChainWindow:
+        List-like chain on top of `BlockLog`. Keeps only the last `window` blocks in memory, older ones are read
+        from the log on access. Supports what `Blockchain` and `API` need from the chain list: `append`, `pop`,
+        `len`, indexes and slices by height.
+
+Usage:
+    log = BlockLog('data/blocks')
+    chain = ChainWindow(log, window=64)
+    chain.append(block)
+    chain[0], chain[10:20], chain[-1]
+    log.close()
+
+Note:
+    Log is written by one node process only. Reads and writes of different threads are serialized by a lock.
+"""
+
+
+logger = logging.getLogger('Blockchain')
+
+# segment number, offset in segment, record size, block hash
+INDEX_ENTRY = struct.Struct('>IQI32s')
+RECORD_HEADER = struct.Struct('>I')
+
+
+class BlockLog:
+
+    __slots__ = 'path', 'segment_size', 'sync_every', '_entries', '_heights', '_index', '_writer', '_segment', '_unsynced', '_maps', '_lock'
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, sync_every=16):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        # (segment, offset, size) by height
+        self._entries = []
+        self._heights = {}
+        # segment number -> mmap, remapped when segment grows
+        self._maps = {}
+        self._unsynced = 0
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%08d.blk' % number)
+
+    def _load(self):
+        index_path = os.path.join(self.path, 'index')
+        data = b''
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as fp:
+                data = fp.read()
+        sizes = {}
+        for height in range(len(data) // INDEX_ENTRY.size):
+            segment, offset, size, block_hash = INDEX_ENTRY.unpack_from(data, height * INDEX_ENTRY.size)
+            if segment not in sizes:
+                path = self._segment_path(segment)
+                sizes[segment] = os.path.getsize(path) if os.path.exists(path) else 0
+            if offset + RECORD_HEADER.size + size > sizes[segment]:
+                logger.error('Block log index points past data at height %s, cut off' % height)
+                break
+            self._entries.append((segment, offset, size))
+            self._heights[block_hash.hex()] = height
+        self._segment = self._entries[-1][0] if self._entries else 0
+        end = self._end()
+        # data of partially appended blocks and index entries past the data are dropped
+        with open(index_path, 'ab') as fp:
+            fp.truncate(len(self._entries) * INDEX_ENTRY.size)
+        with open(self._segment_path(self._segment), 'ab') as fp:
+            fp.truncate(end)
+        for segment in self._segments():
+            if segment > self._segment:
+                os.remove(self._segment_path(segment))
+        self._index = open(index_path, 'ab')
+        self._open_segment()
+
+    def _segments(self):
+        return sorted(int(el[:-4]) for el in os.listdir(self.path) if el.endswith('.blk'))
+
+    def _open_segment(self):
+        self._writer = open(self._segment_path(self._segment), 'ab')
+
+    def _end(self):
+        if not self._entries or self._entries[-1][0] != self._segment:
+            return 0
+        _, offset, size = self._entries[-1]
+        return offset + RECORD_HEADER.size + size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, block):
+        data = block.encode()
+        with self._lock:
+            offset = self._end()
+            if offset and offset + RECORD_HEADER.size + len(data) > self.segment_size:
+                self._writer.close()
+                self._segment += 1
+                self._open_segment()
+                offset = 0
+            self._writer.write(RECORD_HEADER.pack(len(data)) + data)
+            self._writer.flush()
+            self._index.write(INDEX_ENTRY.pack(self._segment, offset, len(data), bytes.fromhex(block.hash())))
+            self._index.flush()
+            self._heights[block.hash()] = len(self._entries)
+            self._entries.append((self._segment, offset, len(data)))
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self.sync()
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._writer.fileno())
+            os.fsync(self._index.fileno())
+            self._unsynced = 0
+
+    def _map(self, segment, end):
+        mapped = self._maps.get(segment)
+        if mapped is None or len(mapped) < end:
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment_path(segment), 'rb') as fp:
+                mapped = self._maps[segment] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapped
+
+    def _close_maps(self, from_segment=0):
+        for number in [el for el in self._maps if el >= from_segment]:
+            self._maps.pop(number).close()
+
+    def read_raw(self, height):
+        with self._lock:
+            segment, offset, size = self._entries[height]
+            start = offset + RECORD_HEADER.size
+            return self._map(segment, start + size)[start:start + size]
+
+    def read_records(self, start, stop):
+        '''
+        Records of heights from start to stop as they lie in the log, each is 4 bytes length and block bytes.
+        '''
+        with self._lock:
+            stop = min(stop, len(self._entries))
+            res = []
+            height = start
+            while height < stop:
+                segment, offset, _ = self._entries[height]
+                last = height
+                while last + 1 < stop and self._entries[last + 1][0] == segment:
+                    last += 1
+                _, last_offset, last_size = self._entries[last]
+                end = last_offset + RECORD_HEADER.size + last_size
+                res.append(self._map(segment, end)[offset:end])
+                height = last + 1
+            return b''.join(res)
+
+    def read(self, height):
+        return Block.from_bytes(self.read_raw(height))
+
+    def height_of(self, block_hash):
+        return self._heights.get(block_hash)
+
+    def truncate(self, height):
+        '''
+        Drops blocks from given height to the end, used on rollback.
+        '''
+        with self._lock:
+            if height >= len(self._entries):
+                return
+            segment, offset, _ = self._entries[height]
+            self._heights = {k: v for k, v in self._heights.items() if v < height}
+            del self._entries[height:]
+            self._writer.close()
+            self._close_maps(segment)
+            for number in self._segments():
+                if number > segment:
+                    os.remove(self._segment_path(number))
+            self._segment = segment
+            with open(self._segment_path(segment), 'ab') as fp:
+                fp.truncate(offset)
+            self._index.truncate(height * INDEX_ENTRY.size)
+            self._open_segment()
+            self.sync()
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            self._writer.close()
+            self._index.close()
+            self._close_maps()
+
+
+class ChainWindow:
+
+    __slots__ = 'log', 'window', '_recent'
+
+    def __init__(self, log, window=64):
+        self.log = log
+        self.window = window
+        self._recent = []
+        self._fill()
+
+    def _fill(self):
+        # head is read very often, so recent blocks are always kept in memory
+        self._recent = [self.log.read(i) for i in range(max(0, len(self.log) - self.window), len(self.log))]
+
+    def __len__(self):
+        return len(self.log)
+
+    def _start(self):
+        return len(self.log) - len(self._recent)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('chain index out of range')
+        start = self._start()
+        if item >= start:
+            return self._recent[item - start]
+        return self.log.read(item)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self[i]
+
+    def append(self, block):
+        self.log.append(block)
+        self._recent.append(block)
+        if len(self._recent) > self.window:
+            del self._recent[:len(self._recent) - self.window]
+
+    def pop(self):
+        block = self[-1]
+        self.log.truncate(len(self) - 1)
+        self._recent.pop()
+        if not self._recent:
+            self._fill()
+        return block
@@ -0,0 +1,65 @@
+import time
+
+"""
+This module keeps the candidate block (template) the miner works on up to date with the chain head and the
+pool of unconfirmed transactions.
+
+Classes:
+    TemplateManager:
+        Wraps `Blockchain.create_block_template`. The template is rebuilt only when the chain head or the
+        mempool version changes. The miner polls `current` while searching a nonce and switches to the new
+        template in place, so new transactions get into the block without restarting the mining loop.
+        Also tracks when mining on the current head started, template age and number of refreshes for telemetry.
+        `reset` drops the template, so the next `current` builds a new one.
+
+Usage:
+    templates = TemplateManager(blockchain)
+    block = templates.current()
+    blockchain.mine_block(block, check_stop, templates.current)
+
+Note:
+    Template identity is used as a change marker. `current` returns the very same `Block` object while nothing
+    changed, so callers can compare with `is`.
+"""
+
+
+class TemplateManager:
+
+    __slots__ = 'bc', 'block', 'key', 'created', 'head_since', 'refreshes'
+
+    def __init__(self, blockchain):
+        self.bc = blockchain
+        self.block = None
+        self.key = None
+        self.created = None
+        self.head_since = time.time()
+        self.refreshes = 0
+
+    def current(self):
+        # key and template are taken under the chain lock, so the template matches the key it is stored with
+        with self.bc.lock:
+            key = (self.bc.head.hash() if self.bc.head else None, self.bc.mempool_version)
+            if self.block is None or key != self.key:
+                now = time.time()
+                if self.key is None or key[0] != self.key[0]:
+                    self.head_since = now
+                # with the same head previous template can be extended instead of built from scratch
+                self.block = self.bc.create_block_template(self.block if self.key and key[0] == self.key[0] else None)
+                self.key = key
+                self.created = now
+                self.refreshes += 1
+            return self.block
+
+    def reset(self):
+        '''
+        Drops the template, for example a mined one which the chain rejected.
+        '''
+        self.block = None
+        self.key = None
+
+    @property
+    def age(self):
+        if self.created is None:
+            return 0
+        return time.time() - self.created
+
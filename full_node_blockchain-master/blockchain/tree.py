@@ -0,0 +1,122 @@
+"""
+This module keeps the tree of recent blocks, the main chain and every side branch seen, so the node can choose the
+chain with the most work and switch to it however deep the fork is.
+
+Classes:
+    TreeNode:
+        Block in the tree: hash, parent hash, height and cumulative work of the chain ending with it. Blocks of side
+        branches are kept in the node, blocks of the main chain live in `Blockchain.chain` only.
+
+    BlockTree:
+        Nodes indexed by hash and by height. `fork_path` walks from two tips down to their common ancestor, so
+        switching chains rolls back and applies only the blocks above it. Nodes deeper than `depth` below the
+        head are dropped by `prune`, which bounds memory and the depth of a reorg.
+
+Functions:
+    block_work(difficulty):
+        Expected number of hashes to find a block at the difficulty, the work one block adds to its chain.
+
+Usage:
+    tree = BlockTree(depth=100)
+    tree.add(block, block_work(difficulty))
+    node = tree.get(block.hash())
+    ancestor, path = tree.fork_path(head.hash(), node.hash)
+
+Note:
+    Nodes whose parent is not in the tree, like the first block loaded from storage, get the work of a chain
+    of their height with the same difficulty. Only differences of work between tips matter.
+"""
+
+
+def block_work(difficulty):
+    return 2 ** int(difficulty)
+
+
+class TreeNode:
+
+    __slots__ = 'hash', 'prev_hash', 'height', 'work', 'block'
+
+    def __init__(self, block_hash, prev_hash, height, work, block=None):
+        self.hash = block_hash
+        self.prev_hash = prev_hash
+        self.height = height
+        self.work = work
+        self.block = block
+
+
+class BlockTree:
+
+    __slots__ = 'nodes', 'by_height', 'depth'
+
+    def __init__(self, depth=100):
+        self.nodes = {}
+        # height -> hashes of blocks at that height
+        self.by_height = {}
+        self.depth = depth
+
+    def __contains__(self, block_hash):
+        return block_hash in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def get(self, block_hash):
+        return self.nodes.get(block_hash)
+
+    def add(self, block, work, keep=False):
+        '''
+        Adds block on top of its parent. With keep block itself is stored in the node, for side branches.
+        '''
+        parent = self.nodes.get(block.prev_hash)
+        base = parent.work if parent is not None else work * block.index
+        node = TreeNode(block.hash(), block.prev_hash, block.index, base + work, block if keep else None)
+        self.nodes[node.hash] = node
+        self.by_height.setdefault(node.height, set()).add(node.hash)
+        return node
+
+    def at_height(self, height):
+        return [self.nodes[el] for el in self.by_height.get(height, ())]
+
+    def remove(self, block_hash):
+        '''
+        Removes block and all its descendants, used for branches which failed verification.
+        '''
+        queue = [block_hash]
+        while queue:
+            node = self.nodes.pop(queue.pop(), None)
+            if node is None:
+                continue
+            self.by_height[node.height].discard(node.hash)
+            if not self.by_height[node.height]:
+                del self.by_height[node.height]
+            queue.extend(el.hash for el in self.at_height(node.height + 1) if el.prev_hash == node.hash)
+
+    def fork_path(self, head_hash, tip_hash):
+        '''
+        Common ancestor of two blocks and nodes from it to the tip, ancestor excluded.
+        Returns (None, []) if the ancestor is not in the tree anymore.
+        '''
+        head = self.nodes.get(head_hash)
+        tip = self.nodes.get(tip_hash)
+        path = []
+        while head is not None and tip is not None and head is not tip:
+            if tip.height >= head.height:
+                path.append(tip)
+                tip = self.nodes.get(tip.prev_hash)
+            else:
+                head = self.nodes.get(head.prev_hash)
+        if head is None or tip is None:
+            return None, []
+        path.reverse()
+        return head, path
+
+    def side_blocks(self):
+        '''
+        Blocks of side branches by height.
+        '''
+        return [el.block for el in sorted(self.nodes.values(), key=lambda el: el.height) if el.block is not None]
+
+    def prune(self, head_height):
+        for height in [el for el in self.by_height if el < head_height - self.depth]:
+            for block_hash in self.by_height.pop(height):
+                del self.nodes[block_hash]
@@ -0,0 +1,221 @@
+from array import array
+
+"""
+This module keeps the set of unspent transaction outputs (UTXO) in a compact form.
+
+Classes:
+    UTXOSet:
+        Table of outpoints, (transaction hash, output index), with amount and address of every unspent output.
+        Records live in parallel arrays. Outputs of one transaction take a run of consecutive record slots, so
+        the only dict is keyed by 32 raw bytes of transaction hash and points to the first slot of its run.
+        Addresses are stored once and referenced by a small integer id. A secondary index keeps an array of
+        record slots per address id for balance and unspent lookups, with O(1) removal.
+        Runs of fully spent transactions are reused by new transactions with the same number of outputs.
+        The table holds everything verifiers need about an output, so spending does not depend on full
+        transaction dicts being kept in DB.
+
+Usage:
+    utxo = UTXOSet()
+    utxo.add(tx.hash, 0, address, 25)
+    address, amount = utxo.get(tx.hash, 0)
+    utxo.spend(tx.hash, 0)
+    utxo.add_many([(tx.hash, i, out.address, out.amount) for i, out in enumerate(tx.outputs)])
+    utxo.by_address(address)
+
+Note:
+    Transaction hashes are given and returned as hex strings like everywhere else, they are kept as raw bytes
+    only inside the table.
+"""
+
+
+# owner of a record slot without unspent output
+EMPTY = 0xFFFFFFFF
+
+
+class UTXOSet:
+
+    __slots__ = (
+        '_txs', '_hashes', '_indexes', '_sizes', '_left', '_amounts', '_owners', '_positions',
+        '_free', '_address_ids', '_addresses', '_by_address', '_count',
+    )
+
+    def __init__(self):
+        # tx hash bytes -> first slot of its run
+        self._txs = {}
+        # per slot: tx hash bytes, output index, amount, address id and position in the address index
+        self._hashes = []
+        self._indexes = array('I')
+        self._amounts = array('Q')
+        self._owners = array('I')
+        self._positions = array('I')
+        # per first slot of a run: number of slots and of unspent outputs in it
+        self._sizes = array('I')
+        self._left = array('I')
+        # run size -> first slots of free runs
+        self._free = {}
+        self._address_ids = {}
+        self._addresses = []
+        # record slots by address id
+        self._by_address = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+    def _address_id(self, address):
+        address_id = self._address_ids.get(address)
+        if address_id is None:
+            address_id = self._address_ids[address] = len(self._addresses)
+            self._addresses.append(address)
+            self._by_address.append(array('I'))
+        return address_id
+
+    def _slot(self, tx_hash, index):
+        first = self._txs.get(bytes.fromhex(tx_hash))
+        if first is None or index >= self._sizes[first]:
+            return None
+        return first + index
+
+    def _allocate(self, key, size):
+        free = self._free.get(size)
+        if free:
+            first = free.pop()
+        else:
+            first = len(self._owners)
+            self._hashes.extend([None] * size)
+            self._indexes.extend(range(size))
+            self._amounts.extend([0] * size)
+            self._owners.extend([EMPTY] * size)
+            self._positions.extend([0] * size)
+            self._sizes.extend([0] * size)
+            self._left.extend([0] * size)
+        for slot in range(first, first + size):
+            self._hashes[slot] = key
+        self._sizes[first] = size
+        self._left[first] = 0
+        self._txs[key] = first
+        return first
+
+    def _release(self, key, first):
+        size = self._sizes[first]
+        del self._txs[key]
+        for slot in range(first, first + size):
+            self._hashes[slot] = None
+        self._free.setdefault(size, []).append(first)
+
+    def _link(self, slot, address_id, amount):
+        slots = self._by_address[address_id]
+        self._positions[slot] = len(slots)
+        slots.append(slot)
+        self._owners[slot] = address_id
+        self._amounts[slot] = amount
+
+    def _unlink(self, slot):
+        # swap with the last slot of the address, so removal is O(1)
+        slots = self._by_address[self._owners[slot]]
+        position = self._positions[slot]
+        last = slots.pop()
+        if last != slot:
+            slots[position] = last
+            self._positions[last] = position
+        self._owners[slot] = EMPTY
+
+    def add(self, tx_hash, index, address, amount, size=1):
+        '''
+        Adds unspent output. Size is number of outputs of the tx, it reserves the run for the outputs added next.
+        '''
+        key = bytes.fromhex(tx_hash)
+        first = self._txs.get(key)
+        if first is None:
+            first = self._allocate(key, max(size, index + 1))
+        elif index >= self._sizes[first]:
+            first = self._grow(key, first, max(size, index + 1))
+        slot = first + index
+        if self._owners[slot] != EMPTY:
+            self._unlink(slot)
+        else:
+            self._left[first] += 1
+            self._count += 1
+        self._link(slot, self._address_id(str(address)), amount)
+
+    def _grow(self, key, first, size):
+        old_size = self._sizes[first]
+        left = self._left[first]
+        moved = [(i, self._owners[first + i], self._amounts[first + i]) for i in range(old_size) if self._owners[first + i] != EMPTY]
+        for i, _, _ in moved:
+            self._unlink(first + i)
+        self._release(key, first)
+        first = self._allocate(key, size)
+        for i, owner, amount in moved:
+            self._link(first + i, owner, amount)
+        self._left[first] = left
+        return first
+
+    def add_many(self, outputs):
+        '''
+        Adds (tx hash, output index, address, amount) items, outputs of one tx get one run of slots.
+        '''
+        outputs = list(outputs)
+        sizes = {}
+        for tx_hash, index, _, _ in outputs:
+            sizes[tx_hash] = max(sizes.get(tx_hash, 0), index + 1)
+        for tx_hash, index, address, amount in outputs:
+            self.add(tx_hash, index, address, amount, sizes[tx_hash])
+
+    def has_unspent(self, tx_hash):
+        return bytes.fromhex(tx_hash) in self._txs
+
+    def get(self, tx_hash, index):
+        '''
+        Returns (address, amount) of unspent output or None.
+        '''
+        slot = self._slot(tx_hash, index)
+        if slot is None or self._owners[slot] == EMPTY:
+            return None
+        return self._addresses[self._owners[slot]], self._amounts[slot]
+
+    def spend(self, tx_hash, index):
+        '''
+        Removes output from the set, returns its (address, amount). Raises KeyError if output is not unspent.
+        '''
+        slot = self._slot(tx_hash, index)
+        if slot is None or self._owners[slot] == EMPTY:
+            raise KeyError((tx_hash, index))
+        res = self._addresses[self._owners[slot]], self._amounts[slot]
+        self._unlink(slot)
+        self._count -= 1
+        first = slot - index
+        self._left[first] -= 1
+        if not self._left[first]:
+            self._release(self._hashes[first], first)
+        return res
+
+    def spend_many(self, outpoints):
+        for tx_hash, index in outpoints:
+            self.spend(tx_hash, index)
+
+    def by_address(self, address):
+        '''
+        List of (tx hash, output index, amount) of unspent outputs of the address.
+        '''
+        address_id = self._address_ids.get(str(address))
+        if address_id is None:
+            return []
+        return [(self._hashes[slot].hex(), self._indexes[slot], self._amounts[slot]) for slot in self._by_address[address_id]]
+
+    def balance(self, address):
+        address_id = self._address_ids.get(str(address))
+        if address_id is None:
+            return 0
+        return sum(self._amounts[slot] for slot in self._by_address[address_id])
+
+    def items(self):
+        '''
+        All unspent outputs as (tx hash, output index, address, amount).
+        '''
+        for slot, owner in enumerate(self._owners):
+            if owner != EMPTY:
+                yield self._hashes[slot].hex(), self._indexes[slot], self._addresses[owner], self._amounts[slot]
@@ -1,7 +1,10 @@
 import rsa
 import binascii
+import threading
+from collections import OrderedDict
 
 from .wallet import Address
+from .blocks import target_digest
 
 """
 This module provides classes for verifying transactions and blocks within a blockchain system. It ensures
@@ -13,8 +16,20 @@ Classes:
         transaction outputs (UTXOs), and validating the input amounts against output amounts.
 
     BlockVerifier:
-        Verifies the validity of blocks by checking the block's hash against the target difficulty, verifying
-        all transactions within the block, and ensuring the block reward is correctly calculated.
+        Verifies the validity of blocks by checking the block's hash against the target difficulty, the block
+        weight against `max_block_weight`, verifying all transactions within the block, and ensuring the block
+        reward is correctly calculated.
+        Signatures of all inputs in a block are checked up front, spread over a process pool when one is given
+        and the block has at least `PARALLEL_MIN_SIGNATURES` of them. UTXO and amount checks stay serial and
+        write into a `db.UTXOView`, so transactions can spend outputs of earlier transactions in the same block.
+
+    SignatureCache:
+        LRU bounded set of already verified signatures with hit and miss counters. One instance is shared by
+        mempool admission and block verification, so signatures of txs relayed earlier are not checked twice.
+
+Functions:
+    check_signature(job):
+        Verifies one input signature against the address of the output it spends.
 
 Exceptions:
     BlockOutOfChain:
@@ -51,11 +66,126 @@ Note:
 """
 
 
+# less signatures then this are checked in place, sending them to processes costs more
+PARALLEL_MIN_SIGNATURES = 8
+# signatures sent to pool process at once, few ms of work to keep pickling overhead low
+SIGNATURES_PER_CHUNK = 32
+
+
+def check_signature(job):
+    '''
+    Job is (signed message, signature hex, address of spent output). Runs in pool processes as well.
+    '''
+    message, signature, address = job
+    try:
+        rsa.verify(message, binascii.unhexlify(signature.encode()), Address(address).key)
+    except:
+        return False
+    return True
+
+
+class SignatureCache:
+    '''
+    Bounded LRU set of already verified (input hash, signature, address) triples.
+    Only successful checks are kept, so a cached triple is always valid. Safe to share between threads.
+    '''
+
+    __slots__ = 'size', 'hits', 'misses', '_entries', '_lock'
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def check(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = True
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def as_dict(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class TxVerifier:
-    def __init__(self, db):
+    def __init__(self, db, cache=None):
         self.db = db
+        self.cache = cache
+
+    def signature_job(self, inp, address):
+        hash_string = '{}{}{}{}'.format(
+            inp.prev_tx_hash, inp.output_index, inp.address, inp.index
+        )
+        return hash_string.encode(), inp.signature, address
 
-    def verify(self, inputs, outputs):
+    def output_address(self, inp):
+        '''
+        Address of the output spent by input, None if there is no such output.
+        '''
+        unspent = self.db.get_unspent(inp.prev_tx_hash, inp.output_index)
+        if unspent is not None:
+            return unspent[0]
+        # outputs of txs which are not applied yet, like earlier txs of the same block
+        try:
+            return self.db.transaction_by_hash[inp.prev_tx_hash]['outputs'][inp.output_index]['address']
+        except (KeyError, IndexError):
+            return None
+
+    def signature_jobs(self, inputs):
+        '''
+        Signature checks of inputs, which can be run before UTXO checks, with their cache keys.
+        None for inputs without spent output.
+        '''
+        res = []
+        for i,inp in enumerate(inputs):
+            if inp.prev_tx_hash == 'COINBASE' and i == 0:
+                res.append(None)
+                continue
+            address = self.output_address(inp)
+            if address is None:
+                res.append(None)
+                continue
+            res.append((self.cache_key(inp, address), self.signature_job(inp, address)))
+        return res
+
+    def cache_key(self, inp, address):
+        return inp.hash, inp.signature, address
+
+    def check_signature(self, inp, address):
+        if self.cache is None:
+            return check_signature(self.signature_job(inp, address))
+        key = self.cache_key(inp, address)
+        if self.cache.check(key):
+            return True
+        valid = check_signature(self.signature_job(inp, address))
+        if valid:
+            self.cache.add(key)
+        return valid
+
+    def verify(self, inputs, outputs, signatures=None):
+        '''
+        Signatures is optional list of already done signature checks results, one per input.
+        '''
         total_amount_in = 0
         total_amount_out = 0
         for i,inp in enumerate(inputs):
@@ -63,22 +193,20 @@ class TxVerifier:
                 total_amount_in = int(self.db.config['mining_reward'])
                 continue
  
-            try:
-                out = self.db.transaction_by_hash[inp.prev_tx_hash]['outputs'][inp.output_index]
-            except KeyError:
+            out = self.db.get_unspent(inp.prev_tx_hash, inp.output_index)
+            if out is None:
+                if inp.prev_tx_hash in self.db.transaction_by_hash:
+                    raise Exception('Output of transaction already spent.')
                 raise Exception('Transaction output not found.')
+            address, amount = out
 
-            total_amount_in += int(out['amount'])
-
-            if (inp.prev_tx_hash,out['hash']) not in self.db.unspent_txs_by_user_hash.get(out['address'], set()):
-                raise Exception('Output of transaction already spent.')
+            total_amount_in += int(amount)
 
-            hash_string = '{}{}{}{}'.format(
-                inp.prev_tx_hash, inp.output_index, inp.address, inp.index
-            )
-            try:
-                rsa.verify(hash_string.encode(), binascii.unhexlify(inp.signature.encode()), Address(out['address']).key) == 'SHA-256'
-            except:
+            if signatures is not None:
+                valid = signatures[i]
+            else:
+                valid = self.check_signature(inp, address)
+            if not valid:
                 raise Exception('Signature verification failed: %s' % inp.as_dict)
 
         for out in outputs:
@@ -96,21 +224,65 @@ class BlockVerificationFailed(Exception):
     pass
 
 class BlockVerifier:
-    def __init__(self, db):
+    def __init__(self, db, pool=None, min_parallel=PARALLEL_MIN_SIGNATURES, cache=None):
         self.db = db
-        self.tv = TxVerifier(db)
+        self.pool = pool
+        self.min_parallel = min_parallel
+        self.cache = cache
+
+    def verify_signatures(self, txs, view=None):
+        '''
+        Checks signatures of all inputs of all txs at once, on process pool if it is set.
+        Returns list of results per input for every tx.
+        '''
+        tv = TxVerifier(view if view is not None else self.db, self.cache)
+        jobs = [tv.signature_jobs(tx.inputs) for tx in txs]
+        # signatures seen before, for example when tx was added to mempool, are not checked again
+        cached = set()
+        if self.cache is not None:
+            cached = {job[0] for tx_jobs in jobs for job in tx_jobs if job is not None and self.cache.check(job[0])}
+        flat = [job for tx_jobs in jobs for job in tx_jobs if job is not None and job[0] not in cached]
+        if self.pool and len(flat) >= self.min_parallel:
+            checked = self.pool.map(check_signature, [job[1] for job in flat], chunksize=SIGNATURES_PER_CHUNK)
+        else:
+            checked = map(check_signature, [job[1] for job in flat])
+        results = dict(zip((job[0] for job in flat), checked))
+        if self.cache is not None:
+            for key, valid in results.items():
+                if valid:
+                    self.cache.add(key)
+        return [[job is not None and (job[0] in cached or results[job[0]]) for job in tx_jobs] for tx_jobs in jobs]
 
-    def verify(self, head, block):
+    def verify(self, head, block, view=None):
+        '''
+        Transactions are applied to the view one by one, so they can spend outputs of previous txs of the block.
+        On success the view holds all changes of the block and can be committed to the DB.
+        '''
+        if view is None:
+            view = self.db.view()
+        tv = TxVerifier(view, self.cache)
         total_block_reward = int(self.db.config['mining_reward'])
 
         # verifying block hash
-        if int(block.hash(), 16) > (2 ** (256-self.db.config['difficulty'])):
+        if bytes.fromhex(block.hash()) > target_digest(self.db.config['difficulty']):
             raise BlockVerificationFailed('Block hash bigger then target difficulty')     
 
+        if block.weight > self.db.config['max_block_weight']:
+            raise BlockVerificationFailed('Block weight over the limit')
+
+        # signatures are the most expensive part, so they are checked together first
+        # and then transactions verified in order, to raise the same error as one by one check
+        view.add_txs(block.txs)
+        signatures = self.verify_signatures(block.txs[1:], view)
+
         # verifying transactions in a block
-        for tx in block.txs[1:]:
-            fee = self.tv.verify(tx.inputs, tx.outputs)
+        for tx, tx_signatures in zip(block.txs[1:], signatures):
+            try:
+                fee = tv.verify(tx.inputs, tx.outputs, tx_signatures)
+            except Exception as e:
+                raise BlockVerificationFailed('Transaction %s: %s' % (tx.hash, e))
             total_block_reward += fee
+            view.apply_tx(tx, block.index)
         
         total_reward_out = 0
         for out in block.txs[0].outputs:
@@ -129,4 +301,6 @@ class BlockVerifier:
             if head.timestamp > block.timestamp:
                 raise BlockOutOfChain('Block from the past')
 
+        view.apply_tx(block.txs[0], block.index)
+        view.block_index = block.index
         return True
@@ -1,5 +1,7 @@
 import rsa
 import binascii
+import threading
+from collections import OrderedDict
 
 """
 This module provides classes for verifying transactions and blocks within a blockchain system. It ensures
@@ -49,19 +51,61 @@ Note:
 """
 
 
+# how many parsed addresses are kept by Address
+ADDRESS_CACHE_SIZE = 10000
+
+
 class Address:
-    def __init__(self, addr):
+    '''
+    Public key of a wallet. Addresses made from a string are interned: the same string gives the same instance
+    from a LRU cache of `ADDRESS_CACHE_SIZE` entries, so the key is parsed and stringified only once.
+    '''
+
+    __slots__ = 'addr', '_str'
+
+    _cache = OrderedDict()
+    # cache is shared by API, sync and mining threads
+    _lock = threading.Lock()
+
+    def __new__(cls, addr):
+        if isinstance(addr, Address):
+            return addr
         if isinstance(addr, rsa.PublicKey):
-            self.addr = addr
-        else:
-            if isinstance(addr,str):
-                addr = addr.encode()
-            # thats not clean bu i didnt find simple crypto library for 512 sha key
-            # to get address/public_key short. 
-            self.addr = rsa.PublicKey.load_pkcs1(b'-----BEGIN RSA PUBLIC KEY-----\n%b\n-----END RSA PUBLIC KEY-----\n' % addr)
+            inst = super().__new__(cls)
+            inst.addr = addr
+            inst._str = None
+            return inst
+        if isinstance(addr, bytes):
+            addr = addr.decode()
+        with cls._lock:
+            inst = cls._cache.get(addr)
+            if inst is not None:
+                cls._cache.move_to_end(addr)
+                return inst
+        inst = super().__new__(cls)
+        # thats not clean bu i didnt find simple crypto library for 512 sha key
+        # to get address/public_key short. 
+        inst.addr = rsa.PublicKey.load_pkcs1(b'-----BEGIN RSA PUBLIC KEY-----\n%b\n-----END RSA PUBLIC KEY-----\n' % addr.encode())
+        inst._str = None
+        # key is parsed without the lock, the same string parsed by another thread meanwhile wins
+        with cls._lock:
+            inst = cls._cache.setdefault(addr, inst)
+            if len(cls._cache) > ADDRESS_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return inst
+
+    def __reduce__(self):
+        return self.__class__, (str(self),)
 
     def __str__(self):
-        return b''.join(self.addr.save_pkcs1().split(b'\n')[1:-2]).decode()
+        if self._str is None:
+            self._str = b''.join(self.addr.save_pkcs1().split(b'\n')[1:-2]).decode()
+        return self._str
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._lock:
+            cls._cache.clear()
 
     @property
     def key(self):
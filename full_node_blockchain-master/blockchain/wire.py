@@ -0,0 +1,76 @@
+import struct
+
+from .blocks import Block, Tx
+
+"""
+This module defines the compact binary wire format used between nodes. It is built on the canonical encoding
+of `Block` and `Tx` from blocks.py, so addresses and hashes travel as raw bytes instead of base64 and hex strings.
+
+Constants:
+    MEDIA_TYPE:
+        Content type of binary payloads. Nodes select the format by content negotiation: `Accept` header for
+        responses and `Content-Type` for request bodies. JSON stays the fallback for peers and clients without it.
+
+Functions:
+    encode_list(items):
+        Encodes a list of Blocks or Txs as 4 bytes count followed by 4 bytes length and bytes of every item.
+
+    join_encoded(encoded), split_encoded(data):
+        Same framing for items which are already encoded.
+
+    frame(encoded), join_records(count, records):
+        Same list from records which already have their length prefix, as the block log stores them.
+
+    decode_blocks(data), decode_txs(data):
+        Reads list of Blocks or Txs back.
+
+    Single Block or Tx payload is just its canonical encoding, `Block.from_bytes` and `Tx.from_bytes` read it.
+
+Usage:
+    payload = encode_list(blocks)
+    blocks = decode_blocks(payload)
+"""
+
+
+MEDIA_TYPE = 'application/x-blockchain'
+
+
+def encode_list(items):
+    return join_encoded([el.encode() for el in items])
+
+
+def join_encoded(encoded):
+    return join_records(len(encoded), b''.join([frame(el) for el in encoded]))
+
+
+def frame(encoded):
+    return struct.pack('>I', len(encoded)) + encoded
+
+
+def join_records(count, records):
+    return struct.pack('>I', count) + records
+
+
+def split_encoded(data):
+    data = memoryview(data)
+    count, = struct.unpack_from('>I', data, 0)
+    offset = 4
+    res = []
+    for _ in range(count):
+        size, = struct.unpack_from('>I', data, offset)
+        offset += 4
+        if len(data) < offset + size:
+            raise ValueError('Unexpected end of data')
+        res.append(data[offset:offset+size])
+        offset += size
+    if offset != len(data):
+        raise ValueError('Extra data after list')
+    return res
+
+
+def decode_blocks(data):
+    return [Block.from_bytes(el) for el in split_encoded(data)]
+
+
+def decode_txs(data):
+    return [Tx.from_bytes(el) for el in split_encoded(data)]
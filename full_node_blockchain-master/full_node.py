@@ -1,16 +1,26 @@
-from fastapi import FastAPI, BackgroundTasks, Request
+from fastapi import FastAPI, BackgroundTasks, Request, Response
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 import uvicorn
 import requests
 import asyncio
 import logging
+import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from models import *
 from blockchain.db import DB
+from blockchain.sqlite_db import SQLiteDB
 from blockchain.blockchain import Blockchain
 from blockchain.wallet import Wallet
 from blockchain.api import API
-from blockchain.blocks import Input, Output, Tx
+from blockchain.miner import Miner
+from blockchain.storage import BlockLog
+from blockchain.snapshot import Snapshots
+from blockchain.blocks import Input, Output, Tx, Block
+from blockchain import wire
 
 """
 A blockchain full node implementation using FastAPI framework to manage the node operations via HTTP API calls.
@@ -26,6 +36,18 @@ Functions:
     mine(event: asyncio.Event) -> None:
         Continuously mines new blocks until stopped by setting the event.
 
+    save_snapshot(block, db) -> None:
+        Saves the in-memory DB state every `--snapshot-every` blocks, called when a block is committed.
+
+    load_wallet(data_dir: str) -> Wallet:
+        Loads the node wallet from the data dir or creates and saves a new one, so restarted node keeps its address.
+
+    dump_mempool() -> None:
+        Saves unconfirmed transactions to the mempool file of the data dir.
+
+    dump_mempool_loop() -> None:
+        Saves the mempool every `--mempool-dump-every` seconds, so a crash loses only the last interval.
+
 FastAPI Endpoints:
     /chain/stop-mining: 
         Stops the mining process if it's currently running.
@@ -33,6 +55,12 @@ FastAPI Endpoints:
     /chain/start-mining:
         Starts the mining process if it's not already running.
 
+    /chain/mining-stats:
+        Returns hashrate, time-to-block histogram, template age and stale block counters of the miner.
+
+    /chain/verify-stats:
+        Returns size, hits and misses of the signature verification cache.
+
     /server/nodes:
         Returns a list of known nodes in the network.
 
@@ -51,25 +79,34 @@ FastAPI Endpoints:
     /chain/status:
         Provides the current status of the node, including the latest block hash and index.
 
+    /chain/tx_proof:
+        Returns Merkle inclusion proof and block header for a confirmed transaction, for light clients.
+
     /chain/sync:
-        Serves a range of blocks for syncing purposes to other nodes.
+        Serves a range of blocks for syncing purposes to other nodes. Binary if requested by `Accept` header.
 
     /chain/add_block:
-        Adds a new block to the blockchain and broadcasts it to other nodes.
+        Adds a new block to the blockchain and broadcasts it to other nodes. Body is JSON or binary.
 
     /chain/tx_create:
-        Adds a new transaction to the transaction pool and broadcasts it to other nodes.
+        Adds a new transaction to the transaction pool and broadcasts it to other nodes. Body is JSON or binary.
+
+    /chain/tx_create_batch:
+        Adds a list of transactions, which may spend outputs of each other, in one call. Returns result for every
+        transaction and relays accepted ones to other nodes in a single message. Body is JSON or binary list.
+
+Wire Format:
+    Blocks and txs travel in the compact binary format of `blockchain.wire` when the peer supports it. Every
+    response carries `X-Wire-Formats` header, so nodes remember which peers accept binary. JSON is the fallback.
 
 Startup and Shutdown Events:
     on_startup():
         Sets up the node, syncs blockchain data, broadcasts the node address, and starts mining if configured.
+        Starts periodic mempool dumps with the data dir.
 
     on_shutdown():
-        Properly stops the mining process if it's running.
-
-Utility Functions:
-    restart_miner() -> None:
-        Restarts the mining process.
+        Properly stops the mining process, miner workers and signature verification pool if they are running.
+        Saves the mempool with the data dir.
 
 Command-line Arguments:
     --node:
@@ -87,6 +124,34 @@ Command-line Arguments:
     --ip:
         The IP address on which to run the node.
 
+    --workers:
+        Number of mining processes. 0 uses all cores, without it mining runs in a single thread.
+
+    --verify-workers:
+        Number of processes checking block signatures in parallel. 0 uses all cores, without it checks are serial.
+
+    --data-dir:
+        Directory for the block log, state snapshots and the node wallet. On start the newest snapshot matching the
+        block log is loaded, only blocks stored after it are replayed and only the rest is synced from peers.
+        Without it the chain lives in memory.
+
+    --snapshot-every:
+        Blocks between state snapshots of the in-memory DB, 100 by default. A snapshot is also saved on shutdown.
+
+    --prune-depth:
+        Pruning mode of the in-memory DB, requires `--data-dir`, so blocks are read from the block log instead of
+        being held in memory. Bodies of fully spent transactions are dropped once the block spending them is this
+        many blocks deep, under steady traffic DB memory then grows only by the block index of transactions.
+        Deeper reorgs are not possible.
+
+    --mempool-dump-every:
+        Seconds between saves of the mempool to `mempool.dat` of the data dir, 60 by default. The mempool is also
+        saved on shutdown. On start saved transactions are verified again and added back before the sync.
+
+    --db:
+        State backend, `memory` (default) or `sqlite`. SQLite keeps blocks and state in `chain.sqlite` of the data
+        dir and commits every block in one transaction, so on start only blocks without committed state are replayed.
+
 Logging:
     Custom logging with color formatting for better visibility during development and troubleshooting.
     
@@ -118,11 +183,6 @@ class ColorFormatter(logging.Formatter):
 
 logger = logging.getLogger("Blockchain")
 
-'''
-TODO:
-* sync data while split brain exist 
-'''
-
 app = FastAPI()
 app.config = {}
 app.jobs = {}
@@ -132,6 +192,8 @@ def sync_data():
     logger.info('================== Sync started =================')
     bc = app.config['api']
     head = bc.get_head()
+    started = time.time()
+    synced = 0
     while True:
         sync_running = False
         for node in app.config['nodes']:
@@ -141,28 +203,70 @@ def sync_data():
             start = head['index']+1 if head else 0
             while True:
                 logger.info(url, {"from_block":start, "limit":20})
-                res = requests.get(url, params={"from_block":start, "limit":20})
+                res = requests.get(url, params={"from_block":start, "limit":20}, headers={'Accept': ACCEPT})
+                remember_peer(node, res)
                 if res.status_code == 200:
-                    data = res.json()
+                    if is_binary(res.headers):
+                        data = wire.decode_blocks(res.content)
+                    else:
+                        data = [Block.from_dict(el) for el in res.json()]
                     if not data:
                         break
-                    sync_running = True
+                    # peer is on another branch, go back until its blocks connect to our tree
+                    if data[0].index and not bc.has_block(data[0].prev_hash) and start > 0 and bc.can_reorg_from(start - 1):
+                        start = max(0, start - 20)
+                        continue
                     for block in data:
                         try:
-                            bc.add_block(block)
+                            added = bc.add_block(block)
                         except Exception as e:
                             logger.exception(e)
                             return
-                        else:
-                            logger.info(f"Block added: #{block['index']}")
+                        if added:
+                            sync_running = True
+                            synced += 1
+                            logger.info(f"Block added: #{block.index}")
                     start += 20
 
             head = bc.get_head()
         if not sync_running:
             app.config['sync_running'] = False
+            logger.info('Synced %s blocks from peers in %.3fs' % (synced, time.time() - started))
             logger.info('================== Sync stopped =================')
             return
             
+def save_snapshot(block, db):
+    if block.index % app.config['snapshot_every'] == 0:
+        started = time.time()
+        app.config['storage'].sync()
+        app.config['snapshots'].save(db, block)
+        logger.info('State snapshot at #%s saved in %.3fs' % (block.index, time.time() - started))
+
+def load_wallet(data_dir):
+    path = os.path.join(data_dir, 'wallet')
+    if os.path.exists(path):
+        with open(path, 'rb') as fp:
+            address, priv = fp.read().split(b'\n', 1)
+        return Wallet(address.decode(), priv)
+    wallet = Wallet.create()
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as fp:
+        fp.write(wallet.address.encode() + b'\n' + wallet.priv)
+    return wallet
+
+def dump_mempool():
+    started = time.time()
+    saved = app.config['bc'].dump_mempool(app.config['mempool_file'])
+    logger.info('Mempool of %s txs saved in %.3fs' % (saved, time.time() - started))
+
+async def dump_mempool_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(app.config['mempool_dump_every'])
+        try:
+            await loop.run_in_executor(None, dump_mempool)
+        except Exception as e:
+            logger.exception(e)
+
 def broadcast(path, data, params=False, fiter_host=None):
     for node in list(app.config['nodes'])[:]:
         if node == ('%s:%s' % (app.config['host'],app.config['port'])) or fiter_host == node:
@@ -172,10 +276,26 @@ def broadcast(path, data, params=False, fiter_host=None):
         try:
             # header added here as we run all nodes on one domain and need somehow understand the sender node
             # to not create broadcast loop
+            headers = {'node':'%s:%s' % (app.config['host'],app.config['port'])}
             if params:
-                requests.post(url, params=data, timeout=2, headers={'node':'%s:%s' % (app.config['host'],app.config['port'])})   
+                res = requests.post(url, params=data, timeout=2, headers=headers)
+            elif isinstance(data, (Block, Tx)):
+                # blocks and txs go in binary form to peers which told us they support it
+                if app.config['peer_formats'].get(node):
+                    headers['Content-Type'] = wire.MEDIA_TYPE
+                    res = requests.post(url, data=data.encode(), timeout=2, headers=headers)
+                else:
+                    res = requests.post(url, json=data.as_dict, timeout=2, headers=headers)
+            elif isinstance(data, list):
+                # batch of txs
+                if app.config['peer_formats'].get(node):
+                    headers['Content-Type'] = wire.MEDIA_TYPE
+                    res = requests.post(url, data=wire.encode_list(data), timeout=2, headers=headers)
+                else:
+                    res = requests.post(url, json={'txs': [el.as_dict for el in data]}, timeout=2, headers=headers)
             else:
-                requests.post(url, json=data, timeout=2, headers={'node':'%s:%s' % (app.config['host'],app.config['port'])})
+                res = requests.post(url, json=data, timeout=2, headers=headers)
+            remember_peer(node, res)
         except:
             pass
 
@@ -187,11 +307,13 @@ def mine(event):
             def check_stop():
                 return event.is_set()
             logger.info(f'>> Starting new block mining')
-            app.config['api'].mine_block(check_stop)
-            logger.info(f'>> New block mined')
-            broadcast('/chain/add_block', app.config['api'].get_head())
+            # template is refreshed inside on new blocks and txs, so loop only turns after own block mined
+            block = app.config['api'].mine_block(check_stop)
             if event.is_set():
                 return
+            if block:
+                logger.info(f'>> New block mined')
+                broadcast('/chain/add_block', block)
         except asyncio.CancelledError:
             logger.info('>>>>>>>>>> Mining loop stopped')
             return
@@ -199,6 +321,67 @@ def mine(event):
             logger.exception(e)
 
 
+### WIRE FORMAT
+
+ACCEPT = '%s, application/json;q=0.5' % wire.MEDIA_TYPE
+
+@app.middleware("http")
+async def wire_formats(request: Request, call_next):
+    response = await call_next(request)
+    # peers learn from this header that binary blocks and txs can be sent to this node
+    response.headers['X-Wire-Formats'] = 'binary,json'
+    return response
+
+def is_binary(headers):
+    return headers.get('content-type', '').startswith(wire.MEDIA_TYPE)
+
+def accepts_binary(request):
+    return wire.MEDIA_TYPE in request.headers.get('accept', '')
+
+def remember_peer(node, res):
+    app.config['peer_formats'][node] = 'binary' in res.headers.get('x-wire-formats', '')
+
+def payload_body(model):
+    '''
+    OpenAPI request body of an endpoint read by read_payload, the raw Request hides it from FastAPI.
+    Nested models are inlined, they are not in the schema components.
+    '''
+    schema = model.schema()
+    defs = schema.pop('definitions', None) or schema.pop('$defs', {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            if '$ref' in node:
+                return inline(defs[node['$ref'].split('/')[-1]])
+            return {k: inline(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [inline(el) for el in node]
+        return node
+
+    return {'requestBody': {'required': True, 'content': {
+        'application/json': {'schema': inline(schema)},
+        wire.MEDIA_TYPE: {'schema': {'type': 'string', 'format': 'binary'}},
+    }}}
+
+async def read_payload(request, model, decode, from_dict):
+    '''
+    Reads Block or Tx from request body, binary or JSON validated by pydantic model
+    '''
+    body = await request.body()
+    if is_binary(request.headers):
+        try:
+            return decode(body)
+        except Exception as e:
+            raise RequestValidationError([{'loc': ('body',), 'msg': str(e), 'type': 'value_error'}])
+    try:
+        return from_dict(model.parse_raw(body).dict())
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    except Exception as e:
+        # errors of Tx/Block construction, like an unsigned input, are bad payloads as well
+        raise RequestValidationError([{'loc': ('body',), 'msg': str(e), 'type': 'value_error'}])
+
+
 ### SERVER OPERATIONS
 
 @app.post("/chain/stop-mining")
@@ -214,6 +397,14 @@ async def start_minig():
         app.jobs['mining'] = asyncio.Event()
         loop.run_in_executor(None, mine, app.jobs['mining'])
 
+@app.get("/chain/mining-stats")
+async def mining_stats():
+    return app.config['api'].get_mining_stats()
+
+@app.get("/chain/verify-stats")
+async def verify_stats():
+    return app.config['api'].get_verify_stats()
+
 @app.get("/server/nodes")
 async def get_nodes():
     return app.config['nodes']
@@ -257,14 +448,14 @@ async def send_amount(address_to:str, amount:int, background_tasks: BackgroundTa
 
     tx = Tx(inputs,outs)
     try:
-        res = bc.add_tx(tx.as_dict)
+        res = bc.add_tx(tx)
     except Exception as e:
         logger.exception(e)
         return {"success":False, "msg":str(e)}
     else:
         if res:
             logger.info(f'Tx added to the stack')
-            background_tasks.add_task(broadcast, '/chain/tx_create', tx.as_dict, False)
+            background_tasks.add_task(broadcast, '/chain/tx_create', tx, False)
             return {"success":True}
         logger.info('Tx already in stack. Skipped.')
         return {"success":False, "msg":"Duplicate"}
@@ -296,13 +487,20 @@ async def status():
         'timestamp':head['timestamp']
     }
 
+@app.get("/chain/tx_proof")
+async def tx_proof(tx_hash:str):
+    return app.config['api'].get_tx_proof(tx_hash)
+
 @app.get("/chain/sync")
-async def sync(from_block:int, limit:int=20):
+async def sync(from_block:int, request: Request, limit:int=20):
     bc = app.config['api']
+    if accepts_binary(request):
+        return Response(bc.get_chain_encoded(from_block, limit), media_type=wire.MEDIA_TYPE)
     return bc.get_chain(from_block, limit)
 
-@app.post("/chain/add_block")
-async def add_block(block:BlockModel, background_tasks: BackgroundTasks, request: Request):
+@app.post("/chain/add_block", openapi_extra=payload_body(BlockModel))
+async def add_block(background_tasks: BackgroundTasks, request: Request):
+    block = await read_payload(request, BlockModel, Block.from_bytes, Block.from_dict)
     logger.info(f"New block arived: #{block.index} from {request.headers.get('node')}")
     if app.config['sync_running']:
         logger.error(f'################### Not added, cause sync is running')
@@ -310,42 +508,59 @@ async def add_block(block:BlockModel, background_tasks: BackgroundTasks, request
     bc = app.config['api']
     head = bc.get_head()
 
-    if (head['index'] + 1) < block.index:
+    # unknown parent means a branch we have not seen, it is fetched by sync from the fork point
+    if (head['index'] + 1) < block.index or not bc.has_block(block.prev_hash):
         app.config['sync_running'] = True
         background_tasks.add_task(sync_data)
         logger.error(f'################### Not added, cause node out of sync.')
         return {"success":False, "msg":'Out of sync'}
     try:
-        res = bc.add_block(block.dict())
-        if res: restart_miner()
+        res = bc.add_block(block)
     except Exception as e:
         logger.exception(e)
         return {"success":False, "msg":str(e)}
     else:
         if res:
             logger.info('Block added to the chain')
-            background_tasks.add_task(broadcast, '/chain/add_block', block.dict(), False, request.headers.get('node'))
+            background_tasks.add_task(broadcast, '/chain/add_block', block, False, request.headers.get('node'))
             return {"success":True}
         logger.info('Old block. Skipped.')
         return {"success":False, "msg":"Duplicate"}
 
-@app.post("/chain/tx_create")
-async def add_tx(tx: TxModel, background_tasks: BackgroundTasks, request: Request):
+@app.post("/chain/tx_create", openapi_extra=payload_body(TxModel))
+async def add_tx(background_tasks: BackgroundTasks, request: Request):
+    tx = await read_payload(request, TxModel, Tx.from_bytes, Tx.from_dict)
     logger.info(f'New Tx arived')
     bc = app.config['api']
     try:
-        res = bc.add_tx(tx.dict())
+        res = bc.add_tx(tx)
     except Exception as e:
         logger.exception(e)
         return {"success":False, "msg":str(e)}
     else:
         if res:
             logger.info(f'Tx added to the stack')
-            background_tasks.add_task(broadcast, '/chain/tx_create', tx.dict(), False, request.headers.get('node'))
+            background_tasks.add_task(broadcast, '/chain/tx_create', tx, False, request.headers.get('node'))
             return {"success":True}
         logger.info('Tx already in stack. Skipped.')
         return {"success":False, "msg":"Duplicate"}
 
+@app.post("/chain/tx_create_batch", openapi_extra=payload_body(TxsModel))
+async def add_txs(background_tasks: BackgroundTasks, request: Request):
+    txs = await read_payload(request, TxsModel, wire.decode_txs, lambda data: [Tx.from_dict(el) for el in data['txs']])
+    logger.info(f'New Tx batch arived: {len(txs)} txs')
+    bc = app.config['api']
+    try:
+        res = bc.add_txs(txs)
+    except Exception as e:
+        logger.exception(e)
+        return {"success":False, "msg":str(e)}
+    accepted = [tx for tx, el in zip(txs, res) if el['success']]
+    if accepted:
+        logger.info(f'{len(accepted)} Txs added to the stack')
+        background_tasks.add_task(broadcast, '/chain/tx_create_batch', accepted, False, request.headers.get('node'))
+    return {"success":bool(accepted), "results":res}
+
 @app.on_event("startup")
 async def on_startup():
     app.config['sync_running'] = True
@@ -357,19 +572,27 @@ async def on_startup():
     if app.config['mine']:
         app.jobs['mining'] = asyncio.Event()
         loop.run_in_executor(None, mine, app.jobs['mining'])
+    if app.config['mempool_file']:
+        app.jobs['mempool_dump'] = asyncio.create_task(dump_mempool_loop())
     
 @app.on_event("shutdown")
 async def on_shutdown():
     if app.jobs.get('mining'):
         app.jobs.get('mining').set()
-
-#### Utils ###########################
-def restart_miner():
-    if app.jobs.get('mining'):
-        loop = asyncio.get_running_loop()
-        app.jobs['mining'].set()
-        app.jobs['mining'] = asyncio.Event()
-        loop.run_in_executor(None, mine, app.jobs['mining'])
+    if app.config.get('miner'):
+        app.config['miner'].stop()
+    if app.jobs.get('mempool_dump'):
+        app.jobs['mempool_dump'].cancel()
+    if app.config.get('mempool_file'):
+        dump_mempool()
+    if app.config.get('verify_pool'):
+        app.config['verify_pool'].shutdown(wait=False)
+    if app.config.get('snapshots') and app.config['bc'].head:
+        app.config['storage'].sync()
+        app.config['snapshots'].save(app.config['db'], app.config['bc'].head)
+    if app.config.get('storage'):
+        app.config['storage'].close()
+    app.config['db'].close()
 
 if __name__ == "__main__":
 
@@ -386,13 +609,61 @@ if __name__ == "__main__":
     parser.add_argument('--mine', required=False, type=bool, help='Port on which run the node.')
     parser.add_argument('--diff', required=False, type=int, help='Difficulty')
     parser.add_argument('--ip', required=True, type=str, help='IP address on which to run the node.')
+    parser.add_argument('--workers', required=False, type=int, help='Mining processes. 0 to use all cores. If not set mines in one thread.')
+    parser.add_argument('--verify-workers', required=False, type=int, help='Processes to check block signatures. 0 to use all cores.')
+    parser.add_argument('--data-dir', required=False, type=str, help='Directory to store blocks, snapshots and wallet. If not set chain is kept in memory.')
+    parser.add_argument('--snapshot-every', required=False, type=int, default=100, help='Blocks between state snapshots.')
+    parser.add_argument('--prune-depth', required=False, type=int, help='Drop fully spent transactions this many blocks deep. Requires --data-dir. If not set all are kept.')
+    parser.add_argument('--mempool-dump-every', required=False, type=int, default=60, help='Seconds between mempool saves to the data dir.')
+    parser.add_argument('--db', required=False, choices=['memory', 'sqlite'], default='memory', help='State backend. sqlite requires --data-dir.')
 
 
     args = parser.parse_args()
-    _DB = DB()
-    _DB.config['difficulty']
-    _W = Wallet.create()
-    _BC = Blockchain(_DB, _W)
+    if args.prune_depth is not None and not args.data_dir:
+        # without the block log every block stays in memory, pruning the DB would not bound memory
+        parser.error('--prune-depth requires --data-dir')
+    started = time.time()
+    _STORAGE = None
+    _SNAPSHOTS = None
+    if args.db == 'sqlite':
+        if not args.data_dir:
+            parser.error('--db sqlite requires --data-dir')
+        os.makedirs(args.data_dir, exist_ok=True)
+        _DB = SQLiteDB(os.path.join(args.data_dir, 'chain.sqlite'))
+        _STORAGE = _DB.blocks
+    else:
+        _DB = None
+        if args.data_dir:
+            _STORAGE = BlockLog(os.path.join(args.data_dir, 'blocks'))
+            _SNAPSHOTS = Snapshots(os.path.join(args.data_dir, 'snapshots'))
+            _DB = _SNAPSHOTS.load(_STORAGE)
+        _DB = _DB or DB()
+        _DB.prune_depth = args.prune_depth
+    loaded = time.time()
+    if args.diff:
+        _DB.config['difficulty'] = args.diff
+    _W = load_wallet(args.data_dir) if args.data_dir else Wallet.create()
+    _MINER = None
+    if args.workers is not None:
+        # start workers before server threads are running, so fork is clean
+        _MINER = Miner(args.workers)
+        _MINER.start()
+    _POOL = None
+    if args.verify_workers is not None:
+        _POOL = ProcessPoolExecutor(args.verify_workers or None)
+    _BC = Blockchain(_DB, _W, on_new_block=save_snapshot if _SNAPSHOTS else None, miner=_MINER, verify_pool=_POOL, storage=_STORAGE)
+    state_index = _DB.block_index if _DB.block_index_by_tx_hash else None
+    replay_started = time.time()
+    replayed = _BC.replay_storage()
+    logger.info(
+        'Startup: state at #%s loaded in %.3fs, %s blocks replayed in %.3fs, ready in %.3fs'
+        % (state_index, loaded - started, replayed, time.time() - replay_started, time.time() - started)
+    )
+    _MEMPOOL_FILE = os.path.join(args.data_dir, 'mempool.dat') if args.data_dir else None
+    if _MEMPOOL_FILE:
+        mempool_started = time.time()
+        accepted = _BC.load_mempool(_MEMPOOL_FILE)
+        logger.info('Mempool: %s txs loaded in %.3fs' % (accepted, time.time() - mempool_started))
     _API = API(_BC)
     logger.info(' ####### Server address: %s ########' %_W.address)
 
@@ -400,13 +671,21 @@ if __name__ == "__main__":
     app.config['wallet'] = _W
     app.config['bc'] = _BC
     app.config['api'] = _API
+    app.config['miner'] = _MINER
+    app.config['verify_pool'] = _POOL
+    app.config['storage'] = _STORAGE
+    app.config['snapshots'] = _SNAPSHOTS
+    app.config['snapshot_every'] = args.snapshot_every
+    app.config['mempool_file'] = _MEMPOOL_FILE
+    app.config['mempool_dump_every'] = args.mempool_dump_every
     app.config['port'] = args.port  
     app.config['host'] = args.ip
     app.config['nodes'] = set(args.node) if args.node else set()
+    app.config['peer_formats'] = {}
     app.config['sync_running'] = False
     app.config['mine'] = args.mine
 
-    if not args.node:
+    if not args.node and not _BC.head:
         _BC.create_first_block()
 
     uvicorn.run(app, host=args.ip, port=args.port, access_log=True)
\ No newline at end of file
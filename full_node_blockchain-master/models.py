@@ -30,6 +30,9 @@ Models:
         Represents a list of blocks, serving as a collection that can be used to transmit multiple blocks,
         for example, when syncing the blockchain across nodes.
 
+    TxsModel:
+        Represents a batch of transactions submitted or relayed at once.
+
     NodesModel:
         Represents a list of node identifiers, typically used to manage and update the network's peer information.
 
@@ -82,5 +85,10 @@ class BlocksModel(BaseModel):
     class Config:
         arbitrary_types_allowed = True
 
+class TxsModel(BaseModel):
+    txs:List[TxModel]
+    class Config:
+        arbitrary_types_allowed = True
+
 class NodesModel(BaseModel):
     nodes:List[str]
\ No newline at end of file